@@ -0,0 +1,210 @@
+"""Caches the parsed capabilities of OGC web services on disk."""
+#ifndef DOXYGEN_SHOULD_SKIP_THIS
+#
+# Copyright (C) 2009
+# by 52 North Initiative for Geospatial Open Source Software GmbH
+#
+# Contact: Andreas Wytzisk
+# 52 North Initiative for Geospatial Open Source Software GmbH
+# Martin-Luther-King-Weg 24
+# 48155 Muenster, Germany
+# info@52north.org
+#
+# This program is free software; you can redistribute and/or modify it
+# under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed WITHOUT ANY WARRANTY; even without the
+# implied WARRANTY OF MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (see gnu-gpl v2.txt). If not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA or visit the Free Software Foundation web page,
+# http://www.fsf.org.
+#
+# @author: $Author: $
+# Created: Oct 17, 2010
+# Modified: $Date$
+#       by: $Author: $
+#
+#endif
+__version__ = '$Id: $'
+
+import os
+import time
+import urllib2
+import cPickle
+import logging
+
+import constants
+
+from hashlib import md5
+
+###############################################################################
+
+class CapabilitiesCache():
+    """
+    Keeps the parsed capabilities of web services on disk, so reconnecting
+    to a known service does not have to download and parse its
+    capabilities document again.
+
+    The cache is handed to L{owslib.wms.WebMapService} or
+    L{owslib.wfs.WebFeatureService}, which store their metadata objects
+    (pickled) per capabilities URL, i.e. per service URL and version.
+
+    Entries older than max_age are revalidated: the document is requested
+    conditionally (ETag, Last-Modified) and only parsed again, if it has
+    changed. If the service cannot be reached, an expired entry is used.
+    """
+
+    def __init__(self, path=os.path.join(constants.TMP_PATH, 'capabilities'),
+                 max_age=constants.CAPABILITIES_MAX_AGE):
+        """
+        @param path: The directory where to cache capabilities.
+        @param max_age: Seconds after an entry gets revalidated.
+        """
+        self._logger = logging.getLogger('capcache-logger')
+        self._logger.setLevel(constants.LOG_LEVEL)
+
+        self.path = path
+        self.max_age = max_age
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, 0755)
+
+    def get(self, url, parse):
+        """
+        Returns the metadata of the given capabilities document.
+
+        @param url: The URL of the capabilities document.
+        @param parse: The function building the metadata from the document.
+        It is called with the document as string and has to return a
+        picklable object.
+        @return: The metadata, from cache or as returned by parse.
+        @raise IOError: If the document is neither cached nor available.
+        """
+        file_name = self.get_path(url)
+        header = self._read(file_name, 1)
+        if header is not None and not self.is_expired(url):
+            metadata = self._read(file_name, 2)
+            if metadata is not None:
+                self._logger.debug("Capabilities of %s from cache.", url)
+                return metadata
+
+        request = urllib2.Request(url)
+        if header is not None:
+            if header['etag']:
+                request.add_header('If-None-Match', header['etag'])
+            if header['last_modified']:
+                request.add_header('If-Modified-Since', header['last_modified'])
+        try:
+            response = urllib2.urlopen(request)
+            try:
+                data = response.read()
+                info = response.info()
+            finally:
+                response.close()
+        except urllib2.HTTPError, e:
+            if e.code != 304 or header is None:
+                raise
+            self._logger.debug("Capabilities of %s not modified.", url)
+            return self._refresh(file_name)
+        except IOError, e:
+            if header is None:
+                raise
+            self._logger.error("Use expired capabilities of %s: %s", url, e)
+            return self._read(file_name, 2)
+
+        digest = md5(data).hexdigest()
+        if header is not None and header['digest'] == digest:
+            self._logger.debug("Capabilities of %s unchanged.", url)
+            return self._refresh(file_name)
+
+        metadata = parse(data)
+        header = {'url': url,
+                  'etag': info.get('ETag'),
+                  'last_modified': info.get('Last-Modified'),
+                  'digest': digest}
+        self._write(file_name, header, metadata)
+        return metadata
+
+    def get_path(self, url):
+        """
+        Returns the file where the capabilities of the URL are cached.
+        """
+        return os.path.join(self.path, md5(url).hexdigest() + '.pickle')
+
+    def is_expired(self, url):
+        """
+        Indicates if the cached capabilities of the URL need revalidation
+        (or are not cached at all).
+        """
+        try:
+            stored = os.path.getmtime(self.get_path(url))
+        except OSError:
+            return True
+        return time.time() - stored > self.max_age
+
+    def remove(self, url):
+        """
+        Removes the cached capabilities of the URL.
+        """
+        file_name = self.get_path(url)
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+    def _refresh(self, file_name):
+        """
+        Marks an entry as revalidated and returns its metadata.
+        """
+        metadata = self._read(file_name, 2)
+        if metadata is not None:
+            os.utime(file_name, None)
+        return metadata
+
+    def _read(self, file_name, count):
+        """
+        Reads the header (count is 1) or the metadata (count is 2) of an
+        entry. Returns None, if the entry is missing or broken.
+        """
+        if not os.path.exists(file_name):
+            return None
+        file_ = None
+        try:
+            try:
+                file_ = open(file_name, 'rb')
+                for i in range(count):
+                    value = cPickle.load(file_)
+                return value
+            except Exception, e:
+                self._logger.error("Drop broken entry %s: %s", file_name, e)
+                if file_:
+                    file_.close()
+                    file_ = None
+                os.remove(file_name)
+                return None
+        finally:
+            if file_:
+                file_.close()
+
+    def _write(self, file_name, header, metadata):
+        """
+        Writes an entry: the (small) header first, so it can be read on its
+        own, then the metadata (write-then-rename).
+        """
+        tmp = None
+        try:
+            try:
+                tmp = open(file_name + '.part', 'wb')
+                cPickle.dump(header, tmp, cPickle.HIGHEST_PROTOCOL)
+                cPickle.dump(metadata, tmp, cPickle.HIGHEST_PROTOCOL)
+                tmp.close()
+                tmp = None
+                os.rename(file_name + '.part', file_name)
+            except (IOError, OSError, TypeError, cPickle.PicklingError), e:
+                self._logger.error("Could not cache capabilities: %s", e)
+        finally:
+            if tmp:
+                tmp.close()
+                os.remove(file_name + '.part')
@@ -44,10 +44,33 @@ BUNDLE_PATH = activity.get_bundle_path()
 CONFIG_PATH = os.path.join(BUNDLE_PATH, 'config')
 ICON_PATH = os.path.join(BUNDLE_PATH, 'icons')
 TMP_PATH = os.path.join(BUNDLE_PATH, 'tmp')
+MBTILES_PATH = os.path.join(BUNDLE_PATH, 'mbtiles')
 
 # VALUES
-GPS_LOOP = 2000 # repeat GPS retrieval in milliseconds
+GPS_SOURCE = os.environ.get('GEO_GPS_SOURCE', 'gpsd') # see position.create_source
+GPSD_HOST = '127.0.0.1' # where gpsd listens
+GPSD_PORT = 2947
+GPS_RECONNECT = 5000 # retry connecting to gpsd in milliseconds
+GPS_FILTER = True # smooth fixes (Kalman filter) before they move the player
+GPS_ACCELERATION = 1.0 # m/s^2 assumed for players by the position filter
 SPACE_DISCRETION = 0.00003 # buffer (assume two points to be equal) XXX test
+TILE_WORKERS = 4 # number of threads fetching map tiles
+TILE_MARGIN = 0 # tiles loaded beyond each edge of the visible map
+TILE_CACHE_SIZE = 50 * 1024 * 1024 # bytes of map tiles cached on disk
+TILE_MAX_AGE = 7 * 24 * 3600 # seconds until a cached map tile expires
+TILE_TIMEOUT = 10 # seconds to wait for a tile server (also when connecting)
+PIXBUF_CACHE_SIZE = 16 * 1024 * 1024 # bytes of decoded map tiles in memory
+# How a WMS map is shown while it loads: a single GetMap response row by row
+# as decoded (both False), tiles as they arrive (only WMS_TILED) or, since a
+# partial composition would hide the upper layers, the map when complete
+# (WMS_LAYERWISE). Responses are decoded while they arrive in any case.
+WMS_TILED = True # request WMS maps as cached tiles
+WMS_LAYERWISE = True # request WMS layers as separate images, composed here
+WMS_LAYER_WORKERS = 4 # number of threads fetching WMS layers
+WMS_CACHE_SIZE = 20 * 1024 * 1024 # bytes of WMS tiles cached on disk (all maps)
+WMS_PIXBUF_CACHE_SIZE = 8 * 1024 * 1024 # bytes of decoded WMS tiles in memory (all maps)
+WMS_TILE_WORKERS = 4 # number of threads fetching missing WMS tiles of a map
+CAPABILITIES_MAX_AGE = 24 * 3600 # seconds until cached capabilities are revalidated
 
 # GeoJSON IDs
 PLAYER_ID = 'org.n52.olpc.player'
@@ -149,6 +149,8 @@ class GeoCanvas(gtk.HBox):
 
         self.current_bbox = BoundingBox(None, None, None, None)
         self.crosslines_timeout = False
+        self._viewport = None # see get_viewport()
+        self.connect("size_allocate", self.viewport_allocation_cb)
 
         self.vbox = gtk.VBox()
         self.vbox.pack_start(self.canvas)
@@ -186,6 +188,34 @@ class GeoCanvas(gtk.HBox):
         """
         self.get_parent_window().set_cursor(gdk_cursor)
 
+    def get_viewport(self):
+        """
+        Returns the transform between lon/lat and screen pixels.
+
+        The transform is created once (see L{GeoCanvas.create_viewport})
+        and kept until L{GeoCanvas.invalidate_viewport} is called, so
+        converting pointer and overlay positions does not have to set it
+        up again for each event.
+
+        @return: A L{projection.Viewport} or None, if the geo has none.
+        """
+        if self._viewport is None:
+            self._viewport = self.create_viewport()
+        return self._viewport
+
+    def invalidate_viewport(self):
+        """
+        Drops the cached viewport. Call it whenever the map's center, zoom
+        or size changes.
+        """
+        self._viewport = None
+
+    def viewport_allocation_cb(self, widget, allocation):
+        """
+        Callback to drop the cached viewport when the size has changed.
+        """
+        self.invalidate_viewport()
+
     def expose_canvas_cb(self, widget, event):
         self._logger.debug("expose_canvas_cb()")
         x, y, width, height = event.area
@@ -366,6 +396,7 @@ class GeoCanvas(gtk.HBox):
 #        self._logger.debug("_draw_no_players_on_map()")
         model = self.activity.get_model()
         self._disable_timeout_redraw_players() # stop redrawing
+        self.drawable.remove_traces()
         for icon in self.drawn_players.values():
             self._logger.debug("remove icon: %s", icon)
             self.drawable.remove_overlay(icon)
@@ -383,6 +414,7 @@ class GeoCanvas(gtk.HBox):
         player = model.players[name]
         position = player.position
 
+        self.drawable.draw_trace(name, player.trace, player.color_stroke)
         if name in self.drawn_players.keys():
             self.drawable.redraw_overlay(self.drawn_players[name], position)
         else:
@@ -468,6 +500,44 @@ class GeoCanvas(gtk.HBox):
         """
         raise NotImplementedError
 
+    def create_viewport(self):
+        """
+        Returns a new viewport for the current center, zoom and size.
+
+        @return: A L{projection.Viewport} or None, if the geo does not use
+        the slippy map projection.
+        @note: Override to make use of L{GeoCanvas.get_viewport}.
+        """
+        return None
+
+    def get_screen_coords_all(self, positions):
+        """
+        Returns the screen coordinates for many positions at once.
+
+        Override if the geo can convert a batch of positions faster than
+        one by one.
+
+        @param positions: A list of positions in lon/lat.
+        @return: A list of tuples (x,y) (None for positions not on screen).
+        """
+        return [self.get_screen_coords(pos) for pos in positions]
+
+    def get_trace_coords(self, trace):
+        """
+        Returns the screen coordinates of the points needed to draw a trace
+        at the zoom level of the map (see L{tracestore.Trace.simplify}).
+
+        @param trace: The L{tracestore.Trace} to draw.
+        @return: A list of tuples (x,y) (None for points not on screen).
+        """
+        viewport = self.get_viewport()
+        if viewport is None:
+            return self.get_screen_coords_all([Point(lon, lat) for lon, lat \
+                                               in trace.get_positions()])
+        positions = trace.get_positions(viewport.zoom)
+        return viewport.to_screen_all([lon for lon, lat in positions],
+                                      [lat for lon, lat in positions])
+
     def register_toolbars(self, toolbox):
         """
         Registers all toolbars the view provides.
@@ -506,6 +576,7 @@ class DrawingCanvas(gtk.DrawingArea):
         self.connect("expose_event", self.expose_cb)
 
         self.canvas = canvas
+        self.traces = {} # { name : (trace, color, points drawn) }
 
     def configure_cb(self, widget, event):
         """
@@ -532,8 +603,14 @@ class DrawingCanvas(gtk.DrawingArea):
 
             drawable = widget.window
             drawable.draw_drawable(self.ctx, self.pixmap, x, y, x, y, w, h)
-            for overlay in self.overlays.keys():
-                self.draw_overlay(overlay, self.overlays[overlay])
+            self._draw_traces(drawable)
+            overlays = self.overlays.items()
+            positions = self.canvas.get_screen_coords_all([pos for overlay, pos \
+                                                           in overlays])
+            for (overlay, pos), position in zip(overlays, positions):
+                if position and self.window:
+                    x_pos, y_pos = self._get_draw_details(overlay, position)[4:]
+                    self.window.draw_pixbuf(self.ctx, overlay, 0, 0, x_pos, y_pos)
         else:
             self._logger.info("expose(): no pixmap to draw on!")
 
@@ -544,6 +621,44 @@ class DrawingCanvas(gtk.DrawingArea):
 #        self._logger.debug("draw_map()")
         self.pixmap.draw_pixbuf(self.ctx, pixbuf, 0, 0, x_pos, y_pos)
 
+    def draw_trace(self, name, trace, color):
+        """
+        Draws the trace of a player as line below the overlays. The canvas
+        is only redrawn if the trace has changed.
+
+        @param name: The name of the player.
+        @param trace: The player's L{tracestore.Trace}.
+        @param color: The color of the line, e.g. '#FF8F00'.
+        """
+        drawn = self.traces.get(name)
+        self.traces[name] = (trace, color, len(trace))
+        if drawn is None or drawn[1:] != (color, len(trace)):
+            self.queue_draw()
+
+    def remove_traces(self):
+        """
+        Removes the traces of all players from the map.
+        """
+        self.traces.clear()
+        self.queue_draw()
+
+    def _draw_traces(self, drawable):
+        """
+        Draws the traces, simplified for the zoom level of the map. Lines
+        are interrupted where points lie beyond the spatial extent.
+        """
+        for trace, color, count in self.traces.values():
+            gc = drawable.new_gc(line_width=2)
+            gc.set_rgb_fg_color(gtk.gdk.color_parse(color))
+            line = []
+            for point in self.canvas.get_trace_coords(trace) + [None]:
+                if point is not None:
+                    line.append(point)
+                    continue
+                if len(line) > 1:
+                    drawable.draw_lines(gc, line)
+                line = []
+
     def draw_overlay(self, overlay, pos):
         """
         Draws the given xo icon on the map at the given pixel position.
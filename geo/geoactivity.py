@@ -48,7 +48,6 @@ from sugar import logger
 from sugar.activity.activity import Activity
 from sugar.presence import presenceservice
 
-import constants
 import position
 import groupthink
 
@@ -65,6 +64,9 @@ SERVICE = "org.n52.olpc.GeoActivity"
 IFACE = SERVICE
 PATH = "/org/n52/olpc/PluginSync"
 
+# map tiles etc. are fetched by worker threads
+gobject.threads_init()
+
 ###############################################################################
 
 class GeoActivity(GroupActivity):#IGNORE:R0904,R0901
@@ -105,16 +107,16 @@ class GeoActivity(GroupActivity):#IGNORE:R0904,R0901
         self._logger.debug("Starting Geo Activity ...")
 
         # initialize GPS
-        self.gps_position = None # set by timeout
+        self.gps_position = None # set by each fix
+        self.gps_fix = None # GPS information of the last fix
         try:
-            # setup GPS timer
+            # stream fixes from gpsd
             self.gps_receiver = GPSReceiver(self.gps_info)
             self._logger.debug('try to establish connection')
 
             #_LOG.debug("GPS_SESSION: %s", self.gps_receiver.GPS_SESSION)
             if self.gps_receiver.GPS_SESSION is not None:
-                self.gps_receiver.get_position()
-                gobject.timeout_add(constants.GPS_LOOP, self._emit_position_change)
+                self.gps_receiver.watch(self._emit_position_change)
                 self._logger.debug('GPS connection established.')
         except:
             # no connection could be established
@@ -257,28 +259,22 @@ class GeoActivity(GroupActivity):#IGNORE:R0904,R0901
     def get_gps_herror(self):
         return self.gps_info['eph']
 
-    def _emit_position_change(self):
+    def _emit_position_change(self, gps_info):
         """
         Emits a 'position_changed' signal indicating the GPS position has
-        been updated.
+        been updated (called for each new fix).
 
         Connect to with
             GeoActivity.connect(self, activity, position)
         Where position is of type L{shapely.geometry.Point}.
         """
-        if self.has_gps_connection():
-            self.gps_receiver.get_position()
-            self.gps_position = Point(self.gps_info['longitude'],
-                                      self.gps_info['latitude'])
-            if self.gps_position.x != 0 and self.gps_position.y != 0:
-                # (0,0) is special case
-#                self._logger.debug("position changed: %s", self.gps_position)
-                self.emit('position_changed', self.gps_position)
-        else:
-            self._logger.info('No GPS connection. Reset position to None.')
-            self.gps_position = None
-        #self._logger.debug('lon/lat: %s/%s' % (self.gps_position.x, self.gps_position.y))
-        return True
+        self.gps_fix = gps_info
+        self.gps_position = Point(gps_info['longitude'],
+                                  gps_info['latitude'])
+        if self.gps_position.x != 0 and self.gps_position.y != 0:
+            # (0,0) is special case
+#            self._logger.debug("position changed: %s", self.gps_position)
+            self.emit('position_changed', self.gps_position)
 
     #######################################################################
 
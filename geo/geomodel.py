@@ -50,6 +50,7 @@ from utils import _
 
 from groupthink.groupthink_base import CausalDict
 from groupthink.groupthink_base import string_translator
+from tracestore import Trace
 from shapely.geometry import Point
 from shapely.geometry import shape
 
@@ -127,7 +128,7 @@ class Player(gobject.GObject):
 
     ICON_SIZE = (30,30)
 
-    trace = dict() # { 'time.time()': position }
+    trace = None # the L{Trace} of moves
     oldpos = None # used, to not emit unnecessary changes.
     icon = None
 
@@ -145,7 +146,7 @@ class Player(gobject.GObject):
         # players properties
         self.nickname = nickname
         self.position = Point(0,0)
-        self.trace = dict()
+        self.trace = Trace()
 
         # set colors of the current player as default
         self.color_fill = profile.get_color().get_fill_color()
@@ -210,12 +211,16 @@ class Player(gobject.GObject):
         self.color_stroke = stroke
         self.color_fill   = fill
 
-    def set_position(self, source, new_pos):
+    def set_position(self, source, new_pos, altitude=None, error=None,
+                     utc=None):
         """
         Callback method to set a new position for the player.
 
         @param source: the source emitted the signal
         @param new_pos: the new position as L{shapely.geometry.Point}.
+        @param altitude: the altitude in meters (traced, if known).
+        @param error: the horizontal error in meters (traced, if known).
+        @param utc: the time of the fix in seconds (traced, now if unknown).
         @note: Emits a 'player_changed' signal to indicate the change.
         """
 #        self._logger.debug("set new position: %s", new_pos)
@@ -224,8 +229,9 @@ class Player(gobject.GObject):
 
         # only emit changes when moved
         if self.has_moved():
-            time_stamp = str(time.time())
-            self.trace[time_stamp] = self.position
+            if utc is None:
+                utc = time.time()
+            self.trace.append(utc, new_pos.x, new_pos.y, altitude, error)
             self._logger.debug("emit player_changed")
             self.emit('player_changed')
 
@@ -317,7 +323,13 @@ class GeoModel():
         self.players[self.mynickname] = this_player
         #gobject.timeout_add(3000, self.print_dict) # only for debugging
 
-        activity.connect('position_changed', this_player.set_position)
+        activity.connect('position_changed', self._position_changed_cb,
+                         this_player)
+
+        # players walking within a position simulation (load testing)
+        receiver = getattr(activity, 'gps_receiver', None)
+        if receiver is not None and receiver.GPS_SESSION is not None:
+            receiver.watch_others(self._simulated_position_cb)
 
         self._logger.debug("INIT GEOSPACEMODEL DONE.")
 
@@ -355,6 +367,33 @@ class GeoModel():
         shared.connect('buddy-joined', player_joined_cb)
         shared.connect('buddy-left', player_left_cb)
 
+    def _position_changed_cb(self, activity, position, player):
+        """
+        Moves the own player to the position of the activity's last fix.
+        """
+        gps_info = activity.gps_fix or {}
+        player.set_position(activity, position, gps_info.get('altitude'),
+                            gps_info.get('eph'), gps_info.get('utc'))
+
+    def _simulated_position_cb(self, name, gps_info):
+        """
+        Moves the player of a simulated walker (joining it first) and
+        shares the move, like a player of another XO would do.
+
+        @param name: The name of the walker.
+        @param gps_info: The GPS information of the walker's fix.
+        """
+        player = self.players.get(name)
+        joined = player is None
+        if joined:
+            player = Player(name)
+        player.set_position(None, Point(gps_info['longitude'],
+                                        gps_info['latitude']),
+                            gps_info.get('altitude'), gps_info.get('eph'),
+                            gps_info.get('utc'))
+        if joined or player.has_moved():
+            self.players[name] = player
+
     def print_dict(self):
         """
         For debugging: log out the shared datastructure pretty printed.
@@ -404,10 +443,8 @@ class GeoModel():
             player = self.players[key]
             nick = player.nickname
 
-            trace = list()
-            for key in player.trace.keys():
-                trace.append((key, player.trace[key]))
-            trace = str(trace.sort())
+            # (time, lon, lat, altitude, error) in order of time
+            trace = str(list(player.trace))
 
             fill = player.color_fill
             stroke = player.color_stroke
@@ -0,0 +1,333 @@
+"""Reads and writes map tiles from/to MBTiles (SQLite) files.
+
+Usage (imports a region into a MBTiles file):
+
+    python mbtiles.py FILE WEST SOUTH EAST NORTH MIN_ZOOM MAX_ZOOM [SOURCE]
+
+SOURCE is either a tile server URL (default are the tile servers listed in
+config/default_tiles) or a directory containing tiles as <zoom>/<x>/<y>.png
+(e.g. the tile cache).
+
+@see: http://mapbox.com/developers/mbtiles/
+"""
+#ifndef DOXYGEN_SHOULD_SKIP_THIS
+#
+# Copyright (C) 2009
+# by 52 North Initiative for Geospatial Open Source Software GmbH
+#
+# Contact: Andreas Wytzisk
+# 52 North Initiative for Geospatial Open Source Software GmbH
+# Martin-Luther-King-Weg 24
+# 48155 Muenster, Germany
+# info@52north.org
+#
+# This program is free software; you can redistribute and/or modify it
+# under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed WITHOUT ANY WARRANTY; even without the
+# implied WARRANTY OF MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (see gnu-gpl v2.txt). If not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA or visit the Free Software Foundation web page,
+# http://www.fsf.org.
+#
+# @author: $Author: $
+# Created: Oct 17, 2010
+# Modified: $Date$
+#       by: $Author: $
+#
+#endif
+__version__ = '$Id: $'
+
+import os
+import sys
+import glob
+import sqlite3
+import logging
+import threading
+
+import tilesource
+
+from projection import TILE_PIXELS
+from projection import lonlat2world
+from tilesource import TileSource
+
+_LOG = logging.getLogger('mbtiles-logger')
+
+_DEFAULT_TILES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'config', 'default_tiles')
+_OSM_URL = 'http://tile.openstreetmap.org/' # if none configured
+_BATCH_SIZE = 256 # tiles stored per transaction when importing
+
+###############################################################################
+
+class MBTiles():
+    """
+    A tile store backed by a MBTiles file.
+
+    Tiles are looked up by (zoom, x, y) in slippy map numbering. Within the
+    file rows are stored in TMS numbering (y axis pointing north), as the
+    MBTiles specification demands.
+
+    @note: The store is used from several tile workers and is thread-safe.
+    """
+
+    def __init__(self, path, create=False):
+        """
+        Opens the given MBTiles file.
+
+        @param path: The path of the MBTiles file.
+        @param create: Create an empty file (with schema), if not existent.
+        @raise IOError: If file does not exist and create is False.
+        """
+        if not create and not os.path.exists(path):
+            raise IOError, "No such MBTiles file: '%s'" % path
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        if create:
+            self._create_schema()
+
+        metadata = self.get_metadata()
+        self.min_zoom = int(metadata.get('minzoom', 0))
+        self.max_zoom = int(metadata.get('maxzoom', 30))
+
+    def get(self, tile):
+        """
+        Returns the image data of the given tile.
+
+        @param tile: The tile tuple (zoom, x, y).
+        @return: The encoded image or None if the tile is not stored.
+        """
+        zoom, x, y = tile
+        if not self.min_zoom <= zoom <= self.max_zoom:
+            return None
+        self._lock.acquire()
+        try:
+            cursor = self._db.execute('SELECT tile_data FROM tiles WHERE '
+                                      'zoom_level=? AND tile_column=? AND '
+                                      'tile_row=?', (zoom, x, _flip(zoom, y)))
+            row = cursor.fetchone()
+        finally:
+            self._lock.release()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def get_metadata(self):
+        """
+        Returns the metadata table as dictionary.
+        """
+        self._lock.acquire()
+        try:
+            try:
+                rows = self._db.execute('SELECT name, value FROM metadata')
+                return dict(rows.fetchall())
+            except sqlite3.Error, e:
+                _LOG.error("No metadata within '%s': %s", self.path, e)
+                return {}
+        finally:
+            self._lock.release()
+
+    def put_all(self, tiles, metadata=None):
+        """
+        Stores the given tiles within one transaction.
+
+        @param tiles: An iterable of ((zoom, x, y), data) tuples.
+        @param metadata: A dictionary of metadata to store (optional).
+        @return: The number of tiles stored.
+        """
+        rows = [(zoom, x, _flip(zoom, y), sqlite3.Binary(data)) \
+                for (zoom, x, y), data in tiles if data]
+        self._lock.acquire()
+        try:
+            try:
+                self._db.executemany('INSERT OR REPLACE INTO tiles (zoom_level, '
+                                     'tile_column, tile_row, tile_data) VALUES '
+                                     '(?, ?, ?, ?)', rows)
+                if metadata:
+                    self._db.executemany('INSERT OR REPLACE INTO metadata '
+                                         '(name, value) VALUES (?, ?)',
+                                         metadata.items())
+                self._db.commit()
+            except sqlite3.Error:
+                self._db.rollback()
+                raise
+        finally:
+            self._lock.release()
+        if metadata:
+            self.min_zoom = int(metadata.get('minzoom', self.min_zoom))
+            self.max_zoom = int(metadata.get('maxzoom', self.max_zoom))
+        return len(rows)
+
+    def close(self):
+        """
+        Closes the underlying database.
+        """
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()
+
+    def _create_schema(self):
+        """
+        Creates tables and the (zoom, column, row) index, if not existent.
+        """
+        self._db.execute('CREATE TABLE IF NOT EXISTS metadata '
+                         '(name TEXT, value TEXT)')
+        self._db.execute('CREATE UNIQUE INDEX IF NOT EXISTS name ON '
+                         'metadata (name)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level '
+                         'INTEGER, tile_column INTEGER, tile_row INTEGER, '
+                         'tile_data BLOB)')
+        self._db.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON '
+                         'tiles (zoom_level, tile_column, tile_row)')
+        self._db.commit()
+
+###########################  FUNCTIONS  #######################################
+
+def open_stores(path):
+    """
+    Opens all MBTiles files lying within the given directory.
+
+    @param path: The directory to look for *.mbtiles files.
+    @return: A list of L{MBTiles} (empty, if directory does not exist).
+    """
+    stores = []
+    for file_ in sorted(glob.glob(os.path.join(path, '*.mbtiles'))):
+        try:
+            stores.append(MBTiles(file_))
+            _LOG.debug("Opened tile store '%s'.", file_)
+        except (IOError, sqlite3.Error), e:
+            _LOG.error("Could not open tile store '%s': %s", file_, e)
+    return stores
+
+def import_region(path, bbox, min_zoom, max_zoom, source=None):
+    """
+    Imports all tiles of a region into a MBTiles file. Tiles are stored in
+    batches while they are read, so a large region neither has to fit into
+    memory nor is lost completely if the import is interrupted.
+
+    @param path: The MBTiles file (created if not existent).
+    @param bbox: The region as tuple (west, south, east, north) in WGS84.
+    @param min_zoom: The lowest zoom level to import.
+    @param max_zoom: The highest zoom level to import.
+    @param source: A tile server URL or a directory of <zoom>/<x>/<y>.png
+    (default are the tile servers of config/default_tiles).
+    @return: The number of tiles imported.
+    """
+    tile_source = None
+    if source is not None and os.path.isdir(source):
+        read = lambda tile: _read_file(source, tile)
+    else:
+        if source is None:
+            urls = tilesource.read_urls(_DEFAULT_TILES) or [_OSM_URL]
+        elif source.endswith('/'):
+            urls = [source]
+        else:
+            urls = [source + '/']
+        tile_source = TileSource(urls)
+        read = lambda tile: _download(tile_source, tile)
+
+    metadata = {'name': os.path.splitext(os.path.basename(path))[0],
+                'type': 'baselayer',
+                'version': '1.0',
+                'format': 'png',
+                'bounds': '%f,%f,%f,%f' % bbox,
+                'minzoom': str(min_zoom),
+                'maxzoom': str(max_zoom)}
+    store = MBTiles(path, create=True)
+    try:
+        old = store.get_metadata()
+        if 'minzoom' in old and 'maxzoom' in old:
+            metadata['minzoom'] = str(min(min_zoom, int(old['minzoom'])))
+            metadata['maxzoom'] = str(max(max_zoom, int(old['maxzoom'])))
+        count = 0
+        batch = []
+        for tile in _region_tiles(bbox, min_zoom, max_zoom):
+            data = read(tile)
+            if data is None:
+                _LOG.warn("Tile %s not available from '%s'.", tile,
+                          source or urls)
+                continue
+            batch.append((tile, data))
+            if len(batch) >= _BATCH_SIZE:
+                count += store.put_all(batch)
+                batch = []
+        return count + store.put_all(batch, metadata)
+    finally:
+        store.close()
+        if tile_source is not None:
+            tile_source.close()
+
+def _region_tiles(bbox, min_zoom, max_zoom):
+    """
+    Generates the tiles (zoom, x, y) covering the region on each zoom level.
+    """
+    west, south, east, north = bbox
+    for zoom in range(min_zoom, max_zoom + 1):
+        first_x, first_y = _lonlat2tile(west, north, zoom)
+        last_x, last_y = _lonlat2tile(east, south, zoom)
+        for x in range(first_x, last_x + 1):
+            for y in range(first_y, last_y + 1):
+                yield (zoom, x, y)
+
+def _read_file(directory, tile):
+    """
+    Reads a tile from a tile directory.
+    """
+    file_ = os.path.join(directory, '%s/%s/%s.png' % tile)
+    if not os.path.exists(file_):
+        return None
+    tmp = open(file_, 'rb')
+    try:
+        return tmp.read()
+    finally:
+        tmp.close()
+
+def _download(tile_source, tile):
+    """
+    Downloads a tile from the tile servers.
+    """
+    try:
+        return tile_source.get_tile(tile)[0]
+    except IOError, e:
+        _LOG.error("Could not load tile %s: %s", tile, e)
+        return None
+
+def _flip(zoom, y):
+    """
+    Converts y between slippy map and TMS numbering.
+    """
+    return (1 << zoom) - 1 - y
+
+def _lonlat2tile(lon, lat, zoom):
+    """
+    Returns the slippy map tile numbers (x, y) containing lon/lat.
+    """
+    tilenum = 1 << zoom
+    x, y = lonlat2world(lon, lat, zoom)
+    x, y = int(x // TILE_PIXELS), int(y // TILE_PIXELS)
+    return min(max(x, 0), tilenum - 1), min(max(y, 0), tilenum - 1)
+
+###############################################################################
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) not in (8, 9):
+        print __doc__
+        sys.exit(1)
+
+    bbox = tuple([float(value) for value in sys.argv[2:6]])
+    args = [sys.argv[1], bbox, int(sys.argv[6]), int(sys.argv[7])]
+    if len(sys.argv) == 9:
+        args.append(sys.argv[8])
+    count = import_region(*args)
+    print '%d tiles imported into %s' % (count, sys.argv[1])
@@ -39,98 +39,248 @@ __version__ = '$Id: osmtileview.py 179 2010-09-27 08:47:24Z  $'
 import os
 import gtk
 import math
-import urllib
 import logging
-import threading
 
 from sugar import profile
 
 import utils
 import geo
+import mbtiles
 import position
 import constants
+import tilesource
 
 from geo import BoundingBox
 from geo import GeoCanvas
 from geo import GeoToolbar
 from shapely.geometry import Point
+from projection import Viewport
+from projection import TILE_PIXELS
+from projection import lonlat2world
+from projection import world2lonlat
+from tilecache import TileCache
+from tilecache import PixbufCache
+from tilesource import HTTPPool
+from tilesource import TileSource
+from tilefetcher import TileFetcher
+from tilefetcher import PRIORITY_PREFETCH
 
 ###############################################################################
 
-class TileReceiver(threading.Thread):
+class TileReceiver():
+    """
+    Loads OSM tiles from MBTiles stores, the tile cache or the tile server.
+
+    MBTiles files lying in L{constants.MBTILES_PATH} are looked up first,
+    so prepared regions can be used without uplink (see L{mbtiles}).
+
+    Tiles are downloaded from the tile servers listed within
+    config/default_tiles (see L{tilesource.TileSource}), sharing
+    persistent connections. An expired tile is requested conditionally, so
+    it is only transferred again if it has changed on the tile server.
 
-    # TODO:  make this editable from the user interface? or via an application
-    # that users with XOs can join to get the correct url
-    _BASE_URL = 'http://tile.openstreetmap.org/mapnik/'
+    @note: L{TileReceiver.receive} is called from within the workers of a
+    L{tilefetcher.TileFetcher}, so it must not touch any widgets.
+    """
+
+    _DEFAULT_TILES = os.path.join(constants.CONFIG_PATH, 'default_tiles')
+    _OSM_URL = 'http://tile.openstreetmap.org/' # if none configured
+    _PLACEHOLDER_LEVELS = 4 # zoom levels to look up for ancestor tiles
+    _PLACEHOLDER_COLOR = 0xe0e0e0ff # fills missing parts of placeholders
 
-    def __init__(self, i, i_x, j, i_y, view):
-        threading.Thread.__init__(self, target=self.render_tile, args=(i, i_x, j, i_y, view))
+    def __init__(self, cache=None, pixbufs=None, stores=None, source=None):
+        """
+        @param cache: The L{tilecache.TileCache} to keep tiles in (a cache
+        within L{constants.TMP_PATH} is created if None).
+        @param pixbufs: The L{tilecache.PixbufCache} to keep decoded tiles
+        in (created if None).
+        @param stores: A list of L{mbtiles.MBTiles} to read tiles from (the
+        files within L{constants.MBTILES_PATH} are opened if None).
+        @param source: The L{tilesource.TileSource} to download tiles from
+        (the servers listed within config/default_tiles if None).
+        """
         self._logger = logging.getLogger('tilereceiver-logger')
         self._logger.setLevel(constants.LOG_LEVEL)
-        self.zoom = view.zoom
-
-    def render_tile(self, i, i_x, j, i_y, view):
-
-        max = 2**(self.zoom) # highest tile-num available
-        if i_x >= 0 and i_y >= 0 and i_x < max and i_y < max:
-            tile_relpath = '%s/%s/' % (self.zoom, i_x)
-            tile_path = os.path.join(constants.TMP_PATH, tile_relpath)
-            tile_name = '%s.png' % i_y
-            tile = os.path.join(tile_relpath, tile_name)
-            file_ = os.path.join(constants.TMP_PATH , tile)
-            #self._logger.debug(file_)
-
-            if not os.path.exists(file_):
-                if not os.path.exists(tile_path):
-                    os.makedirs(tile_path, 0755)
-                tile_url = self._BASE_URL + tile_relpath + tile_name
-                self.get_tile(file_, tile_url)
-        else:
-            # out of bounds
-            file_ = os.path.join(constants.TMP_PATH, '404.png')
+        if cache is None:
+            cache = TileCache()
+        if pixbufs is None:
+            pixbufs = PixbufCache()
+        if stores is None:
+            stores = mbtiles.open_stores(constants.MBTILES_PATH)
+        if source is None:
+            urls = tilesource.read_urls(self._DEFAULT_TILES) or [self._OSM_URL]
+            source = TileSource(urls, HTTPPool(constants.TILE_WORKERS,
+                                               constants.TILE_TIMEOUT))
+        self.cache = cache
+        self.pixbufs = pixbufs
+        self.stores = stores
+        self.source = source
+        self._404 = None
+
+    def receive(self, tile):
+        """
+        Returns the given tile as pixbuf and keeps it in memory. Tiles not
+        available within the tile cache (or expired) will be downloaded
+        (or revalidated) from the tile server first.
+
+        @note: Look up L{TileReceiver.pixbufs} before, decoded tiles are
+        not taken from memory here.
+
+        @param tile: The tile tuple (zoom, x, y).
+        @return: The tile's L{gtk.gdk.Pixbuf} (the 404 image if the tile is
+        out of bounds or could not be loaded).
+        """
+        zoom, i_x, i_y = tile
+        max = 2**(zoom) # highest tile-num available
+        if not (i_x >= 0 and i_y >= 0 and i_x < max and i_y < max):
+            return self._get_404() # out of bounds
+
+        data = self._read_stores(tile)
+        if data is not None:
+            try:
+                pixbuf = utils.load_image(data)
+                self.pixbufs.put(tile, pixbuf)
+                return pixbuf
+            except Exception, e:
+                self._logger.error("Invalid tile %s in store: %s", tile, e)
+
+        file_ = self.cache.get(tile)
+        if file_ is None:
+            file_ = self._download(tile)
+        if file_ is None:
+            # offline: better show an outdated tile than none
+            file_ = self.cache.get_stale(tile)
+        if file_ is None:
+            return self._get_404()
 
-        # draw map stuff on drawable
-        pixbuf = None
         try:
             pixbuf = gtk.gdk.pixbuf_new_from_file(file_)
         except Exception, e:
             self._logger.error("Reload file '%s' (contained no data).", file_)
+            self.cache.remove(tile)
+            return self._get_404()
+        self.pixbufs.put(tile, pixbuf)
+        return pixbuf
+
+    def prefetch(self, tile):
+        """
+        Downloads the given tile into the tile cache, if not cached yet.
+        The tile is not decoded.
+
+        @param tile: The tile tuple (zoom, x, y).
+        """
+        zoom, i_x, i_y = tile
+        max = 2**(zoom) # highest tile-num available
+        if not (i_x >= 0 and i_y >= 0 and i_x < max and i_y < max):
+            return # out of bounds
+        if self._read_stores(tile) is not None:
+            return
+        if self.cache.get_stale(tile) is None or self.cache.is_expired(tile):
+            self._download(tile)
+
+    def get_placeholder(self, tile):
+        """
+        Returns a preliminary pixbuf for the given tile, made of decoded
+        tiles from other zoom levels: an upscaled part of an ancestor tile
+        or, if there is none, a mosaic of the downscaled child tiles.
+
+        @param tile: The tile tuple (zoom, x, y).
+        @return: The placeholder pixbuf or None if there are no decoded
+        tiles to build it from.
+        """
+        zoom, i_x, i_y = tile
+        size = OSMTileView._TILE_PIXELS
+
+        # parent, grandparent, ..
+        for level in range(1, min(zoom, self._PLACEHOLDER_LEVELS) + 1):
+            ancestor = (zoom - level, i_x >> level, i_y >> level)
+            pixbuf = self._lookup(ancestor)
+            if pixbuf is not None:
+                part = size >> level
+                mask = (1 << level) - 1
+                sub = pixbuf.subpixbuf((i_x & mask) * part, (i_y & mask) * part,
+                                       part, part)
+                return sub.scale_simple(size, size, gtk.gdk.INTERP_BILINEAR)
+
+        children = [(zoom + 1, 2 * i_x + dx, 2 * i_y + dy) \
+                    for dx in (0, 1) for dy in (0, 1)]
+        pixbufs = [(child, self._lookup(child)) for child in children]
+        pixbufs = [(child, pixbuf) for child, pixbuf in pixbufs if pixbuf]
+        if not pixbufs:
+            return None
+        half = size / 2
+        mosaic = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, size, size)
+        mosaic.fill(self._PLACEHOLDER_COLOR)
+        for child, pixbuf in pixbufs:
+            dest_x = (child[1] - 2 * i_x) * half
+            dest_y = (child[2] - 2 * i_y) * half
+            pixbuf.scale(mosaic, dest_x, dest_y, half, half, dest_x, dest_y,
+                         0.5, 0.5, gtk.gdk.INTERP_BILINEAR)
+        return mosaic
+
+    def _read_stores(self, tile):
+        """
+        Returns the tile's image data from the first store containing it.
+        """
+        for store in self.stores:
+            data = store.get(tile)
+            if data is not None:
+                return data
+        return None
+
+    def _lookup(self, tile):
+        """
+        Returns the decoded tile, if in memory (a miss is not counted).
+        """
+        if self.pixbufs.contains(tile):
+            return self.pixbufs.get(tile)
+        return None
+
+    def _get_404(self):
+        """
+        Returns the (once decoded) pixbuf shown for unavailable tiles.
+        """
+        if self._404 is None:
             file_ = os.path.join(constants.TMP_PATH, '404.png')
-            pixbuf = gtk.gdk.pixbuf_new_from_file(file_)
-        x_loc = i * view._TILE_PIXELS + view.x_shift
-        y_loc = j * view._TILE_PIXELS + view.y_shift
-        #self._logger.debug('place pixbuf to x: %s y: %s', x_loc, y_loc)
-        view.drawable.draw_map(pixbuf, x_loc, y_loc)
-        view.canvas.queue_draw_area(x_loc, y_loc, view._TILE_PIXELS, view._TILE_PIXELS)
+            self._404 = gtk.gdk.pixbuf_new_from_file(file_)
+        return self._404
 
-    def get_tile(self, file_, tile):
-        tmp = None
+    def _download(self, tile):
+        """
+        Downloads the tile into the tile cache. If an (expired) copy is
+        cached, it is revalidated by its ETag and Last-Modified values.
+
+        @param tile: The tile tuple (zoom, x, y).
+        @return: The path of the cached tile or None if it could not be
+        downloaded.
+        """
+        etag, last_modified = None, None
+        if self.cache.get_stale(tile) is not None:
+            etag, last_modified = self.cache.get_validators(tile)
         try:
-            #self._logger.debug("url: %s", self._BASE_URL + tile_relpath + tile_name)
-            response = urllib.urlopen(tile)
-            tmp = open(file_, 'w')
-            tmp.write(response.read())
-        except Exception, e:
-            self._logger.debug("Could not load tile '%s' from URL (at zoom level %s)", tile, self.zoom)
-            file_ = os.path.join(constants.TMP_PATH, '404.png')
-        finally:
-            if tmp:
-                tmp.close()
+            data, etag, last_modified = self.source.get_tile(tile, etag,
+                                                             last_modified)
+        except IOError, e:
+            self._logger.debug("Could not load tile %s: %s", tile, e)
+            return None
+        if data is None:
+            return self.cache.refresh(tile) # not modified
+        return self.cache.put(tile, data, etag, last_modified)
 
 ###############################################################################
 
 class OSMTileView(GeoCanvas):
 
-    _TILE_PIXELS = 256
-    _NX_TILES = 5
-    _NY_TILES = 5
+    _TILE_PIXELS = TILE_PIXELS
     ZOOM_MIN = 3
     ZOOM_MAX = 18
 
+    nx_tiles = 5 # tile columns, computed from allocation
+    ny_tiles = 5 # tile rows, computed from allocation
     x_shift = 0
     y_shift = 0
-    center = Point(-10.0, 20.0) # !! lon,lat !!
-    zoom = 4 # levels: 2--18
+    _center = Point(-10.0, 20.0) # !! lon,lat !!
+    _zoom = 4 # levels: 2--18
 
     x_pan_start = None
     y_pan_start = None
@@ -146,6 +296,17 @@ class OSMTileView(GeoCanvas):
         self.connect("motion_notify_event", self.pan_motion_cb)
 
         self._control = _Control(self)
+        self._receiver = TileReceiver()
+        self._fetcher = TileFetcher(self._receiver.receive,
+                                    self._receiver.prefetch)
+        self._size = None # (width, height) of the allocation
+        self._layout = None # (zoom, first_x, first_y, last_x, last_y)
+        self._pan_direction = (0, 0) # signs of the recent pan along x, y
+        self._drawn_tiles = set()
+        self._placeholders = set() # tiles drawn preliminary
+        self._drawn_origin = None # (zoom, x, y) world pixel at upper left
+        self._drawn_pixmap = None
+
         if not activity.has_gps_connection():
             self._logger.debug('Less zoom factor, since no GPS connection available.')
             self.zoom = 4
@@ -156,7 +317,8 @@ class OSMTileView(GeoCanvas):
                 self.center = activity.gps_position
 
         self.vbox.connect("expose_event", self.expose_cb)
-        self.size_cb = self.connect("size_allocate", self.size_allocation_cb)
+        self.connect("size_allocate", self.size_allocation_cb)
+        self.connect("destroy", self.destroy_cb)
 
         self.show_all()
 
@@ -175,6 +337,25 @@ class OSMTileView(GeoCanvas):
 
             activity.disconnect(self.center_on_first_position_handler)
 
+    def _get_center(self):
+        return self._center
+
+    def _set_center(self, center):
+        self._center = center
+        self.invalidate_viewport()
+
+    center = property(_get_center, _set_center,
+                      doc='The lon/lat Point shown in the middle of the map.')
+
+    def _get_zoom(self):
+        return self._zoom
+
+    def _set_zoom(self, zoom):
+        self._zoom = zoom
+        self.invalidate_viewport()
+
+    zoom = property(_get_zoom, _set_zoom, doc='The zoom level of the map.')
+
     def button_press_cb(self, widget, event):
         #self._logger.debug("button %s was pressed", event.button)
         if event.button == 1:
@@ -187,35 +368,109 @@ class OSMTileView(GeoCanvas):
         self.pan_started = False
         if self.panning:
             self.panning = False # reset pan modus
-            #self._logger.debug("x: %s y: %s", self.x_pixel, self.y_pixel)
-            x_px_delta = event.x - self.x_pan_start
-            y_px_delta = event.y - self.y_pan_start
-            xy_center = self.get_screen_coords(self.center)
-            self.center = self.get_lonlat_from(xy_center[0] - x_px_delta,
-                                               xy_center[1] - y_px_delta)
-            #self._logger.debug("new center: %s", self.center)
             self.change_cursor(geo.CROSS_CURSOR)
-            self.draw_map()
 
     def pan_motion_cb(self, widget, event):
-        if self.pan_started:
+        """
+        Moves the map while dragging.
+        """
+        if not self.pan_started:
+            return
+        if event.is_hint:
+            x, y, state = event.window.get_pointer()
+        else:
+            x, y = event.x, event.y
+        if not self.panning:
 #            self._logger.debug("panning")
             self.panning = True
             self.change_cursor(geo.PAN_CURSOR)
-        # TODO move map while dragging
+        x_px_delta = int(x - self.x_pan_start)
+        y_px_delta = int(y - self.y_pan_start)
+        if x_px_delta or y_px_delta:
+            self.x_pan_start += x_px_delta
+            self.y_pan_start += y_px_delta
+            self.pan_map(x_px_delta, y_px_delta)
+
+    def pan_map(self, x_px_delta, y_px_delta):
+        """
+        Moves the map by the given pixels.
+
+        The backing pixmap is scrolled, so only tiles which get exposed
+        (or were cut at the edges before) have to be drawn again. The same
+        holds for placeholders of tiles still pending.
+
+        @param x_px_delta: Pixels to move the map to the right.
+        @param y_px_delta: Pixels to move the map downwards.
+        """
+        pixmap = self.drawable.pixmap
+        if pixmap is None or self._drawn_origin is None:
+            return
+        zoom, origin_x, origin_y = self._drawn_origin
+        width, height = pixmap.get_size()
+
+        pixmap.draw_drawable(self.drawable.ctx, pixmap, 0, 0,
+                             x_px_delta, y_px_delta, width, height)
+        bg_gc = self.drawable.style.bg_gc[gtk.STATE_NORMAL]
+        if x_px_delta > 0:
+            pixmap.draw_rectangle(bg_gc, True, 0, 0, x_px_delta, height)
+        elif x_px_delta < 0:
+            pixmap.draw_rectangle(bg_gc, True, width + x_px_delta, 0,
+                                  -x_px_delta, height)
+        if y_px_delta > 0:
+            pixmap.draw_rectangle(bg_gc, True, 0, 0, width, y_px_delta)
+        elif y_px_delta < 0:
+            pixmap.draw_rectangle(bg_gc, True, 0, height + y_px_delta,
+                                  width, -y_px_delta)
+
+        # only tiles (and placeholders) drawn completely before are
+        # complete after scrolling
+        tile_px = self._TILE_PIXELS
+        for drawn in (self._drawn_tiles, self._placeholders):
+            for tile in list(drawn):
+                x_loc = tile[1] * tile_px - origin_x
+                y_loc = tile[2] * tile_px - origin_y
+                if not (0 <= x_loc and x_loc + tile_px <= width and \
+                        0 <= y_loc and y_loc + tile_px <= height):
+                    drawn.discard(tile)
+        self._drawn_origin = (zoom, origin_x - x_px_delta, origin_y - y_px_delta)
+
+        x, y, w, h = self.get_allocation()
+        self.center = Point(*world2lonlat(origin_x - x_px_delta + w / 2,
+                                          origin_y - y_px_delta + h / 2, zoom))
+        self.draw_map()
+        self.drawable.queue_draw()
 
     def size_allocation_cb(self, widget, allocation):
         """
-        Callback to configure widget appropriately before exposing.
+        Callback to redraw the map, when the size has changed.
         """
-        self._logger.debug('size_allocation_cb()')
         x, y, width, height = self.get_allocation()
 #        self._logger.debug("alloc: %s, %s, %s, %s", x, y, width, height)
-        self.x_shift = (width - self._NX_TILES * self._TILE_PIXELS) / 2
-        self.y_shift = (height - self._NY_TILES * self._TILE_PIXELS) / 2
+        if (width, height) == self._size:
+            return
+        self._size = (width, height)
+        self._drawn_tiles.clear()
+        self._placeholders.clear()
         self.queue_draw()
-        self._logger.debug('x_shift: %d, y_shift: %d', self.x_shift, self.y_shift)
-        self.disconnect(self.size_cb) # use only once
+
+    def destroy_cb(self, widget):
+        """
+        Callback to stop fetching tiles and to store the tile cache index.
+        """
+        self._fetcher.shutdown()
+        self._receiver.cache.flush()
+        hits, misses = self._receiver.cache.get_stats()
+        self._logger.debug('tile cache hits: %d, misses: %d', hits, misses)
+        hits, misses = self._receiver.pixbufs.get_stats()
+        self._logger.debug('pixbuf cache hits: %d, misses: %d', hits, misses)
+        self._receiver.pixbufs.clear()
+        for url, requests, errors, latency, paused in \
+                self._receiver.source.get_stats():
+            self._logger.debug('tile server %s: %d requests, %d errors, '
+                               '%.3f s latency', url, requests, errors, latency)
+        self._receiver.source.close()
+        for store in self._receiver.stores:
+            store.close()
 
     def expose_cb(self, widget, event):
         """
@@ -229,35 +484,165 @@ class OSMTileView(GeoCanvas):
     def draw_map(self):
         """
         Draws OSM tiles on the geo's drawable.
-        """
-        # clear old tiles
-        half_range_x = self._NX_TILES / 2.0
-        half_range_y = self._NY_TILES / 2.0
 
-        # xnum/ynum are the middle tile
-        x_num, y_num = deg2num(self.center, self.zoom)
-        first_x = x_num - int(half_range_x)
-        first_y = y_num - int(half_range_y)
-        last_x = x_num + int(half_range_x)
-        last_y = y_num + int(half_range_y)
+        The tiles covering the allocation (plus a ring of
+        L{constants.TILE_MARGIN} tiles) are drawn, so that the center lays
+        in the middle of the allocation.
+
+        Returns immediately: missing tiles are requested from the tile
+        fetcher and drawn as they arrive. Pending requests for tiles which
+        are no longer visible get cancelled.
+        """
+        tile_px = self._TILE_PIXELS
+        margin = constants.TILE_MARGIN
+        viewport = self.get_viewport()
+        origin_x, origin_y = viewport.origin_x, viewport.origin_y
+        width, height = viewport.width, viewport.height
+
+        first_x = origin_x // tile_px - margin
+        first_y = origin_y // tile_px - margin
+        last_x = (origin_x + width - 1) // tile_px + margin
+        last_y = (origin_y + height - 1) // tile_px + margin
+        self.nx_tiles = last_x - first_x + 1
+        self.ny_tiles = last_y - first_y + 1
+        self.x_shift = first_x * tile_px - origin_x
+        self.y_shift = first_y * tile_px - origin_y
 
         # spatial extent: upper-left & bottom-right
-        s_1st, w_1st, n_1st, e_1st = get_edges(first_x, first_y, self.zoom)
-        s_last, w_last, n_last, e_last = get_edges(last_x, last_y, self.zoom)
-        self.current_bbox = BoundingBox(w_1st, s_1st, e_1st, n_1st)
-        self.current_bbox.merge(BoundingBox(w_last, s_last, e_last, n_last))
-
-        # get and cache the tile
-        for i, i_x in enumerate(range(first_x, last_x+1)):
-            vbox = gtk.VBox()
-            for j, i_y in enumerate(range(first_y, last_y+1)):
-                receiver = TileReceiver(i, i_x, j, i_y, self)
-                receiver.start()
-                receiver.join(1)
+        west, north = world2lonlat(first_x * tile_px, first_y * tile_px,
+                                   self.zoom)
+        east, south = world2lonlat((last_x + 1) * tile_px,
+                                   (last_y + 1) * tile_px, self.zoom)
+        self.current_bbox = BoundingBox(west, south, east, north)
+
+        # remember pan direction to prefetch tiles ahead
+        layout = (self.zoom, first_x, first_y, last_x, last_y)
+        layout_changed = layout != self._layout
+        if layout_changed and self._layout is not None:
+            if self._layout[0] == self.zoom:
+                direction = (cmp(first_x, self._layout[1]),
+                             cmp(first_y, self._layout[2]))
+                if direction != (0, 0):
+                    self._pan_direction = direction
+            else:
+                self._pan_direction = (0, 0)
+        self._layout = layout
+
+        # forget drawn tiles when the map was moved (but not scrolled) or
+        # the backing pixmap has changed
+        origin = (self.zoom, origin_x, origin_y)
+        if origin != self._drawn_origin or \
+                self.drawable.pixmap is not self._drawn_pixmap:
+            self._drawn_origin = origin
+            self._drawn_pixmap = self.drawable.pixmap
+            self._drawn_tiles.clear()
+            self._placeholders.clear()
+
+        tiles = [(self.zoom, i_x, i_y) for i_x in range(first_x, last_x+1) \
+                                       for i_y in range(first_y, last_y+1)]
+        if layout_changed:
+            self._fetcher.cancel_except(tiles)
+        for tile in tiles:
+            if tile in self._drawn_tiles:
+                continue
+            pixbuf = self._receiver.pixbufs.get(tile)
+            if pixbuf is not None:
+                self._tile_received_cb(tile, pixbuf)
+            else:
+                self._fetcher.request(tile, self._tile_received_cb)
+                self._draw_placeholder(tile)
+        if layout_changed:
+            self._prefetch(first_x, first_y, last_x, last_y)
 
         if self._CROSSLINES:
             self.motion_crosslines(self)
 
+    def _prefetch(self, first_x, first_y, last_x, last_y):
+        """
+        Requests tiles the user will probably look at next with low priority.
+
+        These are the next ring of tiles in the direction of recent pans
+        (the whole ring, if the user did not pan yet) and the tiles shown
+        after zooming in or out. Prefetched tiles are only stored within
+        the tile cache, not decoded.
+
+        @param first_x: The x-number of the left tile column.
+        @param first_y: The y-number of the upper tile row.
+        @param last_x: The x-number of the right tile column.
+        @param last_y: The y-number of the lower tile row.
+        """
+        zoom = self.zoom
+        dx, dy = self._pan_direction
+        tiles = []
+        for i_x in range(first_x - 1, last_x + 2):
+            for i_y in range(first_y - 1, last_y + 2):
+                ahead = (dx == 0 and dy == 0) or \
+                        (dx > 0 and i_x > last_x) or (dx < 0 and i_x < first_x) or \
+                        (dy > 0 and i_y > last_y) or (dy < 0 and i_y < first_y)
+                if ahead and not (first_x <= i_x <= last_x and \
+                                  first_y <= i_y <= last_y):
+                    tiles.append((zoom, i_x, i_y))
+
+        half_range_x = int(self.nx_tiles / 2.0)
+        half_range_y = int(self.ny_tiles / 2.0)
+        for level in (zoom + 1, zoom - 1):
+            if not self.ZOOM_MIN <= level <= self.ZOOM_MAX:
+                continue
+            center_x, center_y = lonlat2world(self.center.x, self.center.y,
+                                              level)
+            x_num = int(center_x) // self._TILE_PIXELS
+            y_num = int(center_y) // self._TILE_PIXELS
+            for i_x in range(x_num - half_range_x, x_num + half_range_x + 1):
+                for i_y in range(y_num - half_range_y, y_num + half_range_y + 1):
+                    tiles.append((level, i_x, i_y))
+
+        for tile in tiles:
+            if not self._receiver.pixbufs.contains(tile):
+                self._fetcher.request(tile, priority=PRIORITY_PREFETCH)
+
+    def _draw_placeholder(self, tile):
+        """
+        Draws a placeholder for the given tile (once), so that cached tiles
+        of other zoom levels hide the time until the tile arrives.
+
+        @param tile: The tile tuple (zoom, x, y).
+        """
+        if tile in self._placeholders or self.drawable.pixmap is None:
+            return
+        pixbuf = self._receiver.get_placeholder(tile)
+        if pixbuf is None:
+            return
+        zoom, origin_x, origin_y = self._drawn_origin
+        x_loc = tile[1] * self._TILE_PIXELS - origin_x
+        y_loc = tile[2] * self._TILE_PIXELS - origin_y
+        self.drawable.draw_map(pixbuf, x_loc, y_loc)
+        self.canvas.queue_draw_area(x_loc, y_loc, self._TILE_PIXELS, self._TILE_PIXELS)
+        self._placeholders.add(tile)
+
+    def _tile_received_cb(self, tile, pixbuf):
+        """
+        Callback drawing a fetched tile, if it still belongs to the map.
+
+        @param tile: The tile tuple (zoom, x, y).
+        @param pixbuf: The tile's pixbuf.
+        """
+        zoom, i_x, i_y = tile
+        layout_zoom, first_x, first_y, last_x, last_y = self._layout
+        if pixbuf is None or zoom != layout_zoom or \
+                not (first_x <= i_x <= last_x and first_y <= i_y <= last_y):
+            return # outdated
+        if self.drawable.pixmap is None:
+            return
+
+        zoom, origin_x, origin_y = self._drawn_origin
+        x_loc = i_x * self._TILE_PIXELS - origin_x
+        y_loc = i_y * self._TILE_PIXELS - origin_y
+        #self._logger.debug('place pixbuf to x: %s y: %s', x_loc, y_loc)
+        self.drawable.draw_map(pixbuf, x_loc, y_loc)
+        self.canvas.queue_draw_area(x_loc, y_loc, self._TILE_PIXELS, self._TILE_PIXELS)
+        self._drawn_tiles.add(tile)
+        self._placeholders.discard(tile)
+
     def get_world_cursor(self):
         """
         Returns the lon/lat coordinates of the mouse pointer.
@@ -274,65 +659,47 @@ class OSMTileView(GeoCanvas):
         @param y_px: The y pixel.
         @return: Point(lon,lat) for given pixel coordinates.
         """
-        bbox = self.current_bbox
-        x, y, w, h = self.get_allocation()
-#        self._logger.debug('alloc: %s %s %s %s', x, y, w, h)
-
-        bbox_width_px = self._NX_TILES * self._TILE_PIXELS
-        bbox_height_px = self._NY_TILES * self._TILE_PIXELS
-
-        x_norm = float(x_px - self.x_shift) / float(bbox_width_px)
-        y_norm = float(bbox_height_px - y_px + self.y_shift) / float(bbox_height_px)
-
-        # get cursors mercator coordinates
-        ll_x, ll_y = lonlat2xy(bbox.get_west(), bbox.get_south(), self.zoom)
-        ur_x, ur_y = lonlat2xy(bbox.get_east(), bbox.get_north(), self.zoom)
-        x_merc = ll_x + (ur_x - ll_x) * x_norm
-        y_merc = ll_y + (ur_y - ll_y) * y_norm
-
-        # reproject cursor to lon/lat
-        return xy2lonlat(x_merc, y_merc, self.zoom)
+        lon, lat = self.get_viewport().to_lonlat(x_px, y_px)
+        return Point(lon, lat)
 
     def get_screen_coords(self, pos):
         """
         Returns the (x,y) values for the given lon/lat coordinates relative
         to the current screen or None if position lays beyond the current
-        spatial extent (BoundingBox).
+        view.
 
         @param pos: The position relative values shall be calculated for.
         @return: A tuple (x,y) containing the screen coordinates for lon/lat.
         @see geo.GeoCanvas#get_xy_coords()
         """
-        #self._logger.debug('get_screen_coordinates()')
-        bbox = self.current_bbox
-        if not self.current_bbox.contains(pos):
-            #self._logger.debug('out of range .. return None')
-            return None
+        return self.get_viewport().to_screen(pos.x, pos.y)
 
-        width = self._NX_TILES * self._TILE_PIXELS
-        height = self._NY_TILES * self._TILE_PIXELS
-        ll_x, ll_y = lonlat2xy(bbox.get_west(), bbox.get_south(), self.zoom)
-        ur_x, ur_y = lonlat2xy(bbox.get_east(), bbox.get_north(), self.zoom)
-        x_merc, y_merc = lonlat2xy(pos.x, pos.y, self.zoom)
-        x_norm = float(x_merc - ll_x) / float(ur_x - ll_x)
-        y_norm = float(y_merc - ll_y) / float(ur_y - ll_y)
-        x_screen = int(width * x_norm) + self.x_shift
-        y_screen = int(height * y_norm) - self.y_shift
-
-        #self._logger.debug(bbox)
-        #self._logger.debug('x: %1.6f y: %1.6f w: %1.6f h: %1.6f' %
-        #                  (x, y, width, height))
-        #self._logger.debug('lon: %1.6f lat: %1.6f' % (pos.x, pos.y))
-        #self._logger.debug('x_merc: %1.6f y_merc: %1.6f' % (x_merc, y_merc))
-        #self._logger.debug('xnorm: %1.6f ynorm: %1.6f' % (x_norm, y_norm))
-        #self._logger.debug('llx: %1.6f lly: %1.6f' % (ll_x, ll_y))
-        #self._logger.debug('urx: %1.6f ury: %1.6f' % (ur_x, ur_y))
-        #self._logger.debug('x_norm: %1.6f y_norm: %1.6f' % (x_norm, y_norm))
-
-        if (0 <= x_screen < width) and (0 <= y_screen <= height):
-            x_screen, y_screen = x_screen, height - y_screen
-            #self._logger.debug('x_screen: %d y_screen: %d' % (x_screen, y_screen))
-            return x_screen, y_screen
+    def get_screen_coords_all(self, positions):
+        """
+        Returns the screen coordinates of many positions at once.
+
+        @see: geo.GeoCanvas#get_screen_coords_all()
+        """
+        return self.get_viewport().to_screen_all([pos.x for pos in positions],
+                                                 [pos.y for pos in positions])
+
+    def create_viewport(self):
+        """
+        Returns the viewport centering L{OSMTileView.center} within the
+        allocation.
+
+        The center is rounded to whole world pixels, so the map does not
+        shift when the center was derived from a world pixel (see
+        L{OSMTileView.pan_map}).
+
+        @see: geo.GeoCanvas#create_viewport()
+        """
+        x, y, width, height = self.get_allocation()
+        center_x, center_y = lonlat2world(self.center.x, self.center.y,
+                                          self.zoom)
+        origin_x = int(round(center_x)) - width / 2
+        origin_y = int(round(center_y)) - height / 2
+        return Viewport(self.zoom, origin_x, origin_y, width, height)
 
     def register_toolbars(self, toolbox):
         """
@@ -524,134 +891,3 @@ class _MapToolbar(GeoToolbar):
         self.tile_view.change_cursor(geo.WAIT_CURSOR)
         self.control.update_map(Point(center.x - step, center.y))
         self.tile_view.change_cursor(geo.CROSS_CURSOR)
-
-###########################  FUNCTIONS  #######################################
-
-
-# All following functions more or less adopted from:
-# http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Python
-
-from math import pi
-from math import log
-from math import tan
-from math import cos
-from math import atan
-from math import sinh
-from math import radians
-from math import degrees
-
-def deg2num(center, zoom):
-    """Calculates tile numbers from given parameters.
-
-    @param center: The lon/lat of tile center.
-    @param zoom: The zoom level.
-    @see: http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Python
-    """
-    tilenum = num_tiles(zoom)
-    lat_rad = radians(center.y)
-    xtile = int((center.x + 180.0) / 360.0 * tilenum)
-    ytile = int((1.0 - log(tan(lat_rad) + sec(lat_rad)) / pi) / 2.0 * tilenum)
-
-    return xtile, ytile
-
-def num2deg(xtile, ytile, zoom):
-    """Returns the NW-corner of the square.
-
-    Use the function with xtile+1 and/or ytile+1 to get the other corners. With
-    xtile+0.5 & ytile+0.5 it will return the center of the tile.
-
-    @param xtile: The number of the xtile.
-    @param ytile: The number of the ytile.
-    @param zoom: The zoom factor.
-    @return: Point in lon/lat order
-    @see: http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Python
-    """
-    tilenum = num_tiles(zoom)
-    lon_deg = xtile / tilenum * 360.0 - 180.0
-    lat_rad = atan(sinh(pi * (1 - 2 * ytile / tilenum)))
-    lat_deg = degrees(lat_rad)
-
-    return Point(lon_deg, lat_deg)
-
-def lonlat2relativeXY(lon, lat):
-    """Returns a tuple (x,y)."""
-    x_rel = (lon + 180) / 360
-    y_rel = (1 - log(tan(radians(lat)) + sec(radians(lat))) / pi) / 2
-    return x_rel, y_rel
-
-def lonlat2xy(lon, lat, zoom):
-    """Returns a tuple (x,y)."""
-    tilenum = num_tiles(zoom)
-    x_rel, y_rel = lonlat2relativeXY(lon, lat)
-    return tilenum * x_rel, tilenum * y_rel
-
-def xy2lonlat(x_merc, y_merc, zoom):
-    """Returns a Point with lon/lat values."""
-    tilenum = num_tiles(zoom)
-    relY = y_merc / tilenum
-    lat = mercator2lat(pi * (1 - 2 * relY))
-    lon = -180.0 + 360.0 * x_merc / tilenum
-    return Point(lon, lat)
-
-def mercator2lat(mercator_y):
-    """Re-projects mercator coordinate to latitude value.
-
-    @note: parameter must be in domain [-pi,+pi].
-    @param mercator_y: The mercator y value to reproject.
-    @see: http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Python
-    """
-    return degrees(atan(sinh(mercator_y)))
-
-def lat_edge(ytile, zoom):
-    """Returns the latitude edge of given y-tile.
-
-    @param ytile: The y-number of tile to calculate north and south edges for.
-    @param zoom: The specific zoom factor used.
-    @return: Tuple containing (north-edge, south-edge).
-    @see: http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Python
-    """
-    tilenum = num_tiles(zoom)
-    unit = 1 / tilenum
-    rel_y1 = ytile * unit
-    rel_y2 = rel_y1 + unit
-    lat1 = mercator2lat(pi * (1 - 2 * rel_y1))
-    lat2 = mercator2lat(pi * (1 - 2 * rel_y2))
-
-    return lat1, lat2
-
-def lon_edge(xtile, zoom):
-    """Returns the longitude edge of given x-tile.
-
-    @param ytile: The x-number of tile to calculate east and west edges for.
-    @param zoom: The specific zoom factor used.
-    @return: Tuple containing (west-edge, east-edge).
-    @see: http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Python
-    """
-    tilenum = num_tiles(zoom)
-    unit = 360 / tilenum
-    lon1 = -180 + xtile * unit
-    lon2 = lon1 + unit
-
-    return lon1, lon2
-
-def get_edges(xtile, ytile, zoom):
-    """Returns the edges of the given tile.
-
-    @param xtile: The x-number of tile to calculate east and west edges for.
-    @param ytile: The y-number of tile to calculate north and south edges for.
-    @param zoom: The specific zoom factor used.
-    @return: tuple of (S,W,N,E) edges in geographic WGS84.
-    @see: http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Python
-    """
-    lat1, lat2 = lat_edge(ytile, zoom)
-    lon1, lon2 = lon_edge(xtile, zoom)
-
-    return (lat2, lon1, lat1, lon2) # S,W,N,E
-
-def num_tiles(zoom):
-    """Returns the number of tiles."""
-    return 2.0 ** zoom
-
-def sec(rad):
-    """Returns sec = 1/cos."""
-    return 1.0 / cos(rad)
@@ -0,0 +1,312 @@
+# -*- coding: ISO-8859-15 -*-
+# =============================================================================
+# Copyright (c) 2010 52 North Initiative for Geospatial Open Source Software
+#
+# Contact email: info@52north.org
+# =============================================================================
+
+"""
+Chunked, concurrent and resumable GetCoverage downloads.
+
+A coverage request is split into a grid of spatial chunks, which are
+requested concurrently (a bounded number at a time) and streamed to files
+of a download directory. Running the same download again requests only
+the chunks not complete yet.
+
+Only WCS 1.0.0 is supported: a 1.1.0 GetCoverage of a chunk would need
+its own grid origin and returns a multipart response (coverage
+description plus data), which is not taken apart here.
+
+example:
+wcs=WebCoverageService(url, version='1.0.0')
+downloader=CoverageDownloader(wcs, '/tmp/coverage', cols=4, rows=4)
+chunks=downloader.download('elevation', bbox=(-112,36,-106,41), crs='EPSG:4326', format='PGM', width=2000, height=1600)
+
+Run as script to start a stand-in WCS 1.0.0 for local testing, which
+serves a synthetic coverage 'gradient' as PGM (grey values computed from
+lon/lat, so chunks can be compared with a single request):
+
+    python -m owslib.coverage.wcsdownload [PORT [FAILURE_RATE]]
+"""
+
+import os
+import sys
+import time
+import Queue
+import threading
+from hashlib import md5
+
+
+class Chunk(object):
+    """A spatial part of a coverage request."""
+    def __init__(self, row, col, bbox, x=None, y=None, width=None, height=None):
+        """
+        @type row: int
+        @param row: row of the chunk, counted from the north
+        @type col: int
+        @param col: column of the chunk, counted from the west
+        @type bbox: tuple
+        @param bbox: (minx, miny, maxx, maxy) of the chunk
+        @param x, y: pixel offset of the chunk within the coverage (if the
+        coverage is requested by width and height)
+        @param width, height: pixel size of the chunk (dto.)
+        """
+        self.row = row
+        self.col = col
+        self.bbox = bbox
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.path = None # file of the downloaded chunk
+
+    def __str__(self):
+        return 'Chunk row=%s col=%s bbox=%s' % (self.row, self.col, self.bbox)
+
+
+class CoverageDownloader(object):
+    """Downloads coverages of a WCS 1.0.0 in spatial chunks."""
+    def __init__(self, wcs, directory, cols=2, rows=2, workers=4, retries=2,
+                 blocksize=64 * 1024):
+        """
+        @type wcs: WebCoverageService_1_0_0
+        @param wcs: the service to request coverages from
+        @type directory: string
+        @param directory: where to store the chunks (created if missing)
+        @param cols, rows: number of chunks along each axis
+        @param workers: number of chunks requested at once at most
+        @param retries: number of times a failed chunk is requested again
+        @param blocksize: bytes read from a response and written at once
+        @raise ValueError: if the service is not a WCS 1.0.0
+        """
+        if wcs.version != '1.0.0':
+            raise ValueError, 'WCS version %s is not supported, only 1.0.0' % \
+                  wcs.version
+        self.wcs = wcs
+        self.directory = directory
+        self.cols = cols
+        self.rows = rows
+        self.workers = workers
+        self.retries = retries
+        self.blocksize = blocksize
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def split(self, bbox, width=None, height=None):
+        """Split a coverage request into chunks.
+
+        If width and height are given, the chunks are cut along pixel
+        boundaries, so that they fit together exactly.
+
+        @type bbox: tuple
+        @param bbox: (minx, miny, maxx, maxy) of the coverage
+        @return: list of Chunk objects, row by row from the north west
+        """
+        minx, miny, maxx, maxy = [float(v) for v in bbox]
+        if width and height:
+            xs = [int(round(i * width / float(self.cols))) \
+                  for i in range(self.cols + 1)]
+            ys = [int(round(j * height / float(self.rows))) \
+                  for j in range(self.rows + 1)]
+            resx = (maxx - minx) / width
+            resy = (maxy - miny) / height
+        else:
+            xs = [i / float(self.cols) for i in range(self.cols + 1)]
+            ys = [j / float(self.rows) for j in range(self.rows + 1)]
+            resx = maxx - minx
+            resy = maxy - miny
+        chunks = []
+        for row in range(self.rows):
+            for col in range(self.cols):
+                chunk_bbox = (minx + xs[col] * resx, maxy - ys[row + 1] * resy,
+                              minx + xs[col + 1] * resx, maxy - ys[row] * resy)
+                if width and height:
+                    chunk = Chunk(row, col, chunk_bbox, xs[col], ys[row],
+                                  xs[col + 1] - xs[col], ys[row + 1] - ys[row])
+                else:
+                    chunk = Chunk(row, col, chunk_bbox)
+                chunks.append(chunk)
+        return chunks
+
+    def download(self, identifier, bbox, width=None, height=None,
+                 progress=None, **kwargs):
+        """Download a coverage in chunks, skipping chunks downloaded before.
+
+        Further keyword arguments (format, crs, time, resx, ...) are passed
+        to getCoverage for each chunk.
+
+        @type identifier: string
+        @param identifier: the coverage to download
+        @type bbox: tuple
+        @param bbox: (minx, miny, maxx, maxy) of the coverage
+        @param width, height: pixel size of the coverage
+        @param progress: called as progress(chunks done, chunks total) after
+        each chunk (from within the downloading threads)
+        @return: list of Chunk objects (see split) with the path of each
+        chunk's file
+        @raise IOError: if chunks could not be downloaded; the other chunks
+        are kept, so the download can be resumed
+        """
+        chunks = self.split(bbox, width, height)
+        pending = Queue.Queue()
+        for chunk in chunks:
+            chunk.path = self.get_path(identifier, chunk, kwargs)
+            if not os.path.exists(chunk.path):
+                pending.put(chunk)
+        state = {'done': len(chunks) - pending.qsize(), 'failed': []}
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                try:
+                    chunk = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                error = self._fetch_retrying(identifier, chunk, kwargs)
+                lock.acquire()
+                try:
+                    if error is None:
+                        state['done'] += 1
+                    else:
+                        state['failed'].append((chunk, error))
+                    done = state['done']
+                finally:
+                    lock.release()
+                if progress is not None and error is None:
+                    progress(done, len(chunks))
+
+        threads = []
+        for i in range(min(self.workers, pending.qsize())):
+            thread = threading.Thread(target=work)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if state['failed']:
+            chunk, error = state['failed'][0]
+            raise IOError, '%d of %d chunks failed, e.g. %s: %s' % \
+                  (len(state['failed']), len(chunks), chunk, error)
+        return chunks
+
+    def get_path(self, identifier, chunk, kwargs):
+        """Return the file of a chunk. The name contains a digest of the
+        chunk's request, so chunks of other requests are never re-used."""
+        key = repr((self.wcs.url, self.wcs.version, identifier, chunk.bbox,
+                    chunk.width, chunk.height, sorted(kwargs.items())))
+        return os.path.join(self.directory, 'chunk_%d_%d_%s' % \
+                            (chunk.row, chunk.col, md5(key).hexdigest()[:12]))
+
+    def _fetch_retrying(self, identifier, chunk, kwargs):
+        """Download a chunk, retrying on I/O errors. Returns the last
+        error or None on success."""
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                self._fetch(identifier, chunk, kwargs)
+                return None
+            except IOError, e:
+                error = e
+                time.sleep(0.5 * attempt)
+            except Exception, e: # e.g. a service exception, don't retry
+                return e
+        return error
+
+    def _fetch(self, identifier, chunk, kwargs):
+        """Request a chunk and stream the response to its file (written
+        as .part first and renamed when complete)."""
+        args = dict(kwargs)
+        if chunk.width and chunk.height:
+            args['width'] = chunk.width
+            args['height'] = chunk.height
+        u = self.wcs.getCoverage(identifier=identifier, bbox=chunk.bbox,
+                                 **args)
+        part = chunk.path + '.part'
+        try:
+            out = open(part, 'wb')
+            try:
+                while True:
+                    block = u.read(self.blocksize)
+                    if not block:
+                        break
+                    out.write(block)
+            finally:
+                out.close()
+                u.close()
+        except:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        os.rename(part, chunk.path)
+
+
+if __name__ == '__main__':
+
+    import cgi
+    import random
+    import SocketServer
+    import BaseHTTPServer
+
+    CAPABILITIES = '''<?xml version="1.0" encoding="UTF-8"?>
+<WCS_Capabilities xmlns="http://www.opengis.net/wcs" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:gml="http://www.opengis.net/gml" version="1.0.0">
+<Service><name>stand-in</name><label>Stand-in WCS</label><fees>NONE</fees><accessConstraints>NONE</accessConstraints></Service>
+<Capability><Request>
+<GetCapabilities><DCPType><HTTP><Get><OnlineResource xlink:href="%(url)s"/></Get></HTTP></DCPType></GetCapabilities>
+<GetCoverage><DCPType><HTTP><Get><OnlineResource xlink:href="%(url)s"/></Get></HTTP></DCPType></GetCoverage>
+</Request></Capability>
+<ContentMetadata><CoverageOfferingBrief><name>gradient</name><label>Gradient</label>
+<lonLatEnvelope srsName="urn:ogc:def:crs:OGC:1.3:CRS84"><gml:pos>-180 -90</gml:pos><gml:pos>180 90</gml:pos></lonLatEnvelope>
+</CoverageOfferingBrief></ContentMetadata>
+</WCS_Capabilities>'''
+
+    def grey(lon, lat):
+        """Synthetic grey value of a pixel centre (rounded, so that it does
+        not depend on how the pixel's coordinates were computed)."""
+        return int(round((lon + 180.0) * 7 + (lat + 90.0) * 13, 6)) % 256
+
+    class _WCSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """Serves GetCapabilities and GetCoverage (PGM) requests."""
+
+        def do_GET(self):
+            params = {}
+            if '?' in self.path:
+                params = dict([(k.lower(), v) for k, v \
+                               in cgi.parse_qsl(self.path.split('?', 1)[1])])
+            if params.get('request') == 'GetCoverage':
+                if random.random() < FAILURE_RATE:
+                    self.send_error(503)
+                    return
+                minx, miny, maxx, maxy = [float(v) for v \
+                                          in params['bbox'].split(',')]
+                width = int(params['width'])
+                height = int(params['height'])
+                resx = (maxx - minx) / width
+                resy = (maxy - miny) / height
+                rows = [''.join([chr(grey(minx + (i + 0.5) * resx,
+                                          maxy - (j + 0.5) * resy)) \
+                                 for i in range(width)]) \
+                        for j in range(height)]
+                data = 'P5\n%d %d\n255\n' % (width, height) + ''.join(rows)
+                content_type = 'image/x-portable-graymap'
+            else:
+                data = CAPABILITIES % {'url': 'http://localhost:%d/?' % PORT}
+                content_type = 'application/vnd.ogc.wcs_xml'
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    PORT = 8081
+    FAILURE_RATE = 0.0
+    if len(sys.argv) > 1:
+        PORT = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        FAILURE_RATE = float(sys.argv[2])
+    class _WCSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = _WCSServer(('localhost', PORT), _WCSHandler)
+    print 'Serving WCS 1.0.0 on http://localhost:%d/' % PORT
+    server.serve_forever()
@@ -15,6 +15,7 @@ from etree import etree
 
 WFS_NAMESPACE = 'http://www.opengis.net/wfs'
 OGC_NAMESPACE = 'http://www.opengis.net/ogc'
+GML_NAMESPACE = 'http://www.opengis.net/gml'
 
 def nspath(path, ns=WFS_NAMESPACE):
     """
@@ -54,18 +55,54 @@ class WebFeatureService(object):
             raise KeyError, "No content named %s" % name
     
     
-    def __init__(self, url, version='1.0.0', xml=None):
-        """Initialize."""
+    def __init__(self, url, version='1.0.0', xml=None, cache=None):
+        """Initialize.
+
+        A cache (e.g. a CapabilitiesCache of the Geo activity) keeps the
+        parsed metadata per capabilities URL; it must provide
+        cache.get(url, parse), returning the (cached) result of parse(xml).
+        """
         self.url = url
         self.version = version
         self._capabilities = None
         reader = WFSCapabilitiesReader(self.version)
         if xml:
             self._capabilities = reader.readString(xml)
+        elif cache is not None:
+            #restore metadata from cache (parsed on a cache miss)
+            metadata = cache.get(reader.capabilities_url(self.url),
+                                 self._parseMetadata)
+            self.__dict__.update(metadata)
+            return
         else:
-            self._capabilities = reader.read(self.url)
+            #build feature type metadata while the document streams in
+            self._readMetadata(urlopen(reader.capabilities_url(self.url)))
+            return
         self._buildMetadata()
     
+    def _parseMetadata(self, xml):
+        ''' parse capabilities xml and return the (picklable) metadata
+        objects, e.g. to be cached '''
+        self._readMetadata(StringIO(xml))
+        return dict([(name, getattr(self, name)) for name in \
+                ('identification', 'provider', 'operations', 'contents',
+                 'exceptions')])
+
+    def _readMetadata(self, source):
+        ''' set up capabilities metadata objects from a file-like object,
+        parsing incrementally: feature types are built (and their elements
+        freed) as they stream in '''
+        reader = WFSCapabilitiesReader(self.version)
+        contents = {}
+        for cm in reader.iterfeaturetypes(source):
+            contents[cm.id] = cm
+        #the remaining infoset holds service, operations and exceptions
+        self._capabilities = reader._infoset
+        self._buildMetadata()
+        self.contents = contents
+        #the capabilities property re-reads the full document on demand
+        self._capabilities = None
+
     def _buildMetadata(self):
         '''set up capabilities metadata objects: '''
         
@@ -139,30 +176,10 @@ class WebFeatureService(object):
         2) typename and filter (more expressive)
         3) featureid (direct access to known features)
         """
-        base_url = self.getOperationByName('{http://www.opengis.net/wfs}GetFeature').methods[method]['url']
-        request = {'service': 'WFS', 'version': self.version, 'request': 'GetFeature'}
-        
-        # check featureid
-        if featureid:
-            request['featureid'] = ','.join(featureid)
-        elif bbox and typename:
-            request['bbox'] = ','.join([str(x) for x in bbox])
-        elif filter and typename:
-            request['filter'] = str(filter)
-        assert len(typename) > 0
-        request['typename'] = ','.join(typename)
-        
-        request['propertyname'] = ','.join(propertyname)
-        if featureversion: request['featureversion'] = str(featureversion)
-        if maxfeatures: request['maxfeatures'] = str(maxfeatures)
+        u = self._openfeature(typename, filter, bbox, featureid,
+                              featureversion, propertyname, maxfeatures,
+                              method)
 
-        data = urlencode(request)
-
-        if method == 'Post':
-            u = urlopen(base_url, data=data)
-        else:
-            u = urlopen(base_url + data)
-        
         # check for service exceptions, rewrap, and return
         # We're going to assume that anything with a content-length > 32k
         # is data. We'll check anything smaller.
@@ -188,6 +205,114 @@ class WebFeatureService(object):
                 return StringIO(data)
             return u
 
+    def _openfeature(self, typename=None, filter=None, bbox=None,
+                     featureid=None, featureversion=None, propertyname=['*'],
+                     maxfeatures=None,
+                     method='{http://www.opengis.net/wfs}Get'):
+        """Send a GetFeature request (see getfeature) and return the
+        response as it arrives, without checking it for exceptions."""
+        base_url = self.getOperationByName('{http://www.opengis.net/wfs}GetFeature').methods[method]['url']
+        request = {'service': 'WFS', 'version': self.version, 'request': 'GetFeature'}
+        
+        # check featureid
+        if featureid:
+            request['featureid'] = ','.join(featureid)
+        elif bbox and typename:
+            request['bbox'] = ','.join([str(x) for x in bbox])
+        elif filter and typename:
+            request['filter'] = str(filter)
+        assert len(typename) > 0
+        request['typename'] = ','.join(typename)
+        
+        request['propertyname'] = ','.join(propertyname)
+        if featureversion: request['featureversion'] = str(featureversion)
+        if maxfeatures: request['maxfeatures'] = str(maxfeatures)
+
+        data = urlencode(request)
+
+        if method == 'Post':
+            return urlopen(base_url, data=data)
+        return urlopen(base_url + data)
+
+    def iterfeatures(self, typename, bbox=None, propertyname=['*'],
+                     maxfeatures=None, pagesize=None, chunks=1, maxdepth=6,
+                     method='{http://www.opengis.net/wfs}Get'):
+        """Request features and yield them one at a time, as Feature
+        objects, while the GML response is parsed.
+
+        Parameters
+        ----------
+        typename : list
+            List of typenames (string)
+        bbox : tuple
+            (left, bottom, right, top) in the feature type's coordinates.
+            Required for paging.
+        propertyname : list
+            List of feature property names. '*' matches all.
+        maxfeatures : int
+            Maximum number of features to be yielded in total.
+        pagesize : int
+            Maximum number of features per request. A bbox chunk whose
+            request returns pagesize features may be truncated, so it is
+            split into quarters which are requested in turn. Features are
+            yielded once only (by id), though they may be part of several
+            chunks.
+        chunks : int
+            Number of chunks along each axis the bbox is split into for
+            the first requests.
+        maxdepth : int
+            Number of times a chunk is split at most. Features of chunks
+            at that depth may be missing.
+        method : string
+            Qualified name of the HTTP DCP method to use.
+
+        Without bbox or pagesize the features are requested at once.
+
+        Each response is parsed while it arrives (a ServiceExceptionReport
+        is raised as ServiceException), it is never read into memory as a
+        whole.
+        """
+        if not bbox or not pagesize:
+            u = self._openfeature(typename=typename, bbox=bbox,
+                                  propertyname=propertyname,
+                                  maxfeatures=maxfeatures, method=method)
+            for feature in iterfeatures(u):
+                yield feature
+            return
+
+        left, bottom, right, top = [float(x) for x in bbox]
+        width = (right - left) / chunks
+        height = (top - bottom) / chunks
+        queue = [(left + i * width, bottom + j * height,
+                  left + (i + 1) * width, bottom + (j + 1) * height, 0) \
+                 for j in range(chunks) for i in range(chunks)]
+        seen = {}
+        count = 0
+        while queue:
+            x0, y0, x1, y1, depth = queue.pop(0)
+            u = self._openfeature(typename=typename, bbox=(x0, y0, x1, y1),
+                                  propertyname=propertyname,
+                                  maxfeatures=pagesize, method=method)
+            returned = 0
+            for feature in iterfeatures(u):
+                returned += 1
+                if feature.id is not None:
+                    if feature.id in seen:
+                        continue
+                    seen[feature.id] = True
+                yield feature
+                count += 1
+                if maxfeatures and count >= maxfeatures:
+                    return
+            if returned >= pagesize and depth < maxdepth:
+                # chunk may be truncated, request its quarters
+                xm = (x0 + x1) / 2.0
+                ym = (y0 + y1) / 2.0
+                queue.extend([(x0, y0, xm, ym, depth + 1),
+                              (xm, y0, x1, ym, depth + 1),
+                              (x0, ym, xm, y1, depth + 1),
+                              (xm, ym, x1, y1, depth + 1)])
+
     def getOperationByName(self, name):
         """Return a named content item."""
         for item in self.operations:
@@ -386,4 +511,182 @@ class WFSCapabilitiesReader(object):
         if not isinstance(st, str):
             raise ValueError("String must be of type string, not %s" % type(st))
         return etree.fromstring(st)
-    
+
+    def iterfeaturetypes(self, source):
+        """Parse a WFS capabilities document incrementally, yielding the
+        ContentMetadata of each feature type as soon as it is complete
+
+        source is a file name or file-like object. Feature types are
+        detached from the tree and freed once built. When the document is
+        consumed, the reader's infoset holds the remaining document
+        (service, requests, feature type list operations) without feature
+        types.
+        """
+        featuretype = nspath('FeatureType')
+        elems = [] # open elements
+        for event, elem in etree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                elems.append(elem)
+                continue
+            elems.pop()
+            if elem.tag == featuretype and elems:
+                #the feature type list's operations precede its feature types
+                featuretypelist = elems[-1]
+                cm = ContentMetadata(elem, featuretypelist)
+                featuretypelist.remove(elem)
+                elem.clear()
+                yield cm
+        self._infoset = elem
+
+
+class Feature(object):
+    """A feature of a GML feature collection.
+
+    Properties and geometry are decoded from the GML element on first
+    access; the element is released then.
+    """
+
+    def __init__(self, elem):
+        """."""
+        self.typename = elem.tag
+        self.id = elem.get('fid') or elem.get(nspath('id', GML_NAMESPACE))
+        self._elem = elem
+        self._properties = None
+        self._geometry = None
+
+    def _decode(self):
+        """Decode properties and geometry (the first geometric property)."""
+        properties = {}
+        geometry = None
+        for child in self._elem:
+            if child.tag == nspath('boundedBy', GML_NAMESPACE):
+                continue
+            name = localname(child.tag)
+            if len(child) and child[0].tag.startswith('{%s}' % GML_NAMESPACE):
+                if geometry is None:
+                    geometry = decodeGeometry(child[0])
+                    continue
+            properties[name] = child.text
+        self._properties = properties
+        self._geometry = geometry
+        self._elem = None
+
+    def _getproperties(self):
+        if self._elem is not None:
+            self._decode()
+        return self._properties
+    properties = property(_getproperties, None)
+
+    def _getgeometry(self):
+        if self._elem is not None:
+            self._decode()
+        return self._geometry
+    geometry = property(_getgeometry, None)
+
+    def _getgeointerface(self):
+        return {'type': 'Feature', 'id': self.id,
+                'geometry': self.geometry, 'properties': self.properties}
+    __geo_interface__ = property(_getgeointerface, None)
+
+
+def iterfeatures(source):
+    """Parse a GML feature collection (e.g. a GetFeature response)
+    incrementally, yielding a Feature for each feature member as soon as
+    it is complete. Processed members are removed from the tree, so the
+    collection is never held in memory as a whole.
+
+    Parameters
+    ----------
+    source : file name or file-like object
+        The feature collection. A file-like object is closed afterwards.
+    """
+    members = (nspath('featureMember', GML_NAMESPACE),
+               nspath('featureMembers', GML_NAMESPACE))
+    elems = [] # open elements
+    try:
+        for event, elem in etree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                elems.append(elem)
+                continue
+            elems.pop()
+            if len(elems) > 1 and elems[-1].tag in members:
+                yield Feature(elem)
+                elems[-1].remove(elem)
+            elif elem.tag in members and elems:
+                elems[-1].remove(elem)
+        if elem.tag == nspath('ServiceExceptionReport', OGC_NAMESPACE):
+            se = elem.find(nspath('ServiceException', OGC_NAMESPACE))
+            raise ServiceException, str(se.text).strip()
+    finally:
+        if hasattr(source, 'close'):
+            source.close()
+
+def localname(tag):
+    """Return the tag without namespace."""
+    return tag[tag.find('}') + 1:]
+
+def decodeGeometry(elem):
+    """Decode a GML (2 or 3) geometry into a dict like GeoJSON's, e.g.
+    {'type': 'Point', 'coordinates': (x, y)}. Returns None for geometries
+    not supported.
+    """
+    gml = lambda path: nspath(path, GML_NAMESPACE)
+    kind = localname(elem.tag)
+    if kind == 'Point':
+        return {'type': 'Point', 'coordinates': _decodeCoordinates(elem)[0]}
+    if kind in ('LineString', 'LinearRing'):
+        return {'type': 'LineString',
+                'coordinates': _decodeCoordinates(elem)}
+    if kind == 'Polygon':
+        rings = elem.findall(gml('outerBoundaryIs/LinearRing')) + \
+                elem.findall(gml('exterior/LinearRing')) + \
+                elem.findall(gml('innerBoundaryIs/LinearRing')) + \
+                elem.findall(gml('interior/LinearRing'))
+        return {'type': 'Polygon',
+                'coordinates': [_decodeCoordinates(r) for r in rings]}
+    multi = {'MultiPoint': 'Point', 'MultiLineString': 'LineString',
+             'MultiCurve': 'LineString', 'MultiPolygon': 'Polygon',
+             'MultiSurface': 'Polygon'}
+    if kind in multi:
+        parts = []
+        for member in elem:
+            for part in member:
+                geometry = decodeGeometry(part)
+                if geometry is not None:
+                    parts.append(geometry['coordinates'])
+        return {'type': 'Multi' + multi[kind], 'coordinates': parts}
+    return None
+
+def _decodeCoordinates(elem):
+    """Return the list of coordinate tuples of a GML geometry element."""
+    gml = lambda path: nspath(path, GML_NAMESPACE)
+    coordinates = elem.find(gml('coordinates'))
+    if coordinates is not None:
+        cs = coordinates.get('cs', ',')
+        ts = coordinates.get('ts', ' ')
+        decimal = coordinates.get('decimal', '.')
+        points = []
+        for tuple_ in coordinates.text.strip().split(ts):
+            if not tuple_:
+                continue
+            if decimal != '.':
+                tuple_ = tuple_.replace(decimal, '.')
+            points.append(tuple([float(x) for x in tuple_.split(cs)]))
+        return points
+    coords = elem.findall(gml('coord'))
+    if coords:
+        points = []
+        for coord in coords:
+            values = [coord.find(gml(axis)) for axis in ('X', 'Y', 'Z')]
+            points.append(tuple([float(v.text) for v in values \
+                                 if v is not None]))
+        return points
+    poslist = elem.find(gml('posList'))
+    if poslist is not None:
+        dimension = int(poslist.get('srsDimension') or \
+                        poslist.get('dimension') or 2)
+        values = [float(x) for x in poslist.text.split()]
+        return [tuple(values[i:i + dimension]) \
+                for i in range(0, len(values), dimension)]
+    return [tuple([float(x) for x in pos.text.split()]) \
+            for pos in elem.findall(gml('pos'))]
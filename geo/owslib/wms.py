@@ -16,6 +16,7 @@ Currently supports only version 1.1.1 of the WMS protocol.
 """
 
 import cgi
+from cStringIO import StringIO
 from urllib import urlencode
 from urllib2 import urlopen
 from urllib2 import HTTPPasswordMgrWithDefaultRealm
@@ -49,9 +50,14 @@ class WebMapService(object):
 
     
     def __init__(self, url, version='1.1.1', xml=None, 
-                username=None, password=None
+                username=None, password=None, cache=None
                 ):
-        """Initialize."""
+        """Initialize.
+
+        A cache (e.g. a CapabilitiesCache of the Geo activity) keeps the
+        parsed metadata per capabilities URL; it must provide
+        cache.get(url, parse), returning the (cached) result of parse(xml).
+        """
         self.url = url
         self.username = username
         self.password = password
@@ -77,9 +83,17 @@ class WebMapService(object):
             if xml:
                 #read from stored xml
                 self._capabilities = reader.readString(xml)
+            elif cache is not None:
+                #restore metadata from cache (parsed on a cache miss)
+                metadata = cache.get(reader.capabilities_url(self.url),
+                                     self._parseMetadata)
+                self.__dict__.update(metadata)
+                return
             else:
-                #read from non-password protected server
-                self._capabilities = reader.read(self.url)
+                #read from non-password protected server, building layer
+                #metadata while the document streams in
+                self._readMetadata(reader.open(self.url))
+                return
                 
        
         #build metadata objects
@@ -90,10 +104,36 @@ class WebMapService(object):
             reader = WMSCapabilitiesReader(
                 self.version, url=self.url, un=self.username, pw=self.password
                 )
-            self._capabilities = ServiceMetadata(reader.read(self.url))
+            self._capabilities = reader.read(self.url)
         return self._capabilities
     capabilities = property(_getcapproperty, None)
 
+    def _parseMetadata(self, xml):
+        ''' parse capabilities xml and return the (picklable) metadata
+        objects, e.g. to be cached '''
+        self._readMetadata(StringIO(xml))
+        return dict([(name, getattr(self, name)) for name in \
+                ('identification', 'provider', 'operations', 'contents',
+                 'exceptions')])
+
+    def _readMetadata(self, source):
+        ''' set up capabilities metadata objects from a file-like object,
+        parsing incrementally: layers are built (and their elements freed)
+        as they stream in, so the whole document is never held as a tree '''
+        reader = WMSCapabilitiesReader(self.version)
+        contents = {}
+        for cm in reader.iterlayers(source):
+            #same assumption as _buildMetadata: top-level layers and their
+            #direct sublayers
+            if cm.parent is None or cm.parent.parent is None:
+                contents[cm.id] = cm
+        #the remaining infoset holds service, operations and exceptions
+        self._capabilities = reader._infoset
+        self._buildMetadata()
+        self.contents = contents
+        #the capabilities property re-reads the full document on demand
+        self._capabilities = None
+
     def _buildMetadata(self):         
         ''' set up capabilities metadata objects '''
         
@@ -304,7 +344,9 @@ class ContentMetadata:
 
 	Implements IContentMetadata.
 	"""
-	def __init__(self, elem, parent=None):
+	def __init__(self, elem, parent=None, sublayers=True):
+		"""sublayers: build the metadata of sublayers, too (if False,
+		self.layers is left empty to be filled by the caller)"""
 		self.parent = parent
 		if elem.tag != 'Layer':
 			raise ValueError('%s should be a Layer' % (elem,))
@@ -388,8 +430,9 @@ class ContentMetadata:
                         break
                 
 		self.layers = []
-		for child in elem.findall('Layer'):
-			self.layers.append(ContentMetadata(child, self))
+		if sublayers:
+			for child in elem.findall('Layer'):
+				self.layers.append(ContentMetadata(child, self))
 
 	def __str__(self):
 		return 'Layer Name: %s Title: %s' % (self.name, self.title)
@@ -508,6 +551,12 @@ class WMSCapabilitiesReader:
         u = self._open(request)
         return etree.fromstring(u.read())
 
+    def open(self, service_url):
+        """Request a WMS capabilities document, returning it as a
+        file-like object (e.g. to be parsed by iterlayers)
+        """
+        return self._open(self.capabilities_url(service_url))
+
     def readString(self, st):
         """Parse a WMS capabilities document, returning an elementtree instance
 
@@ -517,6 +566,48 @@ class WMSCapabilitiesReader:
             raise ValueError("String must be of type string, not %s" % type(st))
         return etree.fromstring(st)
 
+    def iterlayers(self, source):
+        """Parse a WMS capabilities document incrementally, yielding the
+        ContentMetadata of each layer as soon as the layer is complete
+        (sublayers before their parent layer)
+
+        source is a file name or file-like object. Each layer is built from
+        its own elements only: the metadata of a parent layer is built when
+        its first sublayer starts (sublayers are the last elements of a
+        Layer), layers are detached from the tree and freed once complete.
+        When the document is consumed, the reader's infoset holds the
+        remaining document (service, requests, exceptions) without layers.
+        """
+        elems = [] # open elements
+        layers = [] # open layers, as [elem, ContentMetadata or None]
+        for event, elem in etree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == 'Layer':
+                    if layers and layers[-1][1] is None:
+                        self._buildLayer(layers)
+                    layers.append([elem, None])
+                elems.append(elem)
+                continue
+            elems.pop()
+            if elem.tag == 'Layer':
+                if layers[-1][1] is None:
+                    self._buildLayer(layers)
+                elem, cm = layers.pop()
+                if layers:
+                    layers[-1][1].layers.append(cm)
+                elems[-1].remove(elem)
+                elem.clear()
+                yield cm
+        self._infoset = elem
+
+    def _buildLayer(self, layers):
+        """Build the metadata of the innermost open layer"""
+        parent = None
+        if len(layers) > 1:
+            parent = layers[-2][1]
+        #sublayers are built on their own, they may be (partly) parsed yet
+        layers[-1][1] = ContentMetadata(layers[-1][0], parent, False)
+
 
 class WMSError(Exception):
     """Base class for WMS module errors
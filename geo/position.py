@@ -32,30 +32,67 @@
 __version__ = '$id $'
 
 import os
-import gps
+import sys
+import math
 import time
+import random
+import socket
+import gobject
 import logging
+import calendar
+import simplejson
 
 import constants
 from subprocess import Popen, PIPE
 
 _LOG = logging.getLogger('position-logger')
 
+_KNOTS = 0.514444 # m/s
+_METERS_PER_DEGREE = 111320.0 # along a meridian
+_NMEA_UERE = 5.0 # meters of error per unit of dilution of precision
+
 ###############################################################################
 class GPSReceiver():
-    """Receives GPS signal from gpsd Daemon.
+    """Receives GPS signal from gpsd Daemon (or another position source).
+
+    Which source is used is configured by constants.GPS_SOURCE, see
+    L{create_source}.
 
     TODO check dbus alternative.
     """
 
     GPS_SESSION = None
 
-    def __init__(self, gps_infos):
-        """Creates GPS_SESSION."""
+    def __init__(self, gps_infos, source=constants.GPS_SOURCE):
+        """Creates GPS_SESSION (a L{PositionSource}), for gpsd starts gpsd
+        first. If constants.GPS_FILTER is set, the fixes are smoothed (see
+        L{FilteredSource})."""
         _LOG.debug('Create GPSReceiver.')
         self.result = gps_infos
 
+        raw_infos = gps_infos
+        if constants.GPS_FILTER:
+            raw_infos = {} # gps_infos gets the smoothed fixes
+        if source.strip() == 'gpsd':
+            self.GPS_SESSION = self._start_gpsd(raw_infos)
+        else:
+            try:
+                self.GPS_SESSION = create_source(raw_infos, source)
+            except Exception, e:
+                self.GPS_SESSION = None
+                _LOG.warning("Could not create position source '%s': %s",
+                             source, e)
+        if self.GPS_SESSION is not None and constants.GPS_FILTER:
+            self.GPS_SESSION = FilteredSource(self.GPS_SESSION, gps_infos)
+
+    def _start_gpsd(self, gps_infos):
+        """Starts gpsd on the configured device and connects to it.
+
+        @param gps_infos: The dictionary to update with each fix.
+        @return: The L{GPSStream} or None if gpsd is not available.
+        """
         file_ = None
+        p = None
         try:
             file_ = open(os.path.join(constants.CONFIG_PATH, 'gpsdevice'))
             devices_ = [dev.strip() for dev in file_.readlines() if not dev.startswith('#')]
@@ -72,76 +109,834 @@ class GPSReceiver():
             cmd = out[1] + " " + devices_[0]
             _LOG.debug(cmd)
             p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-            self.GPS_SESSION = gps.gps()
-            time.sleep(0.5)
+            time.sleep(0.5) # let gpsd start listening
+            return GPSStream(gps_infos)
         except Exception, e:
-            self.GPS_SESSION = None
             _LOG.warning('Could not initialize GPS session in postion.py: %s', e)
             if p is not None:
                 _LOG.error(p.communicate())
+            return None
         finally:
             if file_ is not None:
                 file_.close()
 
-    def get_position(self, query='admosy'):
-        """Gathers the current position information.
-
-        Function to retrieve GPS position information from a GPS
-        session running in background. A gpsd daemon has to be running
-        in background.
-
-        The gathered information can be retrieved fine-grained by passing a
-        query string containing special parameter chars (see `man gpsd' for
-        detailed information. However, This function queries the following:
-        ===============
-            a = altitude
-            d = date/time
-            m = NMEA mode
-            o = position report
-            s = NMEA status
-            y = satellites
-        ===============
-
-        The returned value is a dictionary containing the most recent
-        information of the current GPS session, dependent of the query
-        parameter passed to the function.
-
-        The keys to retrieve the information are:
+    def watch(self, callback):
+        """Calls callback(gps_infos) for each new fix (from within the
+        gobject main loop).
+
+        The dictionary passed holds the most recent GPS information, see
+        L{get_position} for its keys.
+        """
+        self.GPS_SESSION.watch(callback)
+
+    def watch_others(self, callback):
+        """Calls callback(name, gps_infos) for each new fix of further
+        receivers, if the source simulates several (see
+        L{WalkerSimulator})."""
+        self.GPS_SESSION.watch_others(callback)
+
+    def get_position(self):
+        """Returns the current position information.
+
+        The information is streamed from gpsd as it arrives (see L{watch}),
+        so this does not query gpsd. The keys to retrieve the information
+        are:
         ======= ==================================
-          latitude       the coordinates latitude (requires 'o')
-          longitude    the coordinates longitude (requires 'o')
-          utc             UTC time in the ISO-8601 format (requires 'd')
-          altitude       Meters above mean sea level (requires 'a')
-          eph            Horizontal error estimate (requires 'o')
-          epv            Vertical error estimate (requires 'o')
-          speed         Knots speed over ground (requires 'o')
-          climb          Vertical velocity [m/s] (requires 'o')
-          status         0=no fix, 1=fix, 2=DGPS-corrected fis (requires 's')
-          satellites     satellites gathered the information (requires 'y')
+          latitude       the coordinates latitude
+          longitude    the coordinates longitude
+          utc             UTC time of the fix
+          altitude       Meters above mean sea level
+          eph            Horizontal error estimate
+          epv            Vertical error estimate
+          speed         Speed over ground [m/s]
+          climb          Vertical velocity [m/s]
+          satellites     satellites used for the fix
         ======= ==================================
 
-        @param query: The query string which information is of interest.
-        @return: A dictionary with the current GPS information. If no current
-                session is available an empty dictionary will be returned.
+        @return: A dictionary with the current GPS information.
         @raise StopIteration: If no GPS connection is available.
         """
-        try:
-            self.GPS_SESSION.query(query)
-        except:
+        if self.GPS_SESSION is None:
             _LOG.error("No GPS connection possible. ")
             raise StopIteration, "No GPS connection possible. "
-        if self.GPS_SESSION:
-            self.result['latitude'] = self.GPS_SESSION.fix.latitude
-            self.result['longitude'] = self.GPS_SESSION.fix.longitude
-            self.result['utc'] = self.GPS_SESSION.fix.time
-            self.result['altitude'] = self.GPS_SESSION.fix.altitude
-            self.result['eph'] = self.GPS_SESSION.fix.eph
-            self.result['epv'] = self.GPS_SESSION.fix.epv
-            self.result['speed'] = self.GPS_SESSION.fix.speed
-            self.result['climb'] = self.GPS_SESSION.fix.climb
-            self.result['satellites'] = self.GPS_SESSION.satellites
-
-            #_LOG.debug(self.result)
+        return self.result
+
+###############################################################################
+
+class PositionSource():
+    """A source of GPS fixes.
+
+    A source updates a dictionary of GPS information (see
+    L{GPSReceiver.get_position}) and calls the callback registered with
+    L{watch} for each new fix, from within the gobject main loop.
+
+    Sources reading the reports of receivers use L{parse}, which
+    understands gpsd JSON reports, the reports of old gpsd versions and
+    NMEA 0183 sentences. The NMEA sentences of one fix (RMC, GGA with the
+    same time) are merged and reported as one fix, once a sentence of the
+    next fix arrives or L{flush} is called.
+    """
+
+    def __init__(self, gps_infos):
+        """
+        @param gps_infos: The dictionary to update with each fix.
+        """
+        self.infos = gps_infos
+        self._callback = None
+        self._last_fix = None
+        self._date = None # UTC midnight of the last NMEA RMC sentence
+        self._epoch = None # [time, lat, lon, alt, eph, speed] of NMEA
+
+    def watch(self, callback):
+        """Calls callback(gps_infos) for each new fix."""
+        self._callback = callback
+
+    def watch_others(self, callback):
+        """Calls callback(name, gps_infos) for each new fix of further
+        receivers. Only simulating sources have such."""
+        pass
+
+    def close(self):
+        """Stops reporting fixes."""
+        pass
+
+    def parse(self, line):
+        """Parses a report and updates the GPS information. The callback is
+        called, if the report holds a new fix.
+
+        @param line: A JSON object, a 'GPSD,...' response or an NMEA
+        sentence.
+        """
+        if line.startswith('{'):
+            try:
+                report = simplejson.loads(line)
+            except ValueError:
+                _LOG.debug('Invalid report: %s', line)
+                return
+            if report.get('class') == 'VERSION':
+                self._greeted(report)
+            elif report.get('class') == 'TPV':
+                self._update_tpv(report)
+            elif report.get('class') == 'SKY':
+                used = [sat for sat in report.get('satellites', []) \
+                        if sat.get('used')]
+                self.infos['satellites'] = len(used)
+        elif line.startswith('GPSD,'):
+            for field in line[5:].split(','):
+                if field.startswith('O='):
+                    self._update_o(field[2:].split())
+                elif field.startswith('Y='):
+                    self._update_y(field[2:].split())
+        elif line.startswith('$'):
+            fields = _split_sentence(line)
+            if fields is None:
+                _LOG.debug('Invalid sentence: %s', line)
+            elif fields[0][2:] == 'RMC':
+                self._update_rmc(fields)
+            elif fields[0][2:] == 'GGA':
+                self._update_gga(fields)
+
+    def flush(self):
+        """Reports the NMEA fix merged so far, if any (e.g. at the end of
+        a log)."""
+        if self._epoch is not None:
+            time_, lat, lon, alt, eph, speed = self._epoch
+            self._epoch = None
+            self._update_fix(self._nmea_time(time_), lat, lon, alt, eph,
+                             None, speed, None)
+
+    def _greeted(self, report):
+        """Called for the VERSION greeting of gpsd."""
+        pass
+
+    def _update_tpv(self, report):
+        """Updates with a JSON TPV (time-position-velocity) report."""
+        if report.get('mode', 0) < 2 or 'lat' not in report or \
+                'lon' not in report:
+            return # no fix
+        eph = report.get('eph')
+        if eph is None and 'epx' in report and 'epy' in report:
+            eph = max(report['epx'], report['epy'])
+        self._update_fix(_parse_time(report.get('time')), report['lat'],
+                         report['lon'], report.get('alt'), eph,
+                         report.get('epv'), report.get('speed'),
+                         report.get('climb'))
+
+    def _update_o(self, values):
+        """Updates with an old 'O' report: tag, time, time error, lat, lon,
+        alt, eph, epv, track, speed, climb, ... ('?' if unknown)."""
+        if len(values) < 11 or values[3] == '?' or values[4] == '?':
+            return # no fix
+        numbers = []
+        for value in values[:11]:
+            try:
+                numbers.append(float(value))
+            except ValueError:
+                numbers.append(None)
+        self._update_fix(numbers[1], numbers[3], numbers[4], numbers[5],
+                         numbers[6], numbers[7], numbers[9], numbers[10])
+
+    def _update_y(self, values):
+        """Updates with an old 'Y' (satellites) report: tag, time, count."""
+        try:
+            self.infos['satellites'] = int(values[2].split(':')[0])
+        except (IndexError, ValueError):
+            pass
+
+    def _update_rmc(self, fields):
+        """Updates with an NMEA RMC (recommended minimum) sentence: time,
+        status, lat, N/S, lon, E/W, speed [knots], track, date, ..."""
+        if len(fields) < 10 or fields[2] != 'A':
+            return # no fix
+        lat = _parse_degrees(fields[3], fields[4])
+        lon = _parse_degrees(fields[5], fields[6])
+        if lat is None or lon is None:
+            return
+        speed = _parse_float(fields[7])
+        if speed is not None:
+            speed *= _KNOTS
+        self._merge_nmea(fields[1], lat, lon, None, None, speed)
+        try:
+            day = time.strptime(fields[9], '%d%m%y')
+            self._date = calendar.timegm(day)
+        except ValueError:
+            pass
+
+    def _update_gga(self, fields):
+        """Updates with an NMEA GGA (fix data) sentence: time, lat, N/S,
+        lon, E/W, quality, satellites, hdop, altitude, ..."""
+        if len(fields) < 10 or fields[6] in ('', '0'):
+            return # no fix
+        lat = _parse_degrees(fields[2], fields[3])
+        lon = _parse_degrees(fields[4], fields[5])
+        if lat is None or lon is None:
+            return
+        satellites = _parse_float(fields[7])
+        if satellites is not None:
+            self.infos['satellites'] = int(satellites)
+        eph = _parse_float(fields[8])
+        if eph is not None:
+            eph *= _NMEA_UERE
+        self._merge_nmea(fields[1], lat, lon, _parse_float(fields[9]), eph,
+                         None)
+
+    def _merge_nmea(self, time_, lat, lon, alt, eph, speed):
+        """Merges the values of an NMEA sentence into the fix of its time.
+        The fix merged before is reported, if the time differs."""
+        if self._epoch is not None and self._epoch[0] != time_:
+            self.flush() # on the date of its RMC, not of the next one
+        if self._epoch is None:
+            self._epoch = [time_, lat, lon, None, None, None]
+        for index, value in ((1, lat), (2, lon), (3, alt), (4, eph),
+                             (5, speed)):
+            if value is not None:
+                self._epoch[index] = value
+
+    def _nmea_time(self, value):
+        """Returns the UTC seconds of an NMEA time of day (hhmmss.ss) on
+        the date of the last RMC sentence (or on day 0)."""
+        try:
+            seconds = int(value[0:2]) * 3600 + int(value[2:4]) * 60 + \
+                      float(value[4:])
+        except ValueError:
+            return None
+        return (self._date or 0) + seconds
+
+    def _update_fix(self, utc, lat, lon, alt, eph, epv, speed, climb):
+        """Stores a fix and reports it, unless it was reported before."""
+        self.infos['latitude'] = lat
+        self.infos['longitude'] = lon
+        self.infos['utc'] = utc
+        for key, value in (('altitude', alt), ('eph', eph), ('epv', epv),
+                           ('speed', speed), ('climb', climb)):
+            if value is not None:
+                self.infos[key] = value
+        fix = (utc, lat, lon)
+        if fix == self._last_fix:
+            return
+        self._last_fix = fix
+        self._report()
+
+    def _report(self):
+        """Hands the new fix to the callback."""
+        if self._callback is not None:
+            self._callback(self.infos)
+
+###############################################################################
+
+class GPSStream(PositionSource):
+    """Streams the reports of gpsd in watcher mode.
+
+    The connection to gpsd is watched by the gobject main loop, so reports
+    are parsed as they arrive, without polling and without blocking the
+    user interface. A fix is reported as soon as gpsd sends it.
+
+    Both protocols of gpsd are understood: gpsd 2.90 and later greet with
+    a JSON VERSION object and are asked to stream JSON reports (?WATCH);
+    older versions are switched to watcher mode ('w+') and send 'GPSD,O='
+    position reports. If gpsd closes the connection, reconnecting is tried
+    every GPS_RECONNECT milliseconds.
+    """
+
+    _GREETING_TIMEOUT = 1000 # ms to wait for a JSON greeting
+
+    def __init__(self, gps_infos, host=constants.GPSD_HOST,
+                 port=constants.GPSD_PORT):
+        """Connects to gpsd.
+
+        @param gps_infos: The dictionary to update with each report.
+        @raise socket.error: If gpsd is not reachable.
+        """
+        PositionSource.__init__(self, gps_infos)
+        self.host = host
+        self.port = port
+        self._socket = None
+        self._watch_id = None
+        self._buffer = ''
+        self._json = False # gpsd speaks JSON
+        self._closed = False
+        self._connect()
+
+    def close(self):
+        """Closes the connection to gpsd (and stops reconnecting)."""
+        self._closed = True
+        self._disconnect()
+
+    def _disconnect(self):
+        if self._watch_id is not None:
+            gobject.source_remove(self._watch_id)
+            self._watch_id = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _connect(self):
+        """Opens the connection and watches it."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(2)
+        sock.connect((self.host, self.port))
+        sock.setblocking(0)
+        self._socket = sock
+        self._buffer = ''
+        self._json = False
+        self._watch_id = gobject.io_add_watch(sock,
+                gobject.IO_IN | gobject.IO_ERR | gobject.IO_HUP,
+                self._receive_cb)
+        gobject.timeout_add(self._GREETING_TIMEOUT, self._subscribe_cb, sock)
+        _LOG.debug('Connected to gpsd at %s:%s.', self.host, self.port)
+
+    def _subscribe_cb(self, sock):
+        """Switches an old gpsd (which did not greet) to watcher mode."""
+        if sock is self._socket and not self._json:
+            self._send('w+\n')
+        return False
+
+    def _reconnect_cb(self):
+        """Tries to connect again (until it succeeds or is closed)."""
+        if self._closed:
+            return False
+        try:
+            self._connect()
+        except socket.error:
+            return True
+        return False
+
+    def _send(self, command):
+        try:
+            self._socket.sendall(command)
+        except socket.error, e:
+            _LOG.error('Could not send to gpsd: %s', e)
+
+    def _receive_cb(self, sock, condition):
+        """Reads what has arrived and parses the complete lines."""
+        data = ''
+        if condition & gobject.IO_IN:
+            try:
+                data = sock.recv(4096)
+            except socket.error, e:
+                _LOG.error('Could not read from gpsd: %s', e)
+        if not data:
+            _LOG.warning('Connection to gpsd lost.')
+            self._watch_id = None
+            self._disconnect()
+            gobject.timeout_add(constants.GPS_RECONNECT, self._reconnect_cb)
+            return False
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            self.parse(line.strip())
+        return True
+
+    def _greeted(self, report):
+        """Asks a JSON speaking gpsd to stream its reports."""
+        self._json = True
+        self._send('?WATCH={"enable":true,"json":true};\n')
+
+###############################################################################
+
+class LogReplay(PositionSource):
+    """Replays a recorded log of a GPS receiver.
+
+    The log is either a gpsd JSON log (as written by 'gpspipe -w'), a log
+    of an old gpsd in watcher mode or an NMEA log (as written by 'gpspipe
+    -r' or read from the device). Fixes are reported in the pace they
+    were recorded, i.e. by the time between two fixes divided by speed.
+
+    The log is read lazily, one fix ahead, so even long logs are replayed
+    without loading them. Pauses of more than _MAX_PAUSE seconds (the
+    receiver was off, its clock was set) are skipped.
+
+    The times of the fixes keep increasing when the log starts again or an
+    NMEA time of day passes midnight, so traces stay in order of time.
+    """
+
+    _MAX_PAUSE = 60
+
+    def __init__(self, gps_infos, file_name, speed=1.0, loop=False):
+        """Starts replaying.
+
+        @param gps_infos: The dictionary to update with each fix.
+        @param file_name: The log to replay.
+        @param speed: The factor to accelerate the replay with (0 replays
+        as fast as possible).
+        @param loop: Whether to start again at the end of the log.
+        @raise IOError: If the log could not be opened.
+        """
+        PositionSource.__init__(self, {})
+        self.target = gps_infos
+        self.file_name = file_name
+        self.speed = speed
+        self.loop = loop
+        self._file = open(file_name, 'r')
+        self._last_utc = None
+        self._offset = 0 # seconds added to the times of the log
+        self._end_utc = None # (shifted) time of the fix reported last
+        self._pending = False
+        self._replayed = False # any fix since the start of the log
+        self._timer_id = gobject.timeout_add(0, self._next_cb)
+
+    def close(self):
+        """Stops replaying."""
+        if self._timer_id is not None:
+            gobject.source_remove(self._timer_id)
+            self._timer_id = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _report(self):
+        """Holds the fix back until its time has come."""
+        self._pending = True
+
+    def _next_cb(self):
+        """Reports the pending fix and schedules the next one."""
+        if self._pending:
+            self._pending = False
+            self._end_utc = self.infos['utc']
+            self.target.update(self.infos)
+            if self._callback is not None:
+                self._callback(self.target)
+
+        while not self._pending:
+            line = self._file.readline()
+            if not line:
+                self.flush()
+                if self._pending:
+                    break
+                if not self.loop or not self._replayed:
+                    _LOG.debug('Replay of %s finished.', self.file_name)
+                    self.close()
+                    return False
+                self._file.seek(0)
+                self._last_fix = None
+                self._last_utc = None # the log's clock starts again
+                self._replayed = False
+                continue
+            self.parse(line.strip())
+        self._replayed = True
+
+        utc = self.infos['utc']
+        delay = 0
+        if utc is not None and self._last_utc is None and \
+                self._end_utc is not None:
+            self._offset = self._end_utc + 1 - utc # log starts again
+        if self._last_utc is not None and utc is not None:
+            delay = utc - self._last_utc
+            if delay < -43200:
+                delay += 86400 # NMEA time of day passed midnight
+                self._offset += 86400
+            if delay < 0 or delay > self._MAX_PAUSE or self.speed <= 0:
+                delay = 0
+            else:
+                delay = int(delay * 1000 / self.speed)
+        self._last_utc = utc
+        if utc is not None:
+            self.infos['utc'] = utc + self._offset
+        self._timer_id = gobject.timeout_add(delay, self._next_cb)
+        return False
+
+###############################################################################
+
+class WalkerSimulator(PositionSource):
+    """Simulates a group of players walking around with GPS receivers.
+
+    Each walker walks at a given speed and changes its direction randomly,
+    within a radius around a center. Its reported positions are disturbed
+    by normally distributed errors. The first walker updates the GPS
+    information of this source (i.e. it plays the own player), the fixes
+    of the others are reported to the callback of L{watch_others}.
+    """
+
+    def __init__(self, gps_infos, walkers=30, speed=1.4, noise=5.0,
+                 center=(7.6261, 51.9625), radius=500.0, interval=1000,
+                 seed=None):
+        """Starts walking.
+
+        @param gps_infos: The dictionary to update with the first walker's
+        fixes.
+        @param walkers: The number of walkers.
+        @param speed: The walking speed in m/s.
+        @param noise: The standard deviation of the position error in m.
+        @param center: Tuple (lon, lat) the walkers start at.
+        @param radius: The distance from the center in m the walkers stay
+        within.
+        @param interval: Milliseconds between two fixes of a walker.
+        @param seed: The seed of the random numbers (to repeat a walk).
+        """
+        PositionSource.__init__(self, gps_infos)
+        self.speed = speed
+        self.noise = noise
+        self.center = center
+        self.radius = radius
+        self.interval = interval
+        self._random = random.Random(seed)
+        self._others = None
+        self._walkers = []
+        for i in range(walkers):
+            self._walkers.append(['walker-%02d' % i, 0.0, 0.0, # name, x, y
+                                  self._random.uniform(0, 2 * math.pi), {}])
+        self._timer_id = gobject.timeout_add(interval, self._step_cb)
+
+    def watch_others(self, callback):
+        """Calls callback(name, gps_infos) for each new fix of a walker
+        other than the first."""
+        self._others = callback
+
+    def close(self):
+        """Stops walking."""
+        if self._timer_id is not None:
+            gobject.source_remove(self._timer_id)
+            self._timer_id = None
+
+    def _step_cb(self):
+        """Moves every walker on and reports its fix."""
+        utc = time.time()
+        step = self.speed * self.interval / 1000.0
+        for walker in self._walkers:
+            name, x, y, heading, infos = walker
+            if math.hypot(x, y) > self.radius:
+                heading = math.atan2(-x, -y) # head back to the center
+            else:
+                heading += self._random.gauss(0, 0.3)
+            x += step * math.sin(heading)
+            y += step * math.cos(heading)
+            walker[1:4] = [x, y, heading]
+
+            lon, lat = self._to_lonlat(x + self._random.gauss(0, self.noise),
+                                       y + self._random.gauss(0, self.noise))
+            if walker is self._walkers[0]:
+                self.infos['satellites'] = 8
+                self._update_fix(utc, lat, lon, 0.0, 2 * self.noise,
+                                 3 * self.noise, self.speed, 0.0)
+            elif self._others is not None:
+                infos.update({'latitude': lat, 'longitude': lon, 'utc': utc,
+                              'altitude': 0.0, 'eph': 2 * self.noise,
+                              'epv': 3 * self.noise, 'speed': self.speed,
+                              'climb': 0.0, 'satellites': 8})
+                self._others(name, infos)
+        return True
+
+    def _to_lonlat(self, x, y):
+        """Returns the lon/lat of a position in m east (x) and north (y)
+        of the center."""
+        lon, lat = self.center
+        lat += y / _METERS_PER_DEGREE
+        lon += x / (_METERS_PER_DEGREE * math.cos(math.radians(lat)))
+        return lon, lat
+
+###############################################################################
+
+class FilteredSource(PositionSource):
+    """Smoothes the fixes of another position source.
+
+    Each fix is passed through a L{KalmanFilter}. A smoothed fix is only
+    reported, if it left the error ellipse around the fix reported last,
+    so a player standing still (or walking slower than its receiver
+    jitters) does not report a move per fix. Fixes of further receivers
+    (see L{PositionSource.watch_others}) are smoothed alike, each with its
+    own filter.
+
+    The dictionary of GPS information is updated with the filter's
+    estimate for every fix, reported or not, so its position and
+    horizontal error (derived from the filter's covariance) are always
+    the smoothed ones.
+    """
+
+    def __init__(self, source, gps_infos,
+                 acceleration=constants.GPS_ACCELERATION):
+        """
+        @param source: The L{PositionSource} to smooth (updating a
+        dictionary of its own).
+        @param gps_infos: The dictionary to update with each smoothed fix.
+        @param acceleration: The acceleration in m/s^2 assumed for
+        players.
+        """
+        PositionSource.__init__(self, gps_infos)
+        self.source = source
+        self.acceleration = acceleration
+        self._filter = KalmanFilter(acceleration)
+        self._filters = {} # { name : KalmanFilter } of further receivers
+        self._others = None
+        source.watch(self._fix_cb)
+
+    def watch_others(self, callback):
+        """Calls callback(name, gps_infos) for each smoothed fix of a
+        further receiver, which left the error ellipse."""
+        self._others = callback
+        self.source.watch_others(self._other_fix_cb)
+
+    def close(self):
+        """Closes the smoothed source."""
+        self.source.close()
+
+    def _fix_cb(self, gps_infos):
+        smoothed = self._filter.update(gps_infos)
+        self.infos.update(self._filter.estimate)
+        if smoothed is not None:
+            self._report()
+
+    def _other_fix_cb(self, name, gps_infos):
+        if name not in self._filters:
+            self._filters[name] = KalmanFilter(self.acceleration)
+        smoothed = self._filters[name].update(gps_infos)
+        if smoothed is not None:
+            self._others(name, smoothed)
+
+###############################################################################
+
+class KalmanFilter():
+    """A constant velocity Kalman filter for the fixes of one receiver.
+
+    Positions are filtered in meters east and north of the first fix,
+    altitudes on their own. The error estimates of the receiver (eph,
+    epv, taken as 95% or two sigma) weight each fix against the position
+    predicted from the former ones; unknown velocity changes are covered
+    by the assumed acceleration.
+    """
+
+    _GATE = 5.991 # chi-square of 95% at 2 degrees of freedom
+    _MAX_PAUSE = 60 # seconds without fix until the filter starts over
+    _DEFAULT_EPH = 20.0
+    _DEFAULT_EPV = 30.0
+
+    def __init__(self, acceleration=constants.GPS_ACCELERATION):
+        """
+        @param acceleration: The acceleration in m/s^2 assumed for
+        players.
+        """
+        self.acceleration = acceleration
+        self.reset()
+
+    def reset(self):
+        """Forgets all fixes."""
+        self.estimate = None # the GPS information smoothed last
+        self._origin = None # (lon, lat) of the first fix
+        self._utc = None
+        self._east = None
+        self._north = None
+        self._up = None
+        self._reported = None # (east, north) reported last
+
+    def update(self, gps_infos):
+        """Filters a fix.
+
+        @param gps_infos: The GPS information of the fix (see
+        L{GPSReceiver.get_position}).
+        @return: A copy of gps_infos with the smoothed position, altitude
+        and horizontal error or None, if the smoothed position lies
+        within the error ellipse of the position returned last. The copy
+        is kept as estimate in any case.
+        """
+        lon, lat = gps_infos['longitude'], gps_infos['latitude']
+        utc = gps_infos.get('utc')
+        if utc is None:
+            utc = time.time()
+        eph = gps_infos.get('eph') or self._DEFAULT_EPH
+        epv = gps_infos.get('epv') or self._DEFAULT_EPV
+        altitude = gps_infos.get('altitude')
+
+        if self._utc is not None and not 0 <= utc - self._utc <= self._MAX_PAUSE:
+            self.reset()
+        if self._origin is None:
+            self._origin = lon, lat
+            self._scale = _METERS_PER_DEGREE * math.cos(math.radians(lat))
+            self._east = _Axis(0.0, (eph / 2) ** 2)
+            self._north = _Axis(0.0, (eph / 2) ** 2)
+        else:
+            dt = utc - self._utc
+            x = (lon - self._origin[0]) * self._scale
+            y = (lat - self._origin[1]) * _METERS_PER_DEGREE
+            for axis, value in ((self._east, x), (self._north, y)):
+                axis.predict(dt, self.acceleration)
+                axis.correct(value, (eph / 2) ** 2)
+        if altitude is not None:
+            if self._up is None:
+                self._up = _Axis(altitude, (epv / 2) ** 2)
+            else:
+                self._up.predict(utc - self._utc, self.acceleration)
+                self._up.correct(altitude, (epv / 2) ** 2)
+        self._utc = utc
+
+        east, north = self._east.position, self._north.position
+        smoothed = dict(gps_infos)
+        smoothed['longitude'] = self._origin[0] + east / self._scale
+        smoothed['latitude'] = self._origin[1] + north / _METERS_PER_DEGREE
+        smoothed['eph'] = 2 * math.sqrt(max(self._east.variance,
+                                            self._north.variance))
+        if self._up is not None:
+            smoothed['altitude'] = self._up.position
+        self.estimate = smoothed
+
+        if self._reported is not None:
+            d_east = east - self._reported[0]
+            d_north = north - self._reported[1]
+            if d_east ** 2 / self._east.variance + \
+                    d_north ** 2 / self._north.variance <= self._GATE:
+                return None # within the error ellipse
+        self._reported = east, north
+        return smoothed
+
+###############################################################################
+
+class _Axis():
+    """
+    The state (position, velocity) and its covariance along one axis of
+    a L{KalmanFilter}.
+    """
+
+    def __init__(self, position, variance):
+        self.position = position
+        self.velocity = 0.0
+        self.variance = variance # of the position
+        self._covariance = 0.0 # of position and velocity
+        self._velocity_variance = 4.0 # (2 m/s)^2, walking or standing
+
+    def predict(self, dt, acceleration):
+        """Moves the state dt seconds on."""
+        q = acceleration ** 2
+        self.position += self.velocity * dt
+        self.variance += 2 * dt * self._covariance + \
+                         dt ** 2 * self._velocity_variance + q * dt ** 4 / 4
+        self._covariance += dt * self._velocity_variance + q * dt ** 3 / 2
+        self._velocity_variance += q * dt ** 2
+
+    def correct(self, measured, variance):
+        """Weights a measured position with the predicted one."""
+        total = self.variance + variance
+        gain_position = self.variance / total
+        gain_velocity = self._covariance / total
+        residual = measured - self.position
+        self.position += gain_position * residual
+        self.velocity += gain_velocity * residual
+        self._velocity_variance -= gain_velocity * self._covariance
+        self._covariance *= 1 - gain_position
+        self.variance *= 1 - gain_position
+
+###########################  FUNCTIONS  #######################################
+
+def create_source(gps_infos, spec):
+    """Creates the position source described by spec, one of
+
+        - 'gpsd [HOST [PORT]]': streams fixes of a running gpsd,
+        - 'replay FILE [SPEED [loop]]': replays a log, see L{LogReplay},
+        - 'simulate [WALKERS [SPEED [NOISE]]]': simulates walkers, see
+          L{WalkerSimulator}.
+
+    @param gps_infos: The dictionary to update with each fix.
+    @param spec: The description of the source, e.g. 'replay walk.nmea 10'.
+    @return: The L{PositionSource}.
+    @raise ValueError: If spec is invalid.
+    """
+    args = spec.split()
+    if not args:
+        raise ValueError, 'no position source given'
+    kind, args = args[0], args[1:]
+    try:
+        if kind == 'gpsd' and len(args) <= 2:
+            host = args and args[0] or constants.GPSD_HOST
+            port = len(args) == 2 and int(args[1]) or constants.GPSD_PORT
+            return GPSStream(gps_infos, host, port)
+        if kind == 'replay' and 1 <= len(args) <= 3:
+            speed = 1.0
+            if len(args) >= 2:
+                speed = float(args[1])
+            return LogReplay(gps_infos, args[0], speed,
+                             len(args) == 3 and args[2] == 'loop')
+        if kind == 'simulate' and len(args) <= 3:
+            numbers = [float(arg) for arg in args]
+            walkers = numbers and int(numbers.pop(0)) or 30
+            return WalkerSimulator(gps_infos, walkers, *numbers)
+    except (IndexError, ValueError):
+        pass
+    raise ValueError, "invalid position source '%s'" % spec
+
+def _split_sentence(line):
+    """Returns the fields of an NMEA sentence or None if its checksum does
+    not match."""
+    if '*' in line:
+        line, checksum = line.split('*', 1)
+        value = 0
+        for char in line[1:]:
+            value ^= ord(char)
+        try:
+            if int(checksum[:2], 16) != value:
+                return None
+        except ValueError:
+            return None
+    return line[1:].split(',')
+
+def _parse_degrees(value, hemisphere):
+    """Returns the degrees of an NMEA (d)ddmm.mmmm value or None."""
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    degrees = int(number / 100) + (number % 100) / 60.0
+    if hemisphere in ('S', 'W'):
+        degrees = -degrees
+    return degrees
+
+def _parse_float(value):
+    """Returns the float of value or None if empty or invalid."""
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+def _parse_time(value):
+    """Returns the UTC seconds of a gpsd time: seconds (gpsd 2.x) or ISO
+    8601 (e.g. 2010-10-17T12:00:00.000Z)."""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        seconds = calendar.timegm(time.strptime(value[:19],
+                                                '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None
+    fraction = value[19:].rstrip('Z')
+    if fraction.startswith('.'):
+        seconds += float('0' + fraction)
+    return seconds
 
 ###############################################################################
 
@@ -158,11 +953,10 @@ if __name__ == '__main__':
              'satellites': 0     # #satellites
              }
 
-    recvr = GPSReceiver(infos)
-
-    for i in range(0, 100):
-        recvr.get_position()
+    # e.g. python position.py replay walk.nmea 10
+    recvr = GPSReceiver(infos, ' '.join(sys.argv[1:]) or constants.GPS_SOURCE)
 
+    def print_fix(infos):
         print 'latitude    ' , infos['latitude']
         print 'longitude   ' , infos['longitude']
         print 'time utc    ' , infos['utc']
@@ -173,5 +967,6 @@ if __name__ == '__main__':
         print 'climb       ' , infos['climb']
         print infos['satellites']
 
-        time.sleep(3)
-
+    if recvr.GPS_SESSION is not None:
+        recvr.watch(print_fix)
+        gobject.MainLoop().run()
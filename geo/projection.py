@@ -0,0 +1,190 @@
+"""Projects lon/lat coordinates onto the slippy map, one or many at once.
+
+World pixels count from the north-west corner of the map at a zoom level,
+which is 256 * 2**zoom pixels wide and high (see
+http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames).
+
+The batch functions use NumPy if available and fall back to the math
+module otherwise.
+"""
+#ifndef DOXYGEN_SHOULD_SKIP_THIS
+#
+# Copyright (C) 2009
+# by 52 North Initiative for Geospatial Open Source Software GmbH
+#
+# Contact: Andreas Wytzisk
+# 52 North Initiative for Geospatial Open Source Software GmbH
+# Martin-Luther-King-Weg 24
+# 48155 Muenster, Germany
+# info@52north.org
+#
+# This program is free software; you can redistribute and/or modify it
+# under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed WITHOUT ANY WARRANTY; even without the
+# implied WARRANTY OF MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (see gnu-gpl v2.txt). If not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA or visit the Free Software Foundation web page,
+# http://www.fsf.org.
+#
+# @author: $Author: $
+# Created: Oct 17, 2010
+# Modified: $Date$
+#       by: $Author: $
+#
+#endif
+__version__ = '$Id: $'
+
+from math import pi
+from math import log
+from math import tan
+from math import cos
+from math import atan
+from math import sinh
+from math import floor
+from math import radians
+from math import degrees
+
+# try to find NumPy (not part of every Sugar build)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TILE_PIXELS = 256
+
+###############################################################################
+
+class Viewport():
+    """
+    The transform between lon/lat and the screen pixels of a map view.
+
+    Beside the (non-linear) mercator projection it is just a translation:
+    the world pixel shown at the upper left corner of the view is
+    subtracted. A view creates the viewport once for its current center,
+    zoom and size and re-uses it for all conversions.
+    """
+
+    def __init__(self, zoom, origin_x, origin_y, width, height):
+        """
+        @param zoom: The zoom level of the view.
+        @param origin_x: The world pixel x shown at the left edge.
+        @param origin_y: The world pixel y shown at the top edge.
+        @param width: The width of the view in pixels.
+        @param height: The height of the view in pixels.
+        """
+        self.zoom = zoom
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.width = width
+        self.height = height
+
+    def to_screen(self, lon, lat):
+        """
+        Returns the screen pixel of lon/lat.
+
+        @return: Tuple (x, y) or None if the point lies beyond the view.
+        """
+        x_world, y_world = lonlat2world(lon, lat, self.zoom)
+        x = int(floor(x_world)) - self.origin_x
+        y = int(floor(y_world)) - self.origin_y
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return x, y
+        return None
+
+    def to_screen_all(self, lons, lats):
+        """
+        Returns the screen pixels of many points at once.
+
+        @param lons: A sequence of longitudes.
+        @param lats: A sequence of latitudes (same length as lons).
+        @return: A list with a tuple (x, y) per point (None if the point
+        lies beyond the view).
+        """
+        if numpy is None:
+            return [self.to_screen(lon, lat) for lon, lat in zip(lons, lats)]
+        if not len(lons):
+            return []
+        xs, ys = lonlat2world_all(lons, lats, self.zoom)
+        xs = numpy.floor(xs).astype(int) - self.origin_x
+        ys = numpy.floor(ys).astype(int) - self.origin_y
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        return [is_inside and (int(x), int(y)) or None \
+                for x, y, is_inside in zip(xs, ys, inside)]
+
+    def to_lonlat(self, x, y):
+        """
+        Returns the lon/lat shown at the given screen pixel.
+
+        @return: Tuple (lon, lat).
+        """
+        return world2lonlat(self.origin_x + x, self.origin_y + y, self.zoom)
+
+###########################  FUNCTIONS  #######################################
+
+def lonlat2world(lon, lat, zoom):
+    """
+    Projects a single lon/lat to world pixels.
+
+    @return: Tuple (x, y) of floats.
+    """
+    scale = TILE_PIXELS * 2.0 ** zoom
+    lat_rad = radians(lat)
+    x = (lon + 180.0) / 360.0 * scale
+    y = (1.0 - log(tan(lat_rad) + 1.0 / cos(lat_rad)) / pi) / 2.0 * scale
+    return x, y
+
+def world2lonlat(x, y, zoom):
+    """
+    Re-projects a single world pixel to lon/lat.
+
+    @return: Tuple (lon, lat).
+    """
+    scale = TILE_PIXELS * 2.0 ** zoom
+    lon = x / scale * 360.0 - 180.0
+    lat = degrees(atan(sinh(pi * (1.0 - 2.0 * y / scale))))
+    return lon, lat
+
+def lonlat2world_all(lons, lats, zoom):
+    """
+    Projects sequences of lon/lat to world pixels.
+
+    @param lons: A sequence of longitudes.
+    @param lats: A sequence of latitudes (same length as lons).
+    @return: Tuple (xs, ys), NumPy arrays if NumPy is available, lists
+    otherwise.
+    """
+    if numpy is None:
+        points = [lonlat2world(lon, lat, zoom) for lon, lat in zip(lons, lats)]
+        return [x for x, y in points], [y for x, y in points]
+    scale = TILE_PIXELS * 2.0 ** zoom
+    lons = numpy.asarray(lons, dtype=float)
+    lats_rad = numpy.radians(numpy.asarray(lats, dtype=float))
+    xs = (lons + 180.0) / 360.0 * scale
+    ys = (1.0 - numpy.log(numpy.tan(lats_rad) + 1.0 / numpy.cos(lats_rad)) \
+          / pi) / 2.0 * scale
+    return xs, ys
+
+def world2lonlat_all(xs, ys, zoom):
+    """
+    Re-projects sequences of world pixels to lon/lat.
+
+    @param xs: A sequence of world pixel x values.
+    @param ys: A sequence of world pixel y values (same length as xs).
+    @return: Tuple (lons, lats), NumPy arrays if NumPy is available, lists
+    otherwise.
+    """
+    if numpy is None:
+        points = [world2lonlat(x, y, zoom) for x, y in zip(xs, ys)]
+        return [lon for lon, lat in points], [lat for lon, lat in points]
+    scale = TILE_PIXELS * 2.0 ** zoom
+    xs = numpy.asarray(xs, dtype=float)
+    ys = numpy.asarray(ys, dtype=float)
+    lons = xs / scale * 360.0 - 180.0
+    lats = numpy.degrees(numpy.arctan(numpy.sinh(pi * (1.0 - 2.0 * ys / scale))))
+    return lons, lats
@@ -0,0 +1,526 @@
+"""Caches map tiles on disk and in memory."""
+#ifndef DOXYGEN_SHOULD_SKIP_THIS
+#
+# Copyright (C) 2009
+# by 52 North Initiative for Geospatial Open Source Software GmbH
+#
+# Contact: Andreas Wytzisk
+# 52 North Initiative for Geospatial Open Source Software GmbH
+# Martin-Luther-King-Weg 24
+# 48155 Muenster, Germany
+# info@52north.org
+#
+# This program is free software; you can redistribute and/or modify it
+# under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed WITHOUT ANY WARRANTY; even without the
+# implied WARRANTY OF MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (see gnu-gpl v2.txt). If not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA or visit the Free Software Foundation web page,
+# http://www.fsf.org.
+#
+# @author: $Author: $
+# Created: Oct 17, 2010
+# Modified: $Date$
+#       by: $Author: $
+#
+#endif
+__version__ = '$Id: $'
+
+import os
+import time
+import logging
+import threading
+
+import constants
+
+###############################################################################
+
+class TileCache():
+    """
+    Size-bounded cache of map tiles on disk.
+
+    Tiles are stored as <path>/<zoom>/<x>/<y>.png. Tiles of several tile
+    grids may share a cache (and its byte budget): their tuples start with
+    the name of the grid, (name, zoom, x, y), and they are stored as
+    <path>/<name>/<zoom>/<x>/<y>.png. For each tile the cache
+    keeps its size, the time it was last accessed, the time it was stored
+    and its HTTP validators (ETag, Last-Modified) within an index file.
+    When the cached tiles exceed the byte budget, the least recently used
+    tiles are removed. Tiles older than max_age are reported as misses, so
+    they will be revalidated (see L{TileCache.get_validators} and
+    L{TileCache.refresh}) or downloaded again.
+
+    Tiles are written to a temporary file first and renamed afterwards, so
+    a half-written tile never appears within the cache.
+
+    @note: The cache is used from several tile workers and is thread-safe.
+    """
+
+    _INDEX_NAME = 'tiles.idx'
+    _SAVE_INTERVAL = 50 # write index after so many changes
+
+    def __init__(self, path=constants.TMP_PATH,
+                 max_bytes=constants.TILE_CACHE_SIZE,
+                 max_age=constants.TILE_MAX_AGE):
+        """
+        Creates a tile cache and reads its index.
+
+        @param path: The directory where to cache tiles.
+        @param max_bytes: The maximum number of bytes to cache.
+        @param max_age: Seconds after a cached tile expires.
+        """
+        self._logger = logging.getLogger('tilecache-logger')
+        self._logger.setLevel(constants.LOG_LEVEL)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self.hits = 0
+        self.misses = 0
+
+        # { ([name,] zoom, x, y) : [size, accessed, stored, etag, last_modified] }
+        self._index = {}
+        self._bytes = 0
+        self._changes = 0
+        self._lock = threading.RLock()
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, 0755)
+        self._read_index()
+
+    def get_path(self, tile):
+        """
+        Returns the file path where the given tile is (or would be) stored.
+
+        @param tile: The tile tuple (zoom, x, y) or (name, zoom, x, y).
+        """
+        parts = [str(part) for part in tile]
+        parts[-1] += '.png'
+        return os.path.join(self.path, *parts)
+
+    def get(self, tile):
+        """
+        Returns the file of the given tile, if it is cached and valid.
+
+        @param tile: The tile tuple (zoom, x, y).
+        @return: The path of the cached tile or None on a cache miss.
+        """
+        self._lock.acquire()
+        try:
+            file_ = self._lookup(tile)
+            if file_ is None or self.is_expired(tile):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._index[tile][1] = time.time()
+            self._changed()
+            return file_
+        finally:
+            self._lock.release()
+
+    def get_stale(self, tile):
+        """
+        Returns the file of the given tile, regardless of its age.
+
+        Use it as fallback if a tile has expired but could not be
+        downloaded again. Does not count as hit or miss.
+
+        @param tile: The tile tuple (zoom, x, y).
+        @return: The path of the cached tile or None if not cached.
+        """
+        self._lock.acquire()
+        try:
+            return self._lookup(tile)
+        finally:
+            self._lock.release()
+
+    def is_expired(self, tile):
+        """
+        Indicates if the given tile is older than max_age.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._index.get(tile)
+            return entry is None or time.time() - entry[2] > self.max_age
+        finally:
+            self._lock.release()
+
+    def get_validators(self, tile):
+        """
+        Returns the HTTP validators the given tile was stored with.
+
+        @param tile: The tile tuple (zoom, x, y).
+        @return: Tuple (etag, last_modified), values are None if unknown.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._index.get(tile)
+            if entry is None:
+                return None, None
+            return entry[3], entry[4]
+        finally:
+            self._lock.release()
+
+    def refresh(self, tile):
+        """
+        Marks the given tile as fresh again, e.g. after the tile server has
+        confirmed the cached copy to be unchanged (HTTP 304).
+
+        @param tile: The tile tuple (zoom, x, y).
+        @return: The path of the cached tile or None if not cached.
+        """
+        self._lock.acquire()
+        try:
+            file_ = self._lookup(tile)
+            if file_ is None:
+                return None
+            now = time.time()
+            entry = self._index[tile]
+            entry[1] = entry[2] = now
+            self._changed()
+            return file_
+        finally:
+            self._lock.release()
+
+    def put(self, tile, data, etag=None, last_modified=None):
+        """
+        Stores the given tile data within the cache.
+
+        @param tile: The tile tuple (zoom, x, y).
+        @param data: The encoded image data of the tile.
+        @param etag: The ETag the tile server sent (optional).
+        @param last_modified: The Last-Modified value the tile server sent
+        (optional).
+        @return: The path of the cached tile or None if data was empty or
+        could not be written.
+        """
+        if not data:
+            return None
+        file_ = self.get_path(tile)
+        tmp_file = file_ + '.part'
+        tmp = None
+        try:
+            try:
+                tile_path = os.path.dirname(file_)
+                if not os.path.exists(tile_path):
+                    os.makedirs(tile_path, 0755)
+                tmp = open(tmp_file, 'wb')
+                tmp.write(data)
+                tmp.close()
+                tmp = None
+                os.rename(tmp_file, file_)
+            except (IOError, OSError), e:
+                self._logger.error("Could not cache tile %s: %s", tile, e)
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                return None
+        finally:
+            if tmp:
+                tmp.close()
+
+        self._lock.acquire()
+        try:
+            now = time.time()
+            entry = self._index.pop(tile, None)
+            if entry is not None:
+                self._bytes -= entry[0]
+            self._index[tile] = [len(data), now, now, etag, last_modified]
+            self._bytes += len(data)
+            self._evict()
+            self._changed()
+        finally:
+            self._lock.release()
+        return file_
+
+    def remove(self, tile):
+        """
+        Removes the given tile from the cache.
+        """
+        self._lock.acquire()
+        try:
+            self._drop(tile)
+            self._changed()
+        finally:
+            self._lock.release()
+
+    def get_size(self):
+        """
+        Returns the number of bytes currently cached.
+        """
+        return self._bytes
+
+    def get_stats(self):
+        """
+        Returns the tuple (hits, misses) counted since creation.
+        """
+        return self.hits, self.misses
+
+    def flush(self):
+        """
+        Writes the index file (write-then-rename).
+        """
+        self._lock.acquire()
+        try:
+            index_file = os.path.join(self.path, self._INDEX_NAME)
+            tmp = None
+            try:
+                tmp = open(index_file + '.part', 'w')
+                for tile, entry in self._index.items():
+                    # validators may contain blanks, so separate by tabs
+                    tmp.write('%s %d %f %f\t%s\t%s\n' % \
+                              ((' '.join([str(part) for part in tile]),) + \
+                               tuple(entry[:3]) + \
+                               (entry[3] or '', entry[4] or '')))
+                tmp.close()
+                tmp = None
+                os.rename(index_file + '.part', index_file)
+                self._changes = 0
+            except (IOError, OSError), e:
+                self._logger.error("Could not write tile index: %s", e)
+            if tmp:
+                tmp.close()
+        finally:
+            self._lock.release()
+
+    def _lookup(self, tile):
+        """
+        Returns the path of the tile if indexed and complete, None otherwise.
+        Broken entries are dropped.
+        """
+        entry = self._index.get(tile)
+        if entry is None:
+            return None
+        file_ = self.get_path(tile)
+        try:
+            size = os.path.getsize(file_)
+        except OSError:
+            size = -1
+        if size <= 0 or size != entry[0]:
+            self._logger.debug("Drop broken tile %s from cache.", tile)
+            self._drop(tile)
+            return None
+        return file_
+
+    def _drop(self, tile):
+        """
+        Removes the tile from the index and from disk (expects the lock).
+        """
+        entry = self._index.pop(tile, None)
+        if entry is not None:
+            self._bytes -= entry[0]
+        file_ = self.get_path(tile)
+        if os.path.exists(file_):
+            try:
+                os.remove(file_)
+            except OSError, e:
+                self._logger.error("Could not remove tile %s: %s", tile, e)
+
+    def _evict(self):
+        """
+        Removes least recently used tiles until the cache fits its budget
+        (expects the lock).
+        """
+        if self._bytes <= self.max_bytes:
+            return
+        # evict down to 90%, so not every put has to sort the index
+        low_water = self.max_bytes * 0.9
+        by_access = [(entry[1], tile) for tile, entry in self._index.items()]
+        by_access.sort()
+        for accessed, tile in by_access:
+            if self._bytes <= low_water:
+                break
+            self._drop(tile)
+        self._logger.debug("Evicted tiles, %d bytes cached.", self._bytes)
+
+    def _changed(self):
+        """
+        Counts index changes and writes index once in a while.
+        """
+        self._changes += 1
+        if self._changes >= self._SAVE_INTERVAL:
+            self.flush()
+
+    def _read_index(self):
+        """
+        Reads the index file. If there is none, tiles already lying in the
+        cache directory get indexed.
+        """
+        index_file = os.path.join(self.path, self._INDEX_NAME)
+        if not os.path.exists(index_file):
+            self._scan()
+            return
+
+        file_ = None
+        try:
+            try:
+                file_ = open(index_file, 'r')
+                for line in file_:
+                    fields = line.rstrip('\n').split('\t')
+                    values = fields[0].split()
+                    if len(values) not in (6, 7):
+                        continue
+                    validators = (fields[1:] + ['', ''])[:2]
+                    tile = tuple([int(value) for value in values[-6:-3]])
+                    if len(values) == 7:
+                        tile = (values[0],) + tile
+                    entry = [int(values[-3]), float(values[-2]), float(values[-1])]
+                    entry.extend([value or None for value in validators])
+                    self._index[tile] = entry
+                    self._bytes += entry[0]
+            except (IOError, ValueError), e:
+                self._logger.error("Could not read tile index: %s", e)
+        finally:
+            if file_:
+                file_.close()
+        self._logger.debug("%d tiles (%d bytes) indexed.",
+                           len(self._index), self._bytes)
+
+    def _scan(self):
+        """
+        Indexes tiles stored before the cache had an index.
+        """
+        for root, dirs, files in os.walk(self.path):
+            rel = root[len(self.path):].strip(os.sep).split(os.sep)
+            if len(rel) not in (2, 3) or \
+                    not (rel[-2].isdigit() and rel[-1].isdigit()):
+                continue
+            for name in files:
+                if not name.endswith('.png') or not name[:-4].isdigit():
+                    continue
+                file_ = os.path.join(root, name)
+                size = os.path.getsize(file_)
+                if size <= 0:
+                    os.remove(file_)
+                    continue
+                tile = (int(rel[-2]), int(rel[-1]), int(name[:-4]))
+                if len(rel) == 3:
+                    tile = (rel[0],) + tile
+                mtime = os.path.getmtime(file_)
+                self._index[tile] = [size, mtime, mtime, None, None]
+                self._bytes += size
+        self._evict()
+        self.flush()
+
+###############################################################################
+
+class PixbufCache():
+    """
+    Size-bounded cache of decoded tiles in memory.
+
+    Holds L{gtk.gdk.Pixbuf}s keyed by tile tuple (zoom, x, y), so redrawing
+    tiles does not have to decode them again. When the pixbufs exceed the
+    memory budget, the least recently used ones are dropped.
+
+    @note: The cache is used from the main loop and from the tile workers
+    and is thread-safe.
+    """
+
+    def __init__(self, max_bytes=constants.PIXBUF_CACHE_SIZE):
+        """
+        Creates an empty pixbuf cache.
+
+        @param max_bytes: The maximum number of (decoded) bytes to hold.
+        """
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self._pixbufs = {} # { (zoom, x, y) : [pixbuf, size, accessed] }
+        self._bytes = 0
+        self._clock = 0 # access counter, cheaper than time.time()
+        self._lock = threading.Lock()
+
+    def get(self, tile):
+        """
+        Returns the pixbuf of the given tile or None if not cached.
+
+        @param tile: The tile tuple (zoom, x, y).
+        """
+        self._lock.acquire()
+        try:
+            entry = self._pixbufs.get(tile)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._clock += 1
+            entry[2] = self._clock
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def contains(self, tile):
+        """
+        Indicates if the given tile is cached. Does not count as hit or miss.
+        """
+        self._lock.acquire()
+        try:
+            return tile in self._pixbufs
+        finally:
+            self._lock.release()
+
+    def put(self, tile, pixbuf):
+        """
+        Caches the pixbuf of the given tile.
+
+        @param tile: The tile tuple (zoom, x, y).
+        @param pixbuf: The decoded tile.
+        """
+        size = pixbuf.get_rowstride() * pixbuf.get_height()
+        self._lock.acquire()
+        try:
+            entry = self._pixbufs.pop(tile, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+            self._clock += 1
+            self._pixbufs[tile] = [pixbuf, size, self._clock]
+            self._bytes += size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """
+        Drops all pixbufs.
+        """
+        self._lock.acquire()
+        try:
+            self._pixbufs.clear()
+            self._bytes = 0
+        finally:
+            self._lock.release()
+
+    def get_size(self):
+        """
+        Returns the number of bytes currently held.
+        """
+        return self._bytes
+
+    def get_stats(self):
+        """
+        Returns the tuple (hits, misses) counted since creation.
+        """
+        return self.hits, self.misses
+
+    def _evict(self):
+        """
+        Drops least recently used pixbufs until the cache fits its budget
+        (expects the lock).
+        """
+        if self._bytes <= self.max_bytes:
+            return
+        low_water = self.max_bytes * 0.9
+        by_access = [(entry[2], tile) for tile, entry in self._pixbufs.items()]
+        by_access.sort()
+        for accessed, tile in by_access:
+            if self._bytes <= low_water:
+                break
+            self._bytes -= self._pixbufs.pop(tile)[1]
@@ -0,0 +1,261 @@
+"""Fetches map tiles in the background with a fixed pool of workers."""
+#ifndef DOXYGEN_SHOULD_SKIP_THIS
+#
+# Copyright (C) 2009
+# by 52 North Initiative for Geospatial Open Source Software GmbH
+#
+# Contact: Andreas Wytzisk
+# 52 North Initiative for Geospatial Open Source Software GmbH
+# Martin-Luther-King-Weg 24
+# 48155 Muenster, Germany
+# info@52north.org
+#
+# This program is free software; you can redistribute and/or modify it
+# under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed WITHOUT ANY WARRANTY; even without the
+# implied WARRANTY OF MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (see gnu-gpl v2.txt). If not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA or visit the Free Software Foundation web page,
+# http://www.fsf.org.
+#
+# @author: $Author: $
+# Created: Oct 17, 2010
+# Modified: $Date$
+#       by: $Author: $
+#
+#endif
+__version__ = '$Id: $'
+
+import heapq
+import gobject
+import logging
+import threading
+
+import constants
+
+# request priorities (lower values are loaded first)
+PRIORITY_VISIBLE = 0
+PRIORITY_PREFETCH = 1
+
+###############################################################################
+
+class TileFetcher():
+    """
+    Loads tiles with a fixed number of worker threads.
+
+    A tile is identified by a tuple (zoom, x, y). Requests are queued by
+    priority and handled by the workers in order: visible tiles first,
+    prefetched tiles only if no visible tile is waiting. At most all but
+    one worker load prefetched tiles, so a worker stays free for visible
+    ones.
+
+    A tile which is already pending is not queued twice, the callback is
+    attached to the pending request instead (raising its priority, if
+    necessary). Requests which are not of interest anymore (e.g. after the
+    zoom level or the center has changed) can be dropped via
+    L{TileFetcher.cancel_except}.
+
+    Callbacks are called from within the gobject main loop, so they may
+    safely draw onto widgets:
+
+        callback(tile, result)
+
+    where result is the value returned by the load function.
+    """
+
+    def __init__(self, load_tile, prefetch_tile=None,
+                 workers=constants.TILE_WORKERS):
+        """
+        Creates the fetcher and starts its workers.
+
+        @param load_tile: The function loading a tile. It is called with
+        the tile tuple from within a worker thread.
+        @param prefetch_tile: The function loading a tile requested with
+        L{PRIORITY_PREFETCH} (load_tile is used if None).
+        @param workers: The number of worker threads.
+        """
+        self._logger = logging.getLogger('tilefetcher-logger')
+        self._logger.setLevel(constants.LOG_LEVEL)
+
+        self._load_tile = load_tile
+        self._prefetch_tile = prefetch_tile or load_tile
+        self._queue = [] # heap of (priority, sequence, tile)
+        self._sequence = 0 # keeps order of equal priorities
+        self._pending = {} # { (zoom, x, y) : [priority, [callback, ..]] }
+        self._prefetching = 0
+        self._max_prefetching = max(1, workers - 1)
+        self._stopped = False
+        self._cond = threading.Condition()
+
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._work,
+                                      name='tile-worker-%d' % i)
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+
+    def request(self, tile, callback=None, priority=PRIORITY_VISIBLE):
+        """
+        Requests the given tile. Returns immediately.
+
+        @param tile: The tile tuple (zoom, x, y).
+        @param callback: Called within the main loop when tile is loaded
+        (may be None, e.g. when prefetching). Called once, even if the tile
+        is requested with it again before it is loaded.
+        @param priority: One of L{PRIORITY_VISIBLE}, L{PRIORITY_PREFETCH}.
+        """
+        self._cond.acquire()
+        try:
+            entry = self._pending.get(tile)
+            if entry is None:
+                entry = self._pending[tile] = [priority, []]
+                self._enqueue(priority, tile)
+            elif priority < entry[0]:
+                # queue again, the old queue entry will be skipped
+                entry[0] = priority
+                self._enqueue(priority, tile)
+            if callback is not None and callback not in entry[1]:
+                entry[1].append(callback)
+        finally:
+            self._cond.release()
+
+    def is_pending(self, tile):
+        """
+        Indicates if the given tile was requested but is not loaded yet.
+        """
+        self._cond.acquire()
+        try:
+            return tile in self._pending
+        finally:
+            self._cond.release()
+
+    def cancel_except(self, tiles):
+        """
+        Cancels all pending requests which are not contained in tiles.
+
+        A tile which is currently loaded by a worker will be finished, but
+        its callbacks will not be called anymore.
+
+        @param tiles: The tiles which are still of interest.
+        """
+        self._cond.acquire()
+        try:
+            for tile in self._pending.keys():
+                if tile not in tiles:
+                    del self._pending[tile]
+            # drop cancelled requests from the queue
+            self._queue = [item for item in self._queue \
+                           if item[2] in self._pending]
+            heapq.heapify(self._queue)
+        finally:
+            self._cond.release()
+
+    def cancel_all(self):
+        """
+        Cancels all pending requests.
+        """
+        self.cancel_except(())
+
+    def shutdown(self):
+        """
+        Cancels all pending requests and stops the workers.
+        """
+        self.cancel_all()
+        self._cond.acquire()
+        try:
+            self._stopped = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        self._workers = []
+
+    def _enqueue(self, priority, tile):
+        """
+        Queues the tile and wakes up a worker (expects the lock).
+        """
+        self._sequence += 1
+        heapq.heappush(self._queue, (priority, self._sequence, tile))
+        self._cond.notifyAll()
+
+    def _next(self):
+        """
+        Waits for the next tile to load (expects the lock).
+
+        @return: Tuple (priority, tile) or None if fetcher was shut down.
+        """
+        while not self._stopped:
+            if self._queue:
+                priority, sequence, tile = self._queue[0]
+                entry = self._pending.get(tile)
+                if entry is None or entry[0] != priority:
+                    heapq.heappop(self._queue) # cancelled or re-queued
+                    continue
+                if priority != PRIORITY_PREFETCH or \
+                        self._prefetching < self._max_prefetching:
+                    heapq.heappop(self._queue)
+                    return priority, tile
+            self._cond.wait()
+        return None
+
+    def _work(self):
+        """
+        Worker loop: loads queued tiles until the fetcher is shut down.
+        """
+        while True:
+            self._cond.acquire()
+            try:
+                item = self._next()
+                if item is None:
+                    break
+                priority, tile = item
+                if priority == PRIORITY_PREFETCH:
+                    self._prefetching += 1
+            finally:
+                self._cond.release()
+
+            result = self._load(tile, priority)
+
+            self._cond.acquire()
+            try:
+                if priority == PRIORITY_PREFETCH:
+                    self._prefetching -= 1
+                    self._cond.notifyAll()
+                entry = self._pending.get(tile)
+                if entry is not None and entry[0] < priority:
+                    # became visible while prefetching, re-queued already
+                    continue
+                entry = self._pending.pop(tile, None)
+            finally:
+                self._cond.release()
+            if entry is None:
+                continue # cancelled meanwhile
+            for callback in entry[1]:
+                gobject.idle_add(_notify, callback, tile, result)
+
+    def _load(self, tile, priority):
+        """
+        Loads the tile with the loader appropriate to its priority.
+        """
+        try:
+            if priority == PRIORITY_PREFETCH:
+                return self._prefetch_tile(tile)
+            return self._load_tile(tile)
+        except Exception, e:
+            self._logger.error("Could not load tile %s: %s", tile, e)
+            return None
+
+###########################  FUNCTIONS  #######################################
+
+def _notify(callback, tile, result):
+    """
+    Calls the callback once from the main loop (used with idle_add).
+    """
+    callback(tile, result)
+    return False
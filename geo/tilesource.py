@@ -0,0 +1,470 @@
+"""Downloads map tiles from one or more tile servers over persistent HTTP
+connections.
+
+Run as script to start a stand-in tile server for local testing, which
+serves tiles from a directory of <zoom>/<x>/<y>.png (e.g. the tile cache):
+
+    python tilesource.py DIRECTORY [PORT]
+
+and list http://localhost:PORT/ within config/default_tiles.
+"""
+#ifndef DOXYGEN_SHOULD_SKIP_THIS
+#
+# Copyright (C) 2009
+# by 52 North Initiative for Geospatial Open Source Software GmbH
+#
+# Contact: Andreas Wytzisk
+# 52 North Initiative for Geospatial Open Source Software GmbH
+# Martin-Luther-King-Weg 24
+# 48155 Muenster, Germany
+# info@52north.org
+#
+# This program is free software; you can redistribute and/or modify it
+# under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed WITHOUT ANY WARRANTY; even without the
+# implied WARRANTY OF MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (see gnu-gpl v2.txt). If not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA or visit the Free Software Foundation web page,
+# http://www.fsf.org.
+#
+# @author: $Author: $
+# Created: Oct 17, 2010
+# Modified: $Date$
+#       by: $Author: $
+#
+#endif
+__version__ = '$Id: $'
+
+import os
+import sys
+import time
+import socket
+import httplib
+import logging
+import urlparse
+import threading
+
+try:
+    import ssl
+except ImportError: # Python 2.5
+    ssl = None
+
+_LOG = logging.getLogger('tilesource-logger')
+
+_USER_AGENT = 'Geo Activity (OLPC, 52north.org)'
+
+###############################################################################
+
+class HTTPPool():
+    """
+    Keeps HTTP/1.1 connections alive for re-use, per host.
+
+    A connection is taken from the pool for each request and put back
+    afterwards, unless the server closes it. So requests of several
+    threads to the same host share a few open connections instead of
+    opening a new one per request.
+
+    @note: The pool is used from several tile workers and is thread-safe.
+    """
+
+    def __init__(self, max_idle=4, timeout=20):
+        """
+        @param max_idle: Open connections kept per host at most.
+        @param timeout: Socket timeout in seconds, also for connecting.
+        """
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = {} # { (scheme, host) : [connection, ..] }
+        self._lock = threading.Lock()
+
+    def get(self, url, headers=None):
+        """
+        Sends a GET request and reads the response.
+
+        If a re-used connection turns out to be closed by the server, the
+        request is sent once again over a new connection.
+
+        @param url: The URL to request.
+        @param headers: Additional request headers (dictionary).
+        @return: Tuple (status, response headers, body).
+        @raise IOError: If the request fails.
+        """
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+        request_headers = {'User-Agent': _USER_AGENT}
+        if headers:
+            request_headers.update(headers)
+
+        key = (scheme, host)
+        connection = self._acquire(key)
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = self._connect(key)
+            try:
+                connection.request('GET', path or '/', headers=request_headers)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                connection = None
+                if not reused:
+                    raise IOError, "GET %s failed: %s" % (url, e)
+                reused = False # server dropped idle connection, try again
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+        return response.status, response.msg, body
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        self._lock.acquire()
+        try:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+        finally:
+            self._lock.release()
+
+    def _acquire(self, key):
+        """
+        Returns an idle connection to the host or None.
+        """
+        self._lock.acquire()
+        try:
+            connections = self._idle.get(key)
+            if connections:
+                return connections.pop()
+            return None
+        finally:
+            self._lock.release()
+
+    def _release(self, key, connection):
+        """
+        Puts the connection back for re-use (or closes it, if enough idle).
+        """
+        self._lock.acquire()
+        try:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        finally:
+            self._lock.release()
+        connection.close()
+
+    def _connect(self, key):
+        """
+        Opens a new connection to the host. The socket gets the timeout
+        before connecting, so an unreachable host does not hold the
+        calling worker for the TCP connect timeout of the system.
+        """
+        scheme, host = key
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host)
+        else:
+            connection = httplib.HTTPConnection(host)
+        try:
+            sock = _open_socket(connection.host, connection.port,
+                                self.timeout)
+            if scheme == 'https':
+                if ssl is None:
+                    sock = httplib.FakeSocket(sock, socket.ssl(sock))
+                else:
+                    sock = ssl.wrap_socket(sock)
+        except socket.error, e:
+            raise IOError, "Could not connect to %s: %s" % (host, e)
+        connection.sock = sock
+        return connection
+
+###############################################################################
+
+class TileSource():
+    """
+    Downloads tiles from a set of tile servers (e.g. mirrors or the a/b/c
+    hosts of a tile server).
+
+    Requests are distributed round-robin over the hosts. A request which
+    fails because of the host (no connection, server error) is sent to the
+    next host. A host failing several times in a row is skipped for a
+    while; the pause doubles with each further failure. Requests, errors
+    and latency are counted per host, see L{TileSource.get_stats}.
+
+    @note: The source is used from several tile workers and is thread-safe.
+    """
+
+    _MAX_FAILURES = 3 # failures in a row until a host is paused
+    _BACKOFF = 30 # seconds a failing host is paused first
+    _MAX_BACKOFF = 600
+
+    def __init__(self, urls, pool=None):
+        """
+        @param urls: The base URLs of the tile servers. Tiles are requested
+        as <url><zoom>/<x>/<y>.png.
+        @param pool: The L{HTTPPool} to send requests with (created if
+        None).
+        """
+        if not urls:
+            raise ValueError, 'no tile server given'
+        if pool is None:
+            pool = HTTPPool()
+        self.pool = pool
+        self._hosts = [_Host(url) for url in urls]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def get_tile(self, tile, etag=None, last_modified=None):
+        """
+        Downloads a tile, conditionally if validators of a cached copy are
+        given.
+
+        @param tile: The tile tuple (zoom, x, y).
+        @param etag: The ETag of the cached copy (optional).
+        @param last_modified: The Last-Modified value of the cached copy
+        (optional).
+        @return: Tuple (data, etag, last_modified). data is None if the
+        cached copy is still valid (HTTP 304).
+        @raise IOError: If the tile could not be downloaded.
+        """
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        error = None
+        for host in self._choose_hosts():
+            url = host.url + '%s/%s/%s.png' % tile
+            start = time.time()
+            try:
+                status, response_headers, body = self.pool.get(url, headers)
+            except IOError, e:
+                self._failed(host)
+                error = e
+                continue # next host
+            if status >= 500:
+                self._failed(host)
+                error = IOError("GET %s returned status %s" % (url, status))
+                continue
+            self._succeeded(host, time.time() - start)
+
+            if status == httplib.NOT_MODIFIED and headers:
+                return None, etag, last_modified
+            if status != httplib.OK:
+                raise IOError, "GET %s returned status %s" % (url, status)
+            content_type = response_headers.get('Content-Type', '')
+            if not content_type.startswith('image/') or not body:
+                raise IOError, "GET %s returned no image" % url
+            return body, response_headers.get('ETag'), \
+                   response_headers.get('Last-Modified')
+
+        if error is None:
+            raise IOError, 'all tile servers paused after failures'
+        raise error
+
+    def get_stats(self):
+        """
+        Returns the statistics of each host.
+
+        @return: A list of tuples (url, requests, errors, mean latency in
+        seconds, paused), in order of the configured URLs.
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            stats = []
+            for host in self._hosts:
+                latency = 0.0
+                if host.requests > host.errors:
+                    latency = host.latency / (host.requests - host.errors)
+                stats.append((host.url, host.requests, host.errors, latency,
+                              host.paused_until > now))
+            return stats
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        self.pool.close()
+
+    def _choose_hosts(self):
+        """
+        Returns the hosts to try in order: all hosts not paused, starting
+        with the next one in turn.
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            count = len(self._hosts)
+            start = self._next
+            self._next = (self._next + 1) % count
+            hosts = [self._hosts[(start + i) % count] for i in range(count)]
+            return [host for host in hosts if host.paused_until <= now]
+        finally:
+            self._lock.release()
+
+    def _succeeded(self, host, latency):
+        """
+        Counts a request answered by the host.
+        """
+        self._lock.acquire()
+        try:
+            host.requests += 1
+            host.latency += latency
+            host.failures = 0
+            host.backoff = self._BACKOFF
+        finally:
+            self._lock.release()
+
+    def _failed(self, host):
+        """
+        Counts a failed request and pauses the host if it keeps failing.
+        """
+        self._lock.acquire()
+        try:
+            host.requests += 1
+            host.errors += 1
+            host.failures += 1
+            if host.failures >= self._MAX_FAILURES:
+                host.paused_until = time.time() + host.backoff
+                _LOG.warn("Tile server %s paused for %d seconds.", host.url,
+                          host.backoff)
+                host.backoff = min(2 * host.backoff, self._MAX_BACKOFF)
+        finally:
+            self._lock.release()
+
+###############################################################################
+
+class _Host():
+    """
+    Statistics and state of a single tile server.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.requests = 0
+        self.errors = 0
+        self.latency = 0.0 # sum of successful requests
+        self.failures = 0 # errors in a row
+        self.backoff = TileSource._BACKOFF
+        self.paused_until = 0
+
+###########################  FUNCTIONS  #######################################
+
+def _open_socket(host, port, timeout):
+    """
+    Opens a TCP connection to the first address of host which answers
+    within timeout seconds.
+
+    @raise socket.error: If no address answers.
+    """
+    error = socket.error('no address of %s' % host)
+    for family, socktype, proto, name, address in \
+            socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(address)
+            return sock
+        except socket.error, e:
+            sock.close()
+            error = e
+    raise error
+
+def read_urls(file_name):
+    """
+    Reads the base URLs of tile servers from a configuration file, one URL
+    per line. Empty lines and lines starting with '#' are skipped.
+
+    @param file_name: The configuration file (e.g. config/default_tiles).
+    @return: The list of URLs (empty, if file could not be read).
+    """
+    urls = []
+    file_ = None
+    try:
+        try:
+            file_ = open(file_name, 'r')
+            for line in file_:
+                url = _extract_url(line)
+                if url is not None:
+                    urls.append(url)
+        except IOError, e:
+            _LOG.error("Could not read file %s: %s", file_name, e)
+    finally:
+        if file_:
+            file_.close()
+    return urls
+
+def _extract_url(line):
+    """
+    Returns the URL of a configuration line (with trailing '/') or None if
+    line is a comment or empty.
+    """
+    line = line.strip()
+    if line.startswith('#') or len(line) == 0:
+        return None
+    if not line.endswith('/'):
+        line += '/'
+    return line
+
+###############################################################################
+
+if __name__ == '__main__':
+
+    import BaseHTTPServer
+
+    class _TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """Serves tiles of a directory, answers conditional requests."""
+
+        protocol_version = 'HTTP/1.1' # keep-alive
+
+        def do_GET(self):
+            file_ = os.path.join(DIRECTORY, self.path.strip('/'))
+            if not os.path.isfile(file_):
+                self.send_error(404)
+                return
+            mtime = os.path.getmtime(file_)
+            etag = '"%x-%x"' % (int(mtime), os.path.getsize(file_))
+            last_modified = self.date_time_string(mtime)
+            if self.headers.get('If-None-Match') == etag or \
+                    self.headers.get('If-Modified-Since') == last_modified:
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            tmp = open(file_, 'rb')
+            data = tmp.read()
+            tmp.close()
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            self.wfile.write(data)
+
+    if len(sys.argv) not in (2, 3):
+        print __doc__
+        sys.exit(1)
+    DIRECTORY = sys.argv[1]
+    port = 8080
+    if len(sys.argv) == 3:
+        port = int(sys.argv[2])
+    server = BaseHTTPServer.HTTPServer(('localhost', port), _TileHandler)
+    print 'Serving tiles of %s on http://localhost:%d/' % (DIRECTORY, port)
+    server.serve_forever()
@@ -0,0 +1,280 @@
+"""Stores the movement traces of players in typed arrays, simplified per
+zoom level of the map."""
+#ifndef DOXYGEN_SHOULD_SKIP_THIS
+#
+# Copyright (C) 2009
+# by 52 North Initiative for Geospatial Open Source Software GmbH
+#
+# Contact: Andreas Wytzisk
+# 52 North Initiative for Geospatial Open Source Software GmbH
+# Martin-Luther-King-Weg 24
+# 48155 Muenster, Germany
+# info@52north.org
+#
+# This program is free software; you can redistribute and/or modify it
+# under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed WITHOUT ANY WARRANTY; even without the
+# implied WARRANTY OF MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (see gnu-gpl v2.txt). If not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA or visit the Free Software Foundation web page,
+# http://www.fsf.org.
+#
+# @author: $Author: $
+# Created: Oct 17, 2010
+# Modified: $Date$
+#       by: $Author: $
+#
+#endif
+__version__ = '$Id: $'
+
+import sys
+import array
+import struct
+
+from bisect import bisect_left
+from bisect import bisect_right
+from projection import lonlat2world
+
+MAX_LEVEL = 18 # the closest zoom level of the map, drawn in full detail
+TOLERANCE = 1.0 # pixels a simplified trace may deviate from the trace
+
+_COLUMNS = ('times', 'lons', 'lats', 'altitudes', 'errors')
+# squared tolerance per zoom level, in world pixels of zoom level 0
+_TOLERANCES = [(TOLERANCE / 2.0 ** level) ** 2 for level in range(MAX_LEVEL)]
+_HEADER = '<4sI' # magic, number of points
+_MAGIC = 'TRC1'
+_NAN = float('nan')
+
+###############################################################################
+
+class Trace():
+    """
+    The movement trace of a player: time, lon, lat, altitude and
+    horizontal error of each move, in order of time.
+
+    Each value is kept in a column (an array of doubles), so a point takes
+    40 bytes, instead of a dictionary entry, a time string and a
+    L{shapely.geometry.Point} with its GEOS geometry. Points are appended
+    in amortized constant time; a point older than the last one is
+    inserted in place, which costs time in proportion to the points after
+    it. Unknown altitudes and errors are NaN.
+
+    A level of detail pyramid is built while appending: a point belongs to
+    the farthest zoom level at which it is farther than TOLERANCE pixels
+    from the point kept before (a radial distance filter, nested over the
+    levels). Each level holds the indices of its points, so drawing a
+    trace at zoom level z (see L{simplify}) only touches the points of
+    levels 0 to z. The pyramid takes 4 bytes per point at most.
+    """
+
+    def __init__(self):
+        for name in _COLUMNS:
+            setattr(self, name, array.array('d'))
+        self._levels = [array.array('I') for level in range(MAX_LEVEL)]
+        self._kept = [None] * MAX_LEVEL # (x, y) kept last per level
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, index):
+        """
+        Returns the point at index as tuple (time, lon, lat, altitude,
+        error).
+        """
+        return self.times[index], self.lons[index], self.lats[index], \
+               self.altitudes[index], self.errors[index]
+
+    def __iter__(self):
+        for index in xrange(len(self.times)):
+            yield self[index]
+
+    def append(self, utc, lon, lat, altitude=None, error=None):
+        """
+        Adds a point.
+
+        @param utc: The time of the point in seconds since the epoch.
+        @param lon: The longitude.
+        @param lat: The latitude.
+        @param altitude: The altitude in meters (None if unknown).
+        @param error: The horizontal error in meters (None if unknown).
+        """
+        if altitude is None:
+            altitude = _NAN
+        if error is None:
+            error = _NAN
+        values = (utc, lon, lat, altitude, error)
+        if not self.times or utc >= self.times[-1]:
+            for name, value in zip(_COLUMNS, values):
+                getattr(self, name).append(value)
+            self._simplify(len(self.times) - 1)
+        else:
+            index = bisect_right(self.times, utc)
+            for name, value in zip(_COLUMNS, values):
+                getattr(self, name).insert(index, value)
+            self._resimplify(index) # indices behind have moved
+
+    def between(self, start=None, end=None):
+        """
+        Returns the points from start (inclusive) to end (exclusive).
+
+        @param start: The time to start at (None for the first point).
+        @param end: The time to end at (None for beyond the last point).
+        @return: A new L{Trace}.
+        """
+        first, last = self._get_range(start, end)
+        trace = Trace()
+        for name in _COLUMNS:
+            setattr(trace, name, getattr(self, name)[first:last])
+        trace._rebuild()
+        return trace
+
+    def simplify(self, zoom, start=None, end=None):
+        """
+        Returns the points needed to draw the trace at a zoom level: those
+        of the pyramid levels up to zoom, and the first and last point.
+
+        @param zoom: The zoom level of the map.
+        @param start: The time to start at (None for the first point).
+        @param end: The time to end at (None for beyond the last point).
+        @return: A new L{Trace}.
+        """
+        indices = self._select(zoom, start, end)
+        trace = Trace()
+        for name in _COLUMNS:
+            column = getattr(self, name)
+            setattr(trace, name, array.array('d', [column[index] \
+                                                   for index in indices]))
+        trace._rebuild()
+        return trace
+
+    def get_positions(self, zoom=MAX_LEVEL, start=None, end=None):
+        """
+        Returns the positions needed to draw the trace at a zoom level (see
+        L{simplify}), all positions by default.
+
+        @return: A list of tuples (lon, lat).
+        """
+        return [(self.lons[index], self.lats[index]) \
+                for index in self._select(zoom, start, end)]
+
+    def clear(self):
+        """
+        Removes all points.
+        """
+        self.__init__()
+
+    def tostring(self):
+        """
+        Returns the trace as (little-endian) binary string, see
+        L{fromstring}.
+        """
+        data = [struct.pack(_HEADER, _MAGIC, len(self.times))]
+        for name in _COLUMNS:
+            column = getattr(self, name)
+            if sys.byteorder == 'big':
+                column = array.array('d', column)
+                column.byteswap()
+            data.append(column.tostring())
+        return ''.join(data)
+
+    def _get_range(self, start, end):
+        """
+        Returns the indices (first, last + 1) of a time range.
+        """
+        first, last = 0, len(self.times)
+        if start is not None:
+            first = bisect_left(self.times, start)
+        if end is not None:
+            last = bisect_left(self.times, end)
+        return first, max(first, last)
+
+    def _select(self, zoom, start, end):
+        """
+        Returns the (ordered) indices of the points to draw at a zoom level
+        within a time range.
+        """
+        first, last = self._get_range(start, end)
+        if zoom >= MAX_LEVEL:
+            return xrange(first, last)
+        if first == last:
+            return []
+        indices = [first, last - 1]
+        for level in self._levels[:max(0, int(zoom)) + 1]:
+            indices.extend(level[bisect_left(level, first):
+                                 bisect_left(level, last)])
+        indices.sort()
+        return [index for i, index in enumerate(indices) \
+                if i == 0 or index != indices[i - 1]]
+
+    def _simplify(self, index):
+        """
+        Puts a point appended into the level of detail pyramid.
+        """
+        x, y = lonlat2world(self.lons[index], self.lats[index], 0)
+        for level in range(MAX_LEVEL):
+            kept = self._kept[level]
+            if kept is None or \
+                    (x - kept[0]) ** 2 + (y - kept[1]) ** 2 > _TOLERANCES[level]:
+                self._levels[level].append(index)
+                for finer in range(level, MAX_LEVEL):
+                    self._kept[finer] = x, y
+                return
+
+    def _resimplify(self, index):
+        """
+        Puts the points from index on into the level of detail pyramid
+        again. The levels of the points before are kept.
+        """
+        last = None # index kept last at this or a coarser level
+        for level in range(MAX_LEVEL):
+            indices = self._levels[level]
+            del indices[bisect_left(indices, index):]
+            if indices and (last is None or indices[-1] > last):
+                last = indices[-1]
+            if last is None:
+                self._kept[level] = None
+            else:
+                self._kept[level] = lonlat2world(self.lons[last],
+                                                 self.lats[last], 0)
+        for index in xrange(index, len(self.times)):
+            self._simplify(index)
+
+    def _rebuild(self):
+        """
+        Builds the level of detail pyramid of all points again.
+        """
+        self._levels = [array.array('I') for level in range(MAX_LEVEL)]
+        self._kept = [None] * MAX_LEVEL
+        self._resimplify(0)
+
+###########################  FUNCTIONS  #######################################
+
+def fromstring(data):
+    """
+    Returns the trace of a binary string written by L{Trace.tostring}.
+
+    @raise ValueError: If data is no trace.
+    """
+    offset = struct.calcsize(_HEADER)
+    try:
+        magic, count = struct.unpack(_HEADER, data[:offset])
+    except struct.error:
+        raise ValueError, 'no trace'
+    size = count * array.array('d').itemsize
+    if magic != _MAGIC or len(data) != offset + size * len(_COLUMNS):
+        raise ValueError, 'no trace'
+    trace = Trace()
+    for name in _COLUMNS:
+        column = getattr(trace, name)
+        column.fromstring(data[offset:offset + size])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        offset += size
+    trace._rebuild()
+    return trace
@@ -115,6 +115,21 @@ def load_svg_image(name, color_stroke, color_fill, size=(20,20)):
     pixbuf_loader.close()
     return pixbuf_loader.get_pixbuf()
 
+def load_image(data):
+    """
+    Decodes an image from memory (without a round-trip through a file).
+
+    @param data: The encoded image (PNG, JPEG, ..).
+    @return: The image as L{gtk.gdk.Pixbuf}.
+    @raise gobject.GError: If data is no valid image.
+    """
+    pixbuf_loader = gtk.gdk.PixbufLoader()
+    try:
+        pixbuf_loader.write(data)
+    finally:
+        pixbuf_loader.close()
+    return pixbuf_loader.get_pixbuf()
+
 def load_svg(svg, color_stroke=None, color_fill=None):
     """
     Returns an SVG handle.
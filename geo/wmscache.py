@@ -0,0 +1,254 @@
+"""Caches WMS maps as tiles of a fixed grid."""
+#ifndef DOXYGEN_SHOULD_SKIP_THIS
+#
+# Copyright (C) 2009
+# by 52 North Initiative for Geospatial Open Source Software GmbH
+#
+# Contact: Andreas Wytzisk
+# 52 North Initiative for Geospatial Open Source Software GmbH
+# Martin-Luther-King-Weg 24
+# 48155 Muenster, Germany
+# info@52north.org
+#
+# This program is free software; you can redistribute and/or modify it
+# under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed WITHOUT ANY WARRANTY; even without the
+# implied WARRANTY OF MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (see gnu-gpl v2.txt). If not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA or visit the Free Software Foundation web page,
+# http://www.fsf.org.
+#
+# @author: $Author: $
+# Created: Oct 17, 2010
+# Modified: $Date$
+#       by: $Author: $
+#
+#endif
+__version__ = '$Id: $'
+
+import os
+import gtk
+import math
+import glob
+import logging
+
+import utils
+import constants
+
+from hashlib import md5
+from tilecache import TileCache
+from tilecache import PixbufCache
+
+TILE_PIXELS = 256
+MIN_LEVEL = 1 # level 0 would reach beyond the poles
+MAX_LEVEL = 20
+
+_TILES = None # the tile cache shared by all maps, see get_tile_cache
+_PIXBUFS = None # the pixbuf cache shared by all maps
+
+###############################################################################
+
+class WMSTileCache():
+    """
+    Caches the GetMap responses of one map as tiles.
+
+    A map is made of a WMS, a list of layers, a SRS and an image format.
+    Its tiles are cut along a fixed grid: at level L the world (in degrees
+    of EPSG:4326) is divided into tiles of 360 / 2**L degrees, each
+    requested with TILE_PIXELS * TILE_PIXELS pixels. A tile (level, col,
+    row) thus stands for the GetMap request key (url, layers, srs, bbox,
+    size), so areas seen before are drawn without requesting the WMS.
+
+    Decoded tiles are kept in memory, the responses on disk. All maps
+    share one cache of each (see L{get_tile_cache}), so the tiles of all
+    maps are bounded by WMS_CACHE_SIZE and WMS_PIXBUF_CACHE_SIZE together
+    (least recently used tiles are dropped). A map is thus cheap to
+    create: its tiles are keyed by the map's name within the shared caches.
+    """
+
+    def __init__(self, url, layers, srs, format, tiles=None, pixbufs=None):
+        """
+        @param url: The URL of the WMS.
+        @param layers: The list of layers requested.
+        @param srs: The SRS requested.
+        @param format: The image format requested.
+        @param tiles: The L{TileCache} to store responses in (the shared
+        one by default).
+        @param pixbufs: The L{PixbufCache} to keep decoded tiles in (the
+        shared one by default).
+        """
+        self._logger = logging.getLogger('wmscache-logger')
+        self._logger.setLevel(constants.LOG_LEVEL)
+
+        key = '|'.join([url, ','.join(layers), srs, format, str(TILE_PIXELS)])
+        self.name = md5(key).hexdigest()
+        if tiles is None:
+            tiles = get_tile_cache()
+        if pixbufs is None:
+            pixbufs = get_pixbuf_cache()
+        self.tiles = tiles
+        self.pixbufs = pixbufs
+
+    def get(self, tile):
+        """
+        Returns the given tile, if cached.
+
+        @param tile: The tile tuple (level, col, row).
+        @return: The decoded tile or None on a cache miss.
+        """
+        key = (self.name,) + tile
+        pixbuf = self.pixbufs.get(key)
+        if pixbuf is not None:
+            return pixbuf
+        file_ = self.tiles.get(key)
+        if file_ is None:
+            return None
+        try:
+            pixbuf = gtk.gdk.pixbuf_new_from_file(file_)
+        except Exception, e:
+            self._logger.error("Drop broken tile %s: %s", tile, e)
+            self.tiles.remove(key)
+            return None
+        self.pixbufs.put(key, pixbuf)
+        return pixbuf
+
+    def put(self, tile, data, pixbuf=None):
+        """
+        Caches the GetMap response of the given tile.
+
+        @param tile: The tile tuple (level, col, row).
+        @param data: The encoded image.
+        @param pixbuf: The decoded image, if decoded already.
+        @return: The decoded tile or None if data could not be decoded.
+        """
+        if pixbuf is None:
+            try:
+                pixbuf = utils.load_image(data)
+            except Exception, e:
+                self._logger.error("Invalid GetMap response for tile %s: %s",
+                                   tile, e)
+                return None
+        key = (self.name,) + tile
+        self.pixbufs.put(key, pixbuf)
+        self.tiles.put(key, data)
+        return pixbuf
+
+    def flush(self):
+        """
+        Writes the index of the (shared) disk cache.
+        """
+        self.tiles.flush()
+
+###########################  FUNCTIONS  #######################################
+
+def get_tile_cache():
+    """
+    Returns the disk cache shared by all WMS maps (created on first use,
+    from within the main loop).
+    """
+    global _TILES
+    if _TILES is None:
+        _TILES = TileCache(os.path.join(constants.TMP_PATH, 'wms'),
+                           constants.WMS_CACHE_SIZE)
+    return _TILES
+
+def get_pixbuf_cache():
+    """
+    Returns the memory cache of decoded tiles shared by all WMS maps.
+    """
+    global _PIXBUFS
+    if _PIXBUFS is None:
+        _PIXBUFS = PixbufCache(constants.WMS_PIXBUF_CACHE_SIZE)
+    return _PIXBUFS
+
+def get_level(bbox, size):
+    """
+    Returns the grid level whose resolution is closest to the resolution
+    of the given map extent.
+
+    @param bbox: The map extent (a L{geo.BoundingBox} in EPSG:4326).
+    @param size: The map size (width, height) in pixels.
+    """
+    degrees_per_pixel = bbox.get_hrange() / float(size[0])
+    if degrees_per_pixel <= 0:
+        return MAX_LEVEL
+    level = int(round(math.log(360.0 / TILE_PIXELS / degrees_per_pixel, 2)))
+    return min(max(level, MIN_LEVEL), MAX_LEVEL)
+
+def get_tile_range(bbox, level):
+    """
+    Returns the tiles covering the given map extent.
+
+    @return: Tuple (first_col, first_row, last_col, last_row).
+    """
+    span = 360.0 / 2 ** level
+    first_col = int(math.floor((bbox.get_west() + 180.0) / span))
+    last_col = int(math.ceil((bbox.get_east() + 180.0) / span)) - 1
+    first_row = int(math.floor((90.0 - bbox.get_north()) / span))
+    last_row = int(math.ceil((90.0 - bbox.get_south()) / span)) - 1
+    return first_col, first_row, max(first_col, last_col), \
+           max(first_row, last_row)
+
+def is_valid(tile):
+    """
+    Indicates if the given tile lies within the world's extent.
+    """
+    level, col, row = tile
+    return 0 <= col < 2 ** level and 0 <= row < 2 ** (level - 1)
+
+def get_tile_bbox(tile):
+    """
+    Returns the extent (west, south, east, north) of the given tile.
+    """
+    level, col, row = tile
+    span = 360.0 / 2 ** level
+    west = col * span - 180.0
+    north = 90.0 - row * span
+    return west, north - span, west + span, north
+
+def draw_tile(pixbuf, tile, bbox, dest):
+    """
+    Draws a tile onto a map image, scaled to the map's extent.
+
+    @param pixbuf: The decoded tile.
+    @param tile: The tile tuple (level, col, row).
+    @param bbox: The extent of the map image.
+    @param dest: The map image (a L{gtk.gdk.Pixbuf}).
+    @return: The area (x, y, width, height) of the map drawn or None if
+    the tile lies beyond the map.
+    """
+    west, south, east, north = get_tile_bbox(tile)
+    scale_x = dest.get_width() / bbox.get_hrange()
+    scale_y = dest.get_height() / bbox.get_vrange()
+    offset_x = (west - bbox.get_west()) * scale_x
+    offset_y = (bbox.get_north() - north) * scale_y
+    dest_x = max(0, int(math.floor(offset_x)))
+    dest_y = max(0, int(math.floor(offset_y)))
+    end_x = min(dest.get_width(),
+                int(math.ceil((east - bbox.get_west()) * scale_x)))
+    end_y = min(dest.get_height(),
+                int(math.ceil((bbox.get_north() - south) * scale_y)))
+    if end_x <= dest_x or end_y <= dest_y:
+        return None # beyond the map
+    pixbuf.composite(dest, dest_x, dest_y, end_x - dest_x, end_y - dest_y,
+                     offset_x, offset_y,
+                     (east - west) * scale_x / pixbuf.get_width(),
+                     (north - south) * scale_y / pixbuf.get_height(),
+                     gtk.gdk.INTERP_BILINEAR, 255)
+    return dest_x, dest_y, end_x - dest_x, end_y - dest_y
+
+def remove_tmp_files(pattern='/tmp/wms_*.png'):
+    """
+    Removes map files left in /tmp by former versions.
+    """
+    for file_ in glob.glob(pattern):
+        try:
+            os.remove(file_)
+        except OSError:
+            pass
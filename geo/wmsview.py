@@ -36,13 +36,18 @@ __version__ = '$Id: $'
 
 import os
 import gtk
+import Queue
+import gobject
 import logging
+import threading
 
 import geo
+import wmscache
 import constants
 
-from time import time
 from owslib.wms import WebMapService
+from wmscache import WMSTileCache
+from capcache import CapabilitiesCache
 
 from utils import _
 from geo import BoundingBox
@@ -51,6 +56,7 @@ from geo import GeoToolbar
 
 from sugar.graphics.toolbutton import ToolButton
 
+_LOG = logging.getLogger('wms-control')
 
 ###############################################################################
 
@@ -68,6 +74,7 @@ class WMSView(GeoCanvas):
         self._logger = logging.getLogger('wms-logger')
 
         self._control = _Controller(self)
+        self.connect("destroy", self.destroy_cb)
 
     def get_map_coords(self):
         """Returns the map coordinate of the mouse pointer.
@@ -77,15 +84,34 @@ class WMSView(GeoCanvas):
         #XXX return correct map coords
         return (int(self.x_pixel), int(self.y_pixel))
 
-    def display_map(self, file_):
-        """Displays the map tile from a file.
+    def display_pixbuf(self, pixbuf):
+        """Displays the given map image.
 
-        @param file_: Path to the file to be displayed.
+        @param pixbuf: The map as L{gtk.gdk.Pixbuf}.
         """
-        pixbuf = gtk.gdk.pixbuf_new_from_file(file_)
         self.drawable.draw_map(pixbuf, 0, 0)
         self.canvas.queue_draw()
 
+    def display_area(self, area):
+        """Displays a part of the map loaded so far (e.g. the rows decoded
+        or a tile arrived).
+
+        @param area: Tuple (pixbuf, x, y), the part and where it lies
+        within the map.
+        """
+        pixbuf, x, y = area
+        if self.drawable.pixmap is None:
+            return
+        self.drawable.pixmap.draw_pixbuf(self.drawable.ctx, pixbuf, 0, 0,
+                                         x, y, -1, -1)
+        self.canvas.queue_draw()
+
+    def destroy_cb(self, widget):
+        """Callback to stop requesting maps and to store the index of the
+        map cache."""
+        self._control.shutdown()
+        self._control.flush_caches()
+
     def get_world_cursor(self):
         """
         Returns the cursors coordinates for the specified geo instance.
@@ -120,6 +146,7 @@ class _Controller():
     _FORMAT = 'image/png'
     _SRS = 'EPSG:4326'
     _VERSION = '1.1.1'
+    _CHUNK_SIZE = 8 * 1024 # bytes of a GetMap response decoded at once
 
     def __init__(self, wms_view):
 
@@ -127,6 +154,13 @@ class _Controller():
         self.wms_view = wms_view
         self.wms = None
         self.display_layers = None
+        self.cache = None # tiles of the current map, if WMS_TILED
+        self.layer_caches = {} # {layer: tiles}, if WMS_TILED and WMS_LAYERWISE
+        self._layer_maps = {} # {layer: (extent, image)} last image per layer
+        self._requester = _MapRequester()
+        self._capabilities = CapabilitiesCache()
+
+        wmscache.remove_tmp_files()
 
     def connect_to_wms(self, url, display_layers):
         """Connects to WMS with given URL.
@@ -134,13 +168,51 @@ class _Controller():
         @param url: The WMS URL where to connect to.
         @param display_layers: The layers the WMS shall render as map.
         """
-        self.wms = WebMapService(url, self._VERSION)
+        self.wms = WebMapService(url, self._VERSION,
+                                 cache=self._capabilities)
         self.display_layers = display_layers
+        self.flush_caches()
+        self.cache = None
+        self.layer_caches = {}
+        self._layer_maps = {}
+        if constants.WMS_TILED and not constants.WMS_LAYERWISE:
+            self.cache = WMSTileCache(url, display_layers, self._SRS,
+                                      self._FORMAT)
 
         self._logger.debug('WMS: %s' % url)
         self._logger.debug('WMS contents: %s' % self.wms.contents)
         self._logger.debug('display_layers: %s ' % display_layers )
 
+    def set_display_layers(self, display_layers):
+        """Changes the layers of the map and re-requests it.
+
+        If WMS_LAYERWISE, the images of layers displayed before are re-used,
+        so only added layers are requested from WMS.
+
+        @param display_layers: The layers the WMS shall render as map.
+        """
+        self.display_layers = display_layers
+        if self.cache:
+            self.cache.flush()
+            self.cache = WMSTileCache(self.wms.url, display_layers, self._SRS,
+                                      self._FORMAT)
+        bbox = self.wms_view.current_bbox
+        if bbox.lon_min is None:
+            self.perform_getmap()
+        else:
+            self.update_map(bbox)
+
+    def flush_caches(self):
+        """Writes the index of the map caches."""
+        if self.cache:
+            self.cache.flush()
+        for cache in self.layer_caches.values():
+            cache.flush()
+
+    def shutdown(self):
+        """Stops requesting maps."""
+        self._requester.shutdown()
+
     def update_map(self, bbox):
         """Re-requests the current WMS with a new boundingbox."""
         size_width = float(self.wms_view.get_allocation().width)
@@ -195,20 +267,327 @@ class _Controller():
         self._request_map(bbox, size)
 
     def _request_map(self, bbox, size):
-        """Requests the map from WMS."""
+        """Requests the map from WMS in the background. The map shown is
+        kept until the new one has arrived."""
+        bbox = BoundingBox(bbox.get_west(), bbox.get_south(),
+                           bbox.get_east(), bbox.get_north())
+        if constants.WMS_LAYERWISE:
+            caches = None
+            if constants.WMS_TILED:
+                caches = [self._get_layer_cache(layer) \
+                          for layer in self.display_layers]
+            self._requester.request(self._load_layers,
+                                    (self.wms, self.display_layers, caches,
+                                     self._layer_maps, bbox, size),
+                                    self.wms_view.display_pixbuf,
+                                    self.wms_view.display_area)
+            return
+        self._requester.request(self._load_map,
+                                (self.wms, self.display_layers, self.cache,
+                                 bbox, size),
+                                self.wms_view.display_pixbuf,
+                                self.wms_view.display_area)
+
+    def _load_map(self, superseded, report, wms, layers, cache, bbox, size):
+        """Loads the map (called from within the requester's thread).
+
+        The response is decoded while it arrives. Rows already decoded are
+        reported, so they can be displayed before the map is complete. Tiled
+        maps are reported per tile instead (see L{_load_tiles}), layerwise
+        maps only when complete (see L{_load_layers}).
+
+        @param superseded: Function indicating if a newer map was requested.
+        @param report: Function passing decoded parts of the map to the view.
+        @return: The map as L{gtk.gdk.Pixbuf} or None if superseded.
+        """
+        if cache:
+            return self._load_tiles(superseded, report, wms, layers, cache,
+                                    bbox, size)
+
         bbox_tuple = (bbox.get_west(), bbox.get_south(), bbox.get_east(), bbox.get_north())
         self._logger.debug("bbox: W=%s S=%s E=%s N=%s" % bbox_tuple)
-        img = self.wms.getmap(layers=self.display_layers, bbox=bbox_tuple, \
-                              format=self._FORMAT, size=size, \
-                              srs=self._SRS, transparent=True)
+        img = wms.getmap(layers=layers, bbox=bbox_tuple, \
+                         format=self._FORMAT, size=size, \
+                         srs=self._SRS, transparent=True)
+
+        return self._decode(img, superseded, report)[0]
+
+    def _decode(self, img, superseded, report=None, keep=False):
+        """Decodes a GetMap response while it arrives, chunk by chunk.
+
+        @param img: The response (a file-like object, closed afterwards).
+        @param superseded: Function indicating if a newer map was requested.
+        @param report: Function passing the rows decoded so far to the view
+        (optional).
+        @param keep: Whether to keep the encoded response (e.g. to cache it).
+        @return: Tuple (pixbuf, data), pixbuf is None if superseded, data is
+        None unless keep.
+        @raise IOError: If the response is no (complete) image.
+        """
+        loader = gtk.gdk.PixbufLoader()
+        chunks = []
+        rows = [0, 0] # [reported, decoded]
+        def area_updated_cb(loader, x, y, width, height):
+            rows[1] = max(rows[1], y + height)
+        loader.connect('area-updated', area_updated_cb)
+        complete = False
+        try:
+            try:
+                while True:
+                    if superseded():
+                        return None, None
+                    chunk = img.read(self._CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if keep:
+                        chunks.append(chunk)
+                    loader.write(chunk)
+                    if report is not None and rows[1] > rows[0]:
+                        pixbuf = loader.get_pixbuf()
+                        report((pixbuf.subpixbuf(0, rows[0],
+                                                 pixbuf.get_width(),
+                                                 rows[1] - rows[0]),
+                                0, rows[0]))
+                        rows[0] = rows[1]
+                complete = True
+            except gobject.GError, e:
+                raise IOError, "Invalid GetMap response: %s" % e
+        finally:
+            img.close()
+            try:
+                loader.close()
+            except gobject.GError, e:
+                if complete:
+                    raise IOError, "Incomplete GetMap response: %s" % e
+        if keep:
+            return loader.get_pixbuf(), ''.join(chunks)
+        return loader.get_pixbuf(), None
+
+    def _get_layer_cache(self, layer):
+        """Returns the tile cache of a single layer (created if needed)."""
+        cache = self.layer_caches.get(layer)
+        if cache is None:
+            cache = WMSTileCache(self.wms.url, [layer], self._SRS,
+                                 self._FORMAT)
+            self.layer_caches[layer] = cache
+        return cache
+
+    def _load_layers(self, superseded, report, wms, layers, caches,
+                     layer_maps, bbox, size):
+        """Loads each layer as a transparent image of its own and composes
+        the map of them (called from within the requester's thread).
+
+        Layers are loaded concurrently by up to WMS_LAYER_WORKERS threads,
+        from the layer's tile cache if WMS_TILED or else as a single GetMap
+        request (the last image per layer is kept for the same extent). The
+        map is returned once all layers are loaded; nothing is reported
+        before, since a map of the layers loaded so far would replace the
+        map shown by one lacking the upper layers.
+
+        @param caches: The tile cache per layer or None if not WMS_TILED.
+        @param layer_maps: The last images per layer, if not WMS_TILED.
+        @return: The map as L{gtk.gdk.Pixbuf} or None if superseded.
+        """
+        def load(index):
+            if caches:
+                return self._load_tiles(superseded, None, wms, [layers[index]],
+                                        caches[index], bbox, size, True)
+            return self._load_layer(superseded, wms, layers[index],
+                                    layer_maps, bbox, size)
+
+        images = [None] * len(layers)
+        for index, image in _load_concurrently(superseded, range(len(layers)),
+                                               load,
+                                               constants.WMS_LAYER_WORKERS):
+            images[index] = image
+        if superseded():
+            return None
+        return _compose(images, size)
+
+    def _load_layer(self, superseded, wms, layer, layer_maps, bbox, size):
+        """Requests a single layer from WMS, unless its last image has the
+        same extent. The response is decoded while it arrives.
+
+        @return: The layer as L{gtk.gdk.Pixbuf} or None if superseded.
+        """
+        extent = (bbox.get_west(), bbox.get_south(), bbox.get_east(),
+                  bbox.get_north(), size)
+        last = layer_maps.get(layer)
+        if last is not None and last[0] == extent:
+            return last[1]
+        img = wms.getmap(layers=[layer], bbox=extent[:4],
+                         format=self._FORMAT, size=size, srs=self._SRS,
+                         transparent=True)
+        image = self._decode(img, superseded)[0]
+        if image is not None:
+            layer_maps[layer] = (extent, image)
+        return image
+
+    def _load_tiles(self, superseded, report, wms, layers, cache, bbox,
+                    size, transparent=False):
+        """Composes the map of cached tiles. Missing tiles are requested
+        from WMS by up to WMS_TILE_WORKERS threads. Once the cached tiles
+        are reported, each missing tile is reported as it arrives.
+
+        @param report: Function passing areas of the map to the view (None
+        to report nothing, e.g. for a single layer).
+        @param transparent: Whether to compose the tiles on a transparent
+        background (to be composed with other layers) instead of white.
+        """
+        level = wmscache.get_level(bbox, size)
+        first_col, first_row, last_col, last_row = \
+            wmscache.get_tile_range(bbox, level)
+        self._logger.debug("tiles: level=%s cols=%s-%s rows=%s-%s" % \
+                           (level, first_col, last_col, first_row, last_row))
+
+        map_ = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, transparent, 8,
+                              int(size[0]), int(size[1]))
+        if transparent:
+            map_.fill(0x00000000)
+        else:
+            map_.fill(0xffffffff) # GetMap's default background color
+        missing = []
+        for col in range(first_col, last_col + 1):
+            for row in range(first_row, last_row + 1):
+                tile = (level, col, row)
+                if not wmscache.is_valid(tile):
+                    continue
+                pixbuf = cache.get(tile)
+                if pixbuf is None:
+                    missing.append(tile)
+                else:
+                    wmscache.draw_tile(pixbuf, tile, bbox, map_)
+        if not missing:
+            return map_
+
+        if report is not None:
+            report((map_.copy(), 0, 0))
+        load = lambda tile: self._load_tile(superseded, wms, layers, cache,
+                                            tile)
+        for tile, pixbuf in _load_concurrently(superseded, missing, load,
+                                               constants.WMS_TILE_WORKERS):
+            if pixbuf is None:
+                continue
+            area = wmscache.draw_tile(pixbuf, tile, bbox, map_)
+            if area is not None and report is not None:
+                x, y, width, height = area
+                report((map_.subpixbuf(x, y, width, height).copy(), x, y))
+        if superseded():
+            return None
+        return map_
+
+    def _load_tile(self, superseded, wms, layers, cache, tile):
+        """Requests a tile from WMS, decodes it while it arrives and caches
+        it.
+
+        @return: The decoded tile or None if the request failed or was
+        superseded.
+        """
+        size = (wmscache.TILE_PIXELS, wmscache.TILE_PIXELS)
+        try:
+            img = wms.getmap(layers=layers, bbox=wmscache.get_tile_bbox(tile),
+                             format=self._FORMAT, size=size, srs=self._SRS,
+                             transparent=True)
+            pixbuf, data = self._decode(img, superseded, keep=True)
+        except Exception, e:
+            self._logger.error("GetMap for tile %s failed: %s" % (tile, e))
+            return None
+        if pixbuf is None:
+            return None
+        return cache.put(tile, data, pixbuf)
+
+###############################################################################
 
-        # Write map to a tmp file
-        file_ = '/tmp/wms_' + str(long(time())) + '.png'
-        tmp = open(file_, 'w')
-        tmp.write(img.read())
-        tmp.close()
+class _MapRequester():
+    """Runs map requests one after another in a background thread.
 
-        self.wms_view.display_map(file_)
+    Only the latest request counts: a request still waiting is replaced by
+    a newer one, and the result of a running request is dropped when a
+    newer one was made meanwhile. Results are passed to the callback from
+    within the gobject main loop.
+    """
+
+    def __init__(self):
+        self._logger = logging.getLogger('wms-requester')
+        self._logger.setLevel(constants.LOG_LEVEL)
+
+        self._cond = threading.Condition()
+        self._generation = 0 # counts requests
+        self._waiting = None # (generation, load, args, callback, progress)
+        self._stopped = False
+
+        worker = threading.Thread(target=self._work, name='wms-requester')
+        worker.setDaemon(True)
+        worker.start()
+
+    def request(self, load, args, callback, progress=None):
+        """Requests a map. Returns immediately.
+
+        @param load: The function loading the map, called from within the
+        thread as load(superseded, report, *args). superseded() indicates
+        if a newer request was made, so load may give up early (returning
+        None). report(part) passes a part of the result to progress.
+        @param args: The arguments to pass to load.
+        @param callback: Called as callback(result) with the result of load,
+        unless it is None or was superseded.
+        @param progress: Called as progress(part) for each part reported,
+        unless superseded (optional).
+        """
+        self._cond.acquire()
+        try:
+            self._generation += 1
+            self._waiting = (self._generation, load, args, callback, progress)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def shutdown(self):
+        """Drops a waiting request and stops the thread."""
+        self._cond.acquire()
+        try:
+            self._generation += 1 # supersedes a running request
+            self._waiting = None
+            self._stopped = True
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def is_current(self, generation):
+        """Indicates if no newer request than the given one was made."""
+        return generation == self._generation
+
+    def _work(self):
+        """Worker loop: runs the latest request until shut down."""
+        while True:
+            self._cond.acquire()
+            try:
+                while self._waiting is None and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                generation, load, args, callback, progress = self._waiting
+                self._waiting = None
+            finally:
+                self._cond.release()
+
+            superseded = lambda: not self.is_current(generation)
+            def report(part):
+                if progress is not None:
+                    gobject.idle_add(self._deliver, generation, progress, part)
+            try:
+                result = load(superseded, report, *args)
+            except Exception, e:
+                self._logger.error("Map request failed: %s" % e)
+                continue
+            if result is not None:
+                gobject.idle_add(self._deliver, generation, callback, result)
+
+    def _deliver(self, generation, callback, result):
+        """Passes the result to the callback, unless it was superseded
+        (called once from the main loop)."""
+        if self.is_current(generation):
+            callback(result)
+        return False
 
 ###############################################################################
 
@@ -291,9 +670,8 @@ class _MapToolbar(GeoToolbar):
 ###############################################################################
 
 class _WMSToolbar(gtk.Toolbar):
-    """Provides tools to connect to one of the default WMS instances.
-
-    TODO Provide also a combobox for layers?
+    """Provides tools to connect to one of the default WMS instances and to
+    choose the layers of its map.
     """
     _DEFAULT_WMS = os.path.join(constants.BUNDLE_PATH, 'config/default_wms')
 
@@ -329,6 +707,13 @@ class _WMSToolbar(gtk.Toolbar):
         cb_item.add(combo_box)
         self.insert(cb_item, -1)
 
+        layers_btn = gtk.Button(_('Layers'))
+        layers_btn.set_relief(gtk.RELIEF_NONE)
+        layers_btn.connect('clicked', self.layers_cb)
+        layers_item = gtk.ToolItem()
+        layers_item.add(layers_btn)
+        self.insert(layers_item, -1)
+
         refresh_map_btn = ToolButton('reload')
         refresh_map_btn.set_tooltip(_('Refresh Map.'))
         bbox = self.wms_view.current_bbox
@@ -357,6 +742,44 @@ class _WMSToolbar(gtk.Toolbar):
         self.wms_view.current_bbox.reset()
         self.control.perform_getmap()
 
+    def layers_cb(self, button):
+        """Pops up a menu to choose the layers of the map from the layers the
+        current WMS offers.
+
+        @param button: The button the event was triggered.
+        """
+        if not self.control.wms:
+            return
+        menu = gtk.Menu()
+        names = self.control.wms.contents.keys()
+        names.sort()
+        for name in names:
+            item = gtk.CheckMenuItem(name, use_underline=False)
+            item.set_active(name in self.control.display_layers)
+            item.connect('toggled', self.layer_toggled_cb, name)
+            menu.append(item)
+        menu.show_all()
+        menu.popup(None, None, None, 0, gtk.get_current_event_time())
+
+    def layer_toggled_cb(self, item, name):
+        """Adds the layer to or removes it from the map. The last layer is
+        kept.
+
+        @param item: The menu item toggled.
+        @param name: The name of the layer.
+        """
+        layers = [layer for layer in self.control.display_layers
+                  if layer != name]
+        if item.get_active():
+            layers.append(name)
+        elif not layers:
+            item.handler_block_by_func(self.layer_toggled_cb)
+            item.set_active(True)
+            item.handler_unblock_by_func(self.layer_toggled_cb)
+            return
+        self._logger.debug('Display layers: %s' % layers)
+        self.control.set_display_layers(layers)
+
     def _read_default_wmss(self):
         """Returns list containing the default WMS instances read from
         `config/default_wms').
@@ -377,6 +800,70 @@ class _WMSToolbar(gtk.Toolbar):
 
 ###########################  FUNCTIONS  #######################################
 
+def _load_concurrently(superseded, items, load, workers):
+    """Loads items by up to the given number of threads.
+
+    @param superseded: Function indicating if the results are not needed
+    anymore. Loading stops early then.
+    @param items: The items to load.
+    @param load: The function loading an item, called as load(item) from
+    within the threads. Its exceptions are logged (result None).
+    @return: A generator of tuples (item, result) in order of arrival.
+    """
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+    loaded = Queue.Queue()
+
+    def work():
+        while not superseded():
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = load(item)
+            except Exception, e:
+                _LOG.error("Loading %s failed: %s" % (item, e))
+                result = None
+            loaded.put((item, result))
+
+    for i in range(min(workers, len(items))):
+        worker = threading.Thread(target=work, name='wms-loader-%d' % i)
+        worker.setDaemon(True)
+        worker.start()
+
+    for count in range(len(items)):
+        while True:
+            if superseded():
+                return
+            try:
+                yield loaded.get(True, 0.5)
+                break
+            except Queue.Empty:
+                pass
+
+def _compose(images, size):
+    """Composes layer images to a map, the first layer at the bottom (as
+    WMS draws the layers of a GetMap request).
+
+    @param images: The layer images (L{gtk.gdk.Pixbuf}), None for layers
+    not loaded yet.
+    @param size: The map size (width, height) in pixels.
+    @return: The map as L{gtk.gdk.Pixbuf}.
+    """
+    map_ = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8,
+                          int(size[0]), int(size[1]))
+    map_.fill(0xffffffff) # GetMap's default background color
+    for image in images:
+        if image is None:
+            continue
+        width = min(image.get_width(), map_.get_width())
+        height = min(image.get_height(), map_.get_height())
+        image.composite(map_, 0, 0, width, height, 0, 0, 1, 1,
+                        gtk.gdk.INTERP_NEAREST, 255)
+    return map_
+
 def _extract_wms_info(line):
     """Returns URL and list of layers.
 